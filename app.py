@@ -5,9 +5,20 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from artifact_store import ArtifactStore
+from jobs import JobQueue
+from metrics import RequestMetrics
+from profiler import SlowRequestProfiler
+from logging_config import configure_logging
+from database import engine_options, sqlite_pragmas, apply_sqlite_pragmas
+from retention import RetentionSweeper
+from live import LiveSessions
+from rollups import AggregateRollups
+from storage import storage_from_config
+from dedup import PHASH_BANDS
+
+# Configure logging: INFO by default, LOG_LEVEL and LOG_FORMAT=json override it
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Create the Flask app
@@ -16,16 +27,125 @@ app.secret_key = os.environ.get("SESSION_SECRET", "fallback_secret_key_for_devel
 
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///threadcounty.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# SQLite runs in WAL mode with relaxed syncing (see database.sqlite_pragmas); set
+# SQLITE_JOURNAL_MODE=DELETE on filesystems without shared memory support, e.g. NFS
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 30))
+
+# Server databases: one pooled connection per request thread (WORKER_THREADS, see gunicorn.conf.py)
+# plus two for the job dispatcher and its completion callbacks
+app.config['DB_POOL_SIZE'] = int(os.environ.get("DB_POOL_SIZE", 0)) or int(os.environ.get("WORKER_THREADS", 2)) + 2
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get("DB_MAX_OVERFLOW", app.config['DB_POOL_SIZE']))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"], app.config)
+
 # Set up the upload folder for fabric images
 app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Upload storage: 'local' keeps uploads and their derivatives under UPLOAD_FOLDER, spread over
+# STORAGE_SHARD_DEPTH levels of hash-prefix directories; 's3' keeps them in S3_BUCKET of an
+# S3-compatible store (S3_ENDPOINT_URL for MinIO and the like, credentials from the usual AWS_*
+# variables) and caches the STORAGE_BLOCK_SIZE ranges it reads in STORAGE_CACHE_FOLDER, up to
+# STORAGE_CACHE_BYTES, checking a cached file against the bucket again once it is
+# STORAGE_CACHE_REVALIDATE_SECONDS old. Partial chunked uploads always stay under UPLOAD_FOLDER
+app.config['STORAGE_BACKEND'] = os.environ.get("STORAGE_BACKEND", "local")
+app.config['STORAGE_SHARD_DEPTH'] = int(os.environ.get("STORAGE_SHARD_DEPTH", 2))
+app.config['S3_BUCKET'] = os.environ.get("S3_BUCKET")
+app.config['S3_PREFIX'] = os.environ.get("S3_PREFIX", "uploads/")
+app.config['S3_ENDPOINT_URL'] = os.environ.get("S3_ENDPOINT_URL")
+app.config['S3_REGION'] = os.environ.get("S3_REGION")
+app.config['STORAGE_CACHE_FOLDER'] = os.environ.get("STORAGE_CACHE_FOLDER", os.path.join(os.getcwd(), 'storage-cache'))
+app.config['STORAGE_CACHE_BYTES'] = int(os.environ.get("STORAGE_CACHE_BYTES", 1024 * 1024 * 1024))
+app.config['STORAGE_BLOCK_SIZE'] = int(os.environ.get("STORAGE_BLOCK_SIZE", 1024 * 1024))
+app.config['STORAGE_CACHE_REVALIDATE_SECONDS'] = float(os.environ.get("STORAGE_CACHE_REVALIDATE_SECONDS", 5))
+
+# Resumable chunked uploads for large images: each chunk is one request, so
+# UPLOAD_CHUNK_SIZE must stay within MAX_CONTENT_LENGTH
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+app.config['CHUNKED_UPLOAD_MAX_SIZE'] = int(os.environ.get("CHUNKED_UPLOAD_MAX_SIZE", 2 * 1024 * 1024 * 1024))
+
+# Rendered visualizations are stored once at analysis time and served from here
+app.config['ARTIFACT_FOLDER'] = os.environ.get("ARTIFACT_FOLDER", os.path.join(os.getcwd(), 'artifacts'))
+app.config['ARTIFACT_CACHE_BYTES'] = int(os.environ.get("ARTIFACT_CACHE_BYTES", 64 * 1024 * 1024))
+
+# Background analysis: ASYNC_ANALYSIS makes API uploads return 202 and a job id by default,
+# ANALYSIS_WORKERS sizes the process pool (defaults to every core). Long polls for jobs another
+# process is running re-read the job's row every JOB_POLL_INTERVAL seconds. Every process claims
+# queued jobs from the table, and looks for new ones every JOB_CLAIM_INTERVAL seconds; a running
+# job whose process stopped renewing its lease for JOB_LEASE_SECONDS is queued again. A job whose
+# worker process died is retried up to JOB_MAX_ATTEMPTS times in all before it is marked failed
+app.config['ASYNC_ANALYSIS'] = os.environ.get("ASYNC_ANALYSIS", "false").lower() in ('1', 'true', 'yes')
+app.config['ANALYSIS_WORKERS'] = int(os.environ.get("ANALYSIS_WORKERS", 0)) or os.cpu_count()
+app.config['JOB_POLL_MAX_WAIT'] = float(os.environ.get("JOB_POLL_MAX_WAIT", 30))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get("JOB_POLL_INTERVAL", 0.25))
+app.config['JOB_CLAIM_INTERVAL'] = float(os.environ.get("JOB_CLAIM_INTERVAL", 1.0))
+app.config['JOB_LEASE_SECONDS'] = float(os.environ.get("JOB_LEASE_SECONDS", 60))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+app.config['BATCH_MAX_FILES'] = int(os.environ.get("BATCH_MAX_FILES", 200))
+
+# Default processing mode when a request does not pass one: full, roi or pyramid
+app.config['ANALYSIS_MODE'] = os.environ.get("ANALYSIS_MODE", "full")
+
+# Visualization grid: 'uniform' spreads the counts evenly, 'tiles' rules each tile at its detected pitch
+app.config['OVERLAY_STYLE'] = os.environ.get("OVERLAY_STYLE", "uniform")
+
+# Analysis engine: 'tiled' sums each tile along the image axes, 'spectral' runs a 2D FFT per tile that
+# also copes with skewed fabric and records the skew angle. DESKEW_OVERLAY rotates the visualization
+# by the detected skew so its grid follows the threads (spectral engine only)
+app.config['ANALYSIS_ENGINE'] = os.environ.get("ANALYSIS_ENGINE", "tiled")
+app.config['DESKEW_OVERLAY'] = os.environ.get("DESKEW_OVERLAY", "false").lower() in ('1', 'true', 'yes')
+
+# Duplicate uploads: byte-identical images with the same parameters reuse the earlier result.
+# Images within DUPLICATE_MAX_DISTANCE bits of perceptual hash are flagged as near duplicates,
+# and reuse the earlier result too when REUSE_NEAR_DUPLICATES is set (or a request asks for it).
+# Candidates are looked up by hash band, which only finds every match up to PHASH_BANDS - 1 bits
+app.config['DUPLICATE_MAX_DISTANCE'] = int(os.environ.get("DUPLICATE_MAX_DISTANCE", 3))
+if not 0 <= app.config['DUPLICATE_MAX_DISTANCE'] <= PHASH_BANDS - 1:
+    clamped = min(max(app.config['DUPLICATE_MAX_DISTANCE'], 0), PHASH_BANDS - 1)
+    logger.warning("DUPLICATE_MAX_DISTANCE must be between 0 and %s, using %s", PHASH_BANDS - 1, clamped)
+    app.config['DUPLICATE_MAX_DISTANCE'] = clamped
+app.config['REUSE_NEAR_DUPLICATES'] = os.environ.get("REUSE_NEAR_DUPLICATES", "false").lower() in ('1', 'true', 'yes')
+
+# API results link to the overlay image at /api/result/<id>/overlay.jpg; older clients that read
+# the base64 copy inline can get it back with INLINE_VISUALIZATION (or ?inline_visualization=1)
+app.config['INLINE_VISUALIZATION'] = os.environ.get("INLINE_VISUALIZATION", "false").lower() in ('1', 'true', 'yes')
+
+# Opt-in sampling profiler: requests slower than PROFILE_SLOW_REQUEST_MS (0 disables it) have
+# their sampled stacks written to PROFILE_FOLDER as flamegraph-ready .folded files
+app.config['PROFILE_SLOW_REQUEST_MS'] = float(os.environ.get("PROFILE_SLOW_REQUEST_MS", 0))
+app.config['PROFILE_SAMPLE_INTERVAL_MS'] = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", 5))
+app.config['PROFILE_FOLDER'] = os.environ.get("PROFILE_FOLDER", os.path.join(os.getcwd(), 'profiles'))
+
+# Retention: analyses older than RETENTION_DAYS (0 keeps them forever) are archived in the background,
+# deleting their upload, derivatives and visualization; unfinished chunked uploads expire after
+# UPLOAD_SESSION_TTL_HOURS. Sweeps run every RETENTION_INTERVAL seconds, RETENTION_BATCH_SIZE rows at
+# a time, deleting at most RETENTION_FILES_PER_SECOND files
+app.config['RETENTION_DAYS'] = float(os.environ.get("RETENTION_DAYS", 0))
+app.config['UPLOAD_SESSION_TTL_HOURS'] = float(os.environ.get("UPLOAD_SESSION_TTL_HOURS", 24))
+app.config['RETENTION_INTERVAL'] = float(os.environ.get("RETENTION_INTERVAL", 300))
+app.config['RETENTION_BATCH_SIZE'] = int(os.environ.get("RETENTION_BATCH_SIZE", 100))
+app.config['RETENTION_FILES_PER_SECOND'] = float(os.environ.get("RETENTION_FILES_PER_SECOND", 50))
+
+# Live analysis: a phone streams low-resolution frames (over a WebSocket when flask-sock is installed,
+# else one POST each) and gets counts smoothed across frames back; only a locked session is stored.
+# Frames are downscaled to LIVE_FRAME_SIZE pixels and limited to LIVE_MAX_FRAME_BYTES, each new frame
+# weighs LIVE_SMOOTHING in the moving average, and counts are stable once they have moved by at most
+# LIVE_STABLE_TOLERANCE for LIVE_STABLE_FRAMES frames. Each open WebSocket holds a worker thread
+app.config['LIVE_SESSION_TTL'] = float(os.environ.get("LIVE_SESSION_TTL", 300))
+app.config['LIVE_MAX_SESSIONS'] = int(os.environ.get("LIVE_MAX_SESSIONS", 32))
+app.config['LIVE_FRAME_SIZE'] = int(os.environ.get("LIVE_FRAME_SIZE", 640))
+app.config['LIVE_MAX_FRAME_BYTES'] = int(os.environ.get("LIVE_MAX_FRAME_BYTES", 1024 * 1024))
+app.config['LIVE_SMOOTHING'] = float(os.environ.get("LIVE_SMOOTHING", 0.3))
+app.config['LIVE_STABLE_FRAMES'] = int(os.environ.get("LIVE_STABLE_FRAMES", 5))
+app.config['LIVE_STABLE_TOLERANCE'] = float(os.environ.get("LIVE_STABLE_TOLERANCE", 0.02))
+
+# /api/export streams analyses EXPORT_BATCH_SIZE rows at a time, read through a server-side cursor
+app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
@@ -35,14 +155,58 @@ class Base(DeclarativeBase):
 # Initialize SQLAlchemy with the Base
 db = SQLAlchemy(model_class=Base)
 db.init_app(app)
+with app.app_context():
+    apply_sqlite_pragmas(db.engine, sqlite_pragmas(app.config))
+
+# Storage backend for uploads and their derivatives
+storage = storage_from_config(app.config)
+app.extensions['storage'] = storage
+
+# Initialize the content-addressed store for rendered analysis artifacts
+artifact_store = ArtifactStore()
+artifact_store.init_app(app)
+
+# Initialize the background job queue for analyses
+job_queue = JobQueue()
+job_queue.init_app(app)
+
+# Request and stage latency metrics, served on /metrics
+request_metrics = RequestMetrics()
+request_metrics.init_app(app)
+
+slow_request_profiler = SlowRequestProfiler()
+slow_request_profiler.init_app(app)
+
+# Background expiry of old analyses and abandoned upload sessions
+retention_sweeper = RetentionSweeper()
+retention_sweeper.init_app(app)
+
+# Daily rollups of the analysis metrics behind /api/aggregates, updated as analyses complete
+aggregate_rollups = AggregateRollups()
+aggregate_rollups.init_app(app)
+
+# In-memory sessions of the live camera analysis
+live_sessions = LiveSessions()
+live_sessions.init_app(app)
+
+from migrations import upgrade_schema
+
+def init_db():
+    """
+    Create missing tables and bring the schema up to date
+
+    Runs once per deployment (main.py, the gunicorn master or ``flask init-db``)
+    rather than on import, so server workers and scripts start without touching
+    the schema.
+    """
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+    logger.info("Database tables created")
 
 # Import routes after app initialization to avoid circular imports
 from routes import *
 from models import *
-
-with app.app_context():
-    # Create database tables
-    db.create_all()
-    logger.info("Database tables created")
+import commands
 
 logger.info("threadcounty application initialized")
@@ -0,0 +1,308 @@
+import os
+import json
+import shutil
+import hashlib
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+class Artifact(NamedTuple):
+    """A stored artifact together with the metadata needed for HTTP caching"""
+    data: bytes
+    digest: str
+    last_modified: datetime
+
+class ArtifactStore:
+    """
+    Content-addressed store for rendered analysis artifacts (e.g. visualizations)
+
+    Blobs are written once to ``objects/<digest[:2]>/<digest>`` where the digest is
+    the SHA-256 of the content, and a small ref file maps the lookup key (analysis
+    id plus processing parameters) to that digest. A bounded in-memory LRU sits in
+    front of the disk tier so repeated views of the same result never touch disk.
+
+    Blobs are reference counted through ``backrefs/<digest[:2]>/<digest>/``, a
+    directory holding one empty file per key that points at the blob, so deleting
+    the last key of a blob deletes the blob without scanning the store.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_memory_bytes: int = 64 * 1024 * 1024):
+        self.root = root
+        self.max_memory_bytes = max_memory_bytes
+        self._cache: "OrderedDict[str, Artifact]" = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        """Configure the store from the Flask app config"""
+        self.root = app.config['ARTIFACT_FOLDER']
+        self.max_memory_bytes = app.config.get('ARTIFACT_CACHE_BYTES', self.max_memory_bytes)
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'refs'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'backrefs'), exist_ok=True)
+        app.extensions['artifact_store'] = self
+
+    @staticmethod
+    def make_key(kind: str, analysis_id: int, params: Dict[str, Any]) -> str:
+        """
+        Build a stable lookup key for an artifact
+
+        Args:
+            kind: Artifact kind, e.g. 'visualization'
+            analysis_id: ID of the analysis the artifact belongs to
+            params: Processing parameters that affect the artifact's content
+
+        Returns:
+            Hex digest identifying the artifact
+        """
+        payload = json.dumps({'kind': kind, 'analysis_id': analysis_id, 'params': params},
+                             sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.root, 'refs', key)
+
+    def _backrefs_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'backrefs', digest[:2], digest)
+
+    def _read_ref(self, key: str) -> Optional[str]:
+        try:
+            with open(self._ref_path(key)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes) -> Artifact:
+        """
+        Store an artifact under the given key
+
+        Args:
+            key: Lookup key from make_key
+            data: Raw artifact bytes
+
+        Returns:
+            The stored artifact
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self._object_path(digest)
+        previous = self._read_ref(key)
+
+        # The backref goes first, so a concurrent delete of the blob's last other key
+        # sees it and keeps the blob
+        backrefs_path = self._backrefs_path(digest)
+        os.makedirs(backrefs_path, exist_ok=True)
+        open(os.path.join(backrefs_path, key), 'w').close()
+
+        # Identical content is only ever written once; reusing a blob refreshes its
+        # mtime so collect_garbage does not delete it before the ref is written
+        try:
+            os.utime(object_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, object_path)
+
+        ref_path = self._ref_path(key)
+        tmp_path = f"{ref_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(digest)
+        os.replace(tmp_path, ref_path)
+
+        # A key re-pointed at new content no longer holds on to its old blob
+        if previous is not None and previous != digest:
+            self._unreference(key, previous)
+
+        artifact = Artifact(data, digest, self._mtime(object_path))
+        self._remember(key, artifact)
+        logger.debug("Stored artifact %s -> %s (%s bytes)", key[:12], digest[:12], len(data))
+        return artifact
+
+    def get(self, key: str) -> Optional[Artifact]:
+        """
+        Look up an artifact, checking the memory tier before the disk tier
+
+        Args:
+            key: Lookup key from make_key
+
+        Returns:
+            The artifact, or None if it has not been stored
+        """
+        with self._lock:
+            artifact = self._cache.get(key)
+            if artifact is not None:
+                self._cache.move_to_end(key)
+                return artifact
+
+        try:
+            with open(self._ref_path(key)) as f:
+                digest = f.read().strip()
+            object_path = self._object_path(digest)
+            with open(object_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        artifact = Artifact(data, digest, self._mtime(object_path))
+        self._remember(key, artifact)
+        return artifact
+
+    def remember(self, key: str, data: bytes, last_modified: datetime) -> Artifact:
+        """
+        Keep an artifact in the memory tier only
+
+        For renditions that are cheap to re-create from a stored artifact: they
+        never reach disk, so they cannot pile up there, and the LRU budget bounds
+        how many are held.
+
+        Args:
+            key: Lookup key from make_key
+            data: Raw artifact bytes
+            last_modified: Modification time of the artifact it was made from
+
+        Returns:
+            The artifact
+        """
+        artifact = Artifact(data, hashlib.sha256(data).hexdigest(), last_modified)
+        self._remember(key, artifact)
+        return artifact
+
+    def recall(self, key: str) -> Optional[Artifact]:
+        """
+        Look up an artifact in the memory tier only
+
+        Args:
+            key: Lookup key from make_key
+
+        Returns:
+            The artifact, or None if it is not held in memory
+        """
+        with self._lock:
+            artifact = self._cache.get(key)
+            if artifact is not None:
+                self._cache.move_to_end(key)
+            return artifact
+
+    def delete(self, key: str) -> bool:
+        """
+        Remove an artifact, and its blob unless identical artifacts under other keys share it
+
+        Args:
+            key: Lookup key from make_key
+
+        Returns:
+            True if the artifact existed
+        """
+        with self._lock:
+            artifact = self._cache.pop(key, None)
+            if artifact is not None:
+                self._cache_bytes -= len(artifact.data)
+
+        digest = self._read_ref(key)
+        try:
+            os.remove(self._ref_path(key))
+        except FileNotFoundError:
+            return False
+        if digest is not None:
+            self._unreference(key, digest)
+        return True
+
+    def _unreference(self, key: str, digest: str) -> bool:
+        """
+        Drop a key's backref to a blob, deleting the blob if it was the last one
+
+        A put racing with this for the same content may, in rare interleavings,
+        find its blob gone afterwards; get then reports the artifact as missing
+        and it is rendered again.
+
+        Returns:
+            True if the blob was deleted
+        """
+        backrefs_path = self._backrefs_path(digest)
+        try:
+            os.remove(os.path.join(backrefs_path, key))
+        except FileNotFoundError:
+            pass
+        try:
+            # Only succeeds once no other key refers to the blob; blobs stored before
+            # reference counting have no backrefs at all and are left to collect_garbage
+            os.rmdir(backrefs_path)
+        except OSError:
+            return False
+        try:
+            os.remove(self._object_path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def collect_garbage(self, grace_seconds: float = 3600) -> int:
+        """
+        Delete blobs that no ref points to
+
+        delete() already removes blobs as their last key goes; this full scan of
+        the store is for maintenance (``flask collect-artifacts``), to clear blobs
+        stored before reference counting or left behind by a crash. Blobs modified
+        within the grace period are kept, since put() may have just written or
+        reused one without having written its ref yet.
+
+        Args:
+            grace_seconds: Minimum age of a blob before it can be deleted
+
+        Returns:
+            Number of blobs deleted
+        """
+        referenced = set()
+        for entry in os.scandir(os.path.join(self.root, 'refs')):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    referenced.add(f.read().strip())
+            except FileNotFoundError:
+                pass
+
+        cutoff = time.time() - grace_seconds
+        deleted = 0
+        for shard in os.scandir(os.path.join(self.root, 'objects')):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name in referenced or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        shutil.rmtree(self._backrefs_path(entry.name), ignore_errors=True)
+                        deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+    def _remember(self, key: str, artifact: Artifact) -> None:
+        """Insert an artifact into the LRU, evicting the oldest entries over budget"""
+        size = len(artifact.data)
+        if size > self.max_memory_bytes:
+            return
+
+        with self._lock:
+            previous = self._cache.pop(key, None)
+            if previous is not None:
+                self._cache_bytes -= len(previous.data)
+            self._cache[key] = artifact
+            self._cache_bytes += size
+            while self._cache_bytes > self.max_memory_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted.data)
+
+    @staticmethod
+    def _mtime(path: str) -> datetime:
+        return datetime.fromtimestamp(int(os.path.getmtime(path)), tz=timezone.utc)
@@ -0,0 +1,520 @@
+"""
+Benchmarks for the thread counting pipeline
+
+Pipeline mode times the ThreadCounter stages on synthetic fabrics across a size
+sweep, each size in a fresh process so its peak RSS is its own:
+
+    python benchmark.py pipeline --sizes 512,1024,2048,4096 --output before.json
+
+Add --engines tiled,spectral --rotation 5 to compare the analysis engines on a
+skewed weave.
+
+HTTP mode drives /api/analyze, either on a running server or on one started
+in-process on a free local port:
+
+    python benchmark.py http --serve --requests 50 --concurrency 4 --output http.json
+
+Startup mode measures cold start: it launches the production server (or any
+--server command) repeatedly and times how long it takes to answer, and how
+long its first and second analyses take:
+
+    python benchmark.py startup --repeat 5 --output startup.json
+
+Steady-state throughput of the production server is then http mode with
+--url pointed at it.
+
+Database mode measures how many analyses per second the Analysis table takes
+from concurrent writers, writing each row the old way (insert, then update
+with the results) and in a single transaction, against SQLite or any
+--database URL:
+
+    python benchmark.py db --threads 1,4,8 --rows 2000 --output db.json
+
+Results are written as sorted, indented JSON so two runs can be diffed, or
+compared stage by stage:
+
+    python benchmark.py compare before.json after.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import shlex
+import socket
+import tempfile
+import logging
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+import multiprocessing
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from image_processor import ThreadCounter, ImagePipeline, MODES, ENGINES, WARP_ROI, region_slices
+from synthetic_fabric import FabricSpec, generate_fabric, expected_counts
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def summarize_latencies(latencies: List[float], wall_time: Optional[float] = None) -> Dict[str, float]:
+    """
+    Throughput and latency percentiles of a list of timings
+
+    Args:
+        latencies: Seconds taken by each call
+        wall_time: Elapsed time for all calls, when they ran concurrently
+
+    Returns:
+        Dictionary with images_per_sec, mean_ms, p50_ms and p99_ms
+    """
+    latencies_ms = np.array(latencies) * 1000
+    elapsed = wall_time if wall_time is not None else float(np.sum(latencies))
+    return {
+        'images_per_sec': round(len(latencies) / elapsed, 3),
+        'mean_ms': round(float(latencies_ms.mean()), 3),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 3),
+    }
+
+def count_error(spec: FabricSpec, warp_count: float, weft_count: float, deskewed: bool = False) -> Dict[str, float]:
+    """Absolute and relative error of measured counts against the ground truth of a synthetic fabric"""
+    expected_warp, expected_weft = expected_counts(spec, deskewed=deskewed)
+    return {
+        'expected_warp': round(expected_warp, 2),
+        'expected_weft': round(expected_weft, 2),
+        'warp_count': warp_count,
+        'weft_count': weft_count,
+        'warp_error': round(abs(warp_count - expected_warp), 2),
+        'weft_error': round(abs(weft_count - expected_weft), 2),
+        'relative_error': round(max(abs(warp_count - expected_warp) / expected_warp,
+                                    abs(weft_count - expected_weft) / expected_weft), 4),
+    }
+
+def _time_stage(repeat: int, setup: Callable[[], Any], stage: Callable[[Any], Any]) -> List[float]:
+    """Time a stage repeatedly, excluding the setup that gives each call fresh input"""
+    latencies = []
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        stage(argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def count_threads_stage(mode: str, engine: str) -> str:
+    """Name under which count_threads is reported for a mode and engine; the default engine goes unnamed"""
+    return f'count_threads[{mode}]' if engine == 'tiled' else f'count_threads[{mode},{engine}]'
+
+def benchmark_size(spec: FabricSpec, repeat: int, modes: List[str], engines: List[str] = ('tiled',)) -> Dict[str, Any]:
+    """
+    Benchmark every stage on one synthetic fabric; runs in its own worker process
+
+    Args:
+        spec: Fabric to generate
+        repeat: Number of timed calls per stage
+        modes: Processing modes to run count_threads in
+        engines: Analysis engines to run count_threads with, in every mode
+
+    Returns:
+        Per-stage timings, count errors and the peak RSS of the process
+    """
+    # The processing modules log every image at INFO/DEBUG
+    logging.getLogger().setLevel(logging.WARNING)
+    cv2.setNumThreads(1)
+
+    image = generate_fabric(spec)
+    baseline_rss = _peak_rss_mb()
+    counter = ThreadCounter()
+    stages = {}
+
+    stages['preprocess_image'] = summarize_latencies(_time_stage(
+        repeat, lambda: ImagePipeline(image), counter.preprocess_image))
+
+    warp_region = counter.preprocess_image(ImagePipeline(image))[region_slices(image.shape, WARP_ROI)]
+    stages['_frequency_domain_analysis'] = summarize_latencies(_time_stage(
+        repeat, lambda: warp_region, lambda region: counter._frequency_domain_analysis(region, vertical=True)))
+
+    # The visualization draws onto the decoded pixels, so each call gets its own copy
+    warp_count, weft_count = (int(round(count)) for count in expected_counts(spec))
+    stages['_create_visual_result'] = summarize_latencies(_time_stage(
+        repeat, lambda: ImagePipeline(image.copy()),
+        lambda pipeline: counter._create_visual_result(pipeline, warp_count, weft_count)))
+
+    accuracy = {}
+    for mode in modes:
+        for engine in engines:
+            mode_counter = ThreadCounter(mode=mode, engine=engine)
+            stage = count_threads_stage(mode, engine)
+            results = []
+            stages[stage] = summarize_latencies(_time_stage(
+                repeat, lambda: ImagePipeline(image.copy()),
+                lambda pipeline: results.append(mode_counter.count_threads(pipeline))))
+            accuracy[stage] = count_error(spec, results[-1]['warp_count'], results[-1]['weft_count'],
+                                          deskewed='skew_angle' in results[-1])
+
+    return {
+        'spec': spec._asdict(),
+        'stages': stages,
+        'accuracy': accuracy,
+        'baseline_rss_mb': round(baseline_rss, 1),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+def run_pipeline(args) -> Dict[str, Any]:
+    """Run the pipeline benchmark over the requested size sweep"""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in args.sizes:
+        spec = FabricSpec(width=size, height=size, warp_pitch=args.warp_pitch, weft_pitch=args.weft_pitch,
+                          noise=args.noise, rotation=args.rotation, seed=args.seed)
+        # A fresh process per size keeps each peak RSS independent of the sizes before it
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(benchmark_size, spec, args.repeat, args.modes, args.engines).result()
+        results.append(result)
+        for engine in args.engines:
+            stage = count_threads_stage(args.modes[0], engine)
+            stats = result['stages'][stage]
+            print(f"{size}x{size}: {stage} {stats['images_per_sec']} images/sec, p50 {stats['p50_ms']} ms, "
+                  f"p99 {stats['p99_ms']} ms, error {result['accuracy'][stage]['relative_error']:.2%}, "
+                  f"peak RSS {result['peak_rss_mb']} MB")
+    return {'results': results}
+
+def encode_multipart(fields: Dict[str, str], filename: str, data: bytes):
+    """Encode form fields and one file as multipart/form-data, returning (body, content type)"""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+               f'Content-Type: image/jpeg\r\n\r\n'.encode())
+    body.write(data)
+    body.write(f'\r\n--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+def _serve_locally() -> str:
+    """Start the app on a free local port in a background thread, returning its base URL"""
+    from werkzeug.serving import make_server
+    from app import app, init_db
+
+    init_db()
+    # Keep the per-request access log out of the report
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+def _fabric_spec(args) -> FabricSpec:
+    return FabricSpec(width=args.size, height=args.size, warp_pitch=args.warp_pitch, weft_pitch=args.weft_pitch,
+                      noise=args.noise, rotation=args.rotation, seed=args.seed)
+
+def _encode_fabric(spec: FabricSpec) -> bytes:
+    ok, buffer = cv2.imencode('.jpg', generate_fabric(spec), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buffer.tobytes()
+
+def post_analyze(base_url: str, image_bytes: bytes, mode: str, index: int, timeout: float) -> Dict[str, Any]:
+    """Upload one image to /api/analyze, returning its latency and results or error"""
+    # Bytes after the JPEG end marker are ignored by decoders but make every upload
+    # unique, so duplicate detection does not answer from an earlier result
+    data = image_bytes + uuid.uuid4().bytes
+    body, content_type = encode_multipart({'unit': 'cm', 'reference_length': '1', 'mode': mode},
+                                          f'bench-{index}.jpg', data)
+    request = urllib.request.Request(f'{base_url}/api/analyze', data=body, method='POST',
+                                     headers={'Content-Type': content_type})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            payload = json.loads(response.read())
+    except Exception as e:
+        return {'latency': time.perf_counter() - start, 'error': str(e)}
+    return {'latency': time.perf_counter() - start, 'results': payload.get('results')}
+
+def run_http(args) -> Dict[str, Any]:
+    """Drive /api/analyze with concurrent requests and measure the responses"""
+    base_url = _serve_locally() if args.serve else args.url.rstrip('/')
+
+    spec = _fabric_spec(args)
+    image_bytes = _encode_fabric(spec)
+
+    def send(index: int) -> Dict[str, Any]:
+        return post_analyze(base_url, image_bytes, args.mode, index, args.timeout)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        responses = list(executor.map(send, range(args.requests)))
+    wall_time = time.perf_counter() - start
+
+    succeeded = [response for response in responses if response.get('results')]
+    result = {
+        'spec': spec._asdict(),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'mode': args.mode,
+        'upload_bytes': len(image_bytes),
+        'errors': len(responses) - len(succeeded),
+    }
+    if succeeded:
+        result['latency'] = summarize_latencies([response['latency'] for response in succeeded], wall_time)
+        last = succeeded[-1]['results']
+        result['accuracy'] = count_error(spec, last['warp_count'], last['weft_count'])
+        print(f"{len(succeeded)}/{args.requests} requests: {result['latency']['images_per_sec']} images/sec, "
+              f"p50 {result['latency']['p50_ms']} ms, p99 {result['latency']['p99_ms']} ms")
+    return {'results': [result]}
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float) -> None:
+    """Poll the server until it answers, failing if it exits or the timeout passes"""
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode} before answering")
+        try:
+            with urllib.request.urlopen(f'{base_url}/metrics', timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server did not answer within {timeout:.0f} s")
+            time.sleep(0.02)
+
+def run_startup(args) -> Dict[str, Any]:
+    """Launch the server repeatedly, timing readiness and its first and second analyses"""
+    spec = _fabric_spec(args)
+    image_bytes = _encode_fabric(spec)
+    timings = {'ready': [], 'first_request': [], 'second_request': []}
+    errors = 0
+
+    # The server runs in the current directory, where the app keeps its uploads, with this checkout importable
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+
+    for run in range(args.repeat):
+        port = _free_port()
+        command = shlex.split(args.server.format(port=port, python=shlex.quote(sys.executable), root=shlex.quote(root)))
+        base_url = f'http://127.0.0.1:{port}'
+
+        start = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_until_ready(base_url, process, args.timeout)
+            timings['ready'].append(time.perf_counter() - start)
+            for stage, index in (('first_request', 0), ('second_request', 1)):
+                response = post_analyze(base_url, image_bytes, args.mode, run * 2 + index, args.timeout)
+                errors += 'error' in response
+                timings[stage].append(response['latency'])
+        finally:
+            process.terminate()
+            process.wait()
+
+    stages = {stage: summarize_latencies(latencies) for stage, latencies in timings.items()}
+    print(f"ready in {stages['ready']['p50_ms']} ms, first analysis {stages['first_request']['p50_ms']} ms, "
+          f"second analysis {stages['second_request']['p50_ms']} ms (p50 of {args.repeat} starts)")
+    return {'results': [{'spec': spec._asdict(), 'server': args.server, 'errors': errors, 'stages': stages}]}
+
+# Results written by the database benchmark, as count_threads would report them
+_DB_RESULTS = {'warp_count': 40, 'weft_count': 24, 'thread_density': 64.0, 'confidence_score': 0.98,
+               'measurement_unit': 'cm'}
+
+def run_db(args) -> Dict[str, Any]:
+    """Write Analysis rows from concurrent threads, per-stage commits against a single transaction"""
+    # The app reads the database URL when it is imported
+    database = args.database or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    os.environ['DATABASE_URL'] = database
+    from app import app, db, init_db
+    from models import Analysis, STATUS_RUNNING
+
+    init_db()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def new_analysis(index: int) -> Analysis:
+        return Analysis(filename=f'{uuid.uuid4()}.jpg', original_filename=f'bench-{index}.jpg', measurement_unit='cm',
+                        reference_length=1.0, processing_mode='full', status=STATUS_RUNNING)
+
+    def per_stage_commits(index: int) -> None:
+        # Row written when the upload arrives, then again with the results
+        analysis = new_analysis(index)
+        db.session.add(analysis)
+        db.session.commit()
+        analysis.apply_results(_DB_RESULTS)
+        db.session.commit()
+
+    def single_transaction(index: int) -> None:
+        analysis = new_analysis(index)
+        analysis.apply_results(_DB_RESULTS)
+        db.session.add(analysis)
+        db.session.commit()
+
+    def writer(write: Callable[[int], None], indexes: range) -> List[float]:
+        latencies = []
+        with app.app_context():
+            for index in indexes:
+                start = time.perf_counter()
+                write(index)
+                latencies.append(time.perf_counter() - start)
+            db.session.remove()
+        return latencies
+
+    with app.app_context():
+        backend = db.engine.dialect.name
+    results = []
+    for threads in args.threads:
+        stages = {}
+        for write in (per_stage_commits, single_transaction):
+            share = args.rows // threads
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                latencies = [latency for chunk in executor.map(
+                    lambda thread: writer(write, range(thread * share, (thread + 1) * share)), range(threads))
+                    for latency in chunk]
+            stages[write.__name__] = summarize_latencies(latencies, time.perf_counter() - start)
+            print(f"{backend} {threads} threads, {write.__name__}: {stages[write.__name__]['images_per_sec']} rows/sec, "
+                  f"p99 {stages[write.__name__]['p99_ms']} ms")
+        results.append({'label': f'{backend} x{threads}', 'backend': backend, 'threads': threads, 'stages': stages})
+    return {'results': results}
+
+def _metadata(args) -> Dict[str, Any]:
+    """Environment the benchmark ran in, so diffs between runs can be explained"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'command': args.command,
+        'date': datetime.utcnow().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('command', 'output')},
+    }
+
+def compare(baseline_path: str, current_path: str) -> None:
+    """Print the relative change of every stage between two benchmark files"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    def index(report):
+        rows = {}
+        for result in report['results']:
+            size = result['label'] if 'label' in result else f"{result['spec']['width']}x{result['spec']['height']}"
+            for stage, stats in result.get('stages', {'http': result.get('latency', {})}).items():
+                rows[(size, stage)] = stats
+        return rows
+
+    before, after = index(baseline), index(current)
+    print(f"{'size':>11} {'stage':<30} {'p50 ms':>20} {'images/sec':>22}")
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        if not old or not new:
+            continue
+        p50_change = (new['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100
+        rate_change = (new['images_per_sec'] - old['images_per_sec']) / old['images_per_sec'] * 100
+        print(f"{key[0]:>11} {key[1]:<30} {new['p50_ms']:>10.2f} ({p50_change:+6.1f}%) "
+              f"{new['images_per_sec']:>12.2f} ({rate_change:+6.1f}%)")
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',') if item]
+
+def _mode_list(value: str) -> List[str]:
+    modes = [item for item in value.split(',') if item]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown processing modes: {', '.join(unknown)}")
+    return modes
+
+def _engine_list(value: str) -> List[str]:
+    engines = [item for item in value.split(',') if item]
+    unknown = [engine for engine in engines if engine not in ENGINES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown analysis engines: {', '.join(unknown)}")
+    return engines
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the thread counting pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_fabric_options(subparser):
+        subparser.add_argument('--warp-pitch', type=float, default=8.0, help='Pixels between warp threads')
+        subparser.add_argument('--weft-pitch', type=float, default=10.0, help='Pixels between weft threads')
+        subparser.add_argument('--noise', type=float, default=10.0, help='Gaussian noise standard deviation')
+        subparser.add_argument('--rotation', type=float, default=0.0, help='Weave rotation in degrees')
+        subparser.add_argument('--seed', type=int, default=0, help='Random seed for the noise')
+        subparser.add_argument('--output', help='Write the results to this JSON file')
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='Time the ThreadCounter stages over a size sweep')
+    pipeline_parser.add_argument('--sizes', type=_int_list, default=[512, 1024, 2048, 4096],
+                                 help='Comma-separated square image sizes in pixels')
+    pipeline_parser.add_argument('--repeat', type=int, default=5, help='Timed calls per stage and size')
+    pipeline_parser.add_argument('--modes', type=_mode_list, default=['full'],
+                                 help='Comma-separated processing modes for count_threads')
+    pipeline_parser.add_argument('--engines', type=_engine_list, default=['tiled'],
+                                 help='Comma-separated analysis engines for count_threads')
+    add_fabric_options(pipeline_parser)
+
+    http_parser = subparsers.add_parser('http', help='Load test /api/analyze')
+    target = http_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='Base URL of a running server')
+    target.add_argument('--serve', action='store_true', help='Start the app on a free local port')
+    http_parser.add_argument('--requests', type=int, default=50, help='Total number of requests')
+    http_parser.add_argument('--concurrency', type=int, default=4, help='Requests in flight at once')
+    http_parser.add_argument('--size', type=int, default=2048, help='Square image size in pixels')
+    http_parser.add_argument('--mode', choices=MODES, default='full', help='Processing mode')
+    http_parser.add_argument('--timeout', type=float, default=120.0, help='Per-request timeout in seconds')
+    add_fabric_options(http_parser)
+
+    startup_parser = subparsers.add_parser('startup', help='Time server cold start and first requests')
+    startup_parser.add_argument('--server', default='{python} -m gunicorn -c {root}/gunicorn.conf.py --bind 127.0.0.1:{port} wsgi:app',
+                                help='Command starting the server; {port}, {python} and {root} (this checkout) are filled in')
+    startup_parser.add_argument('--repeat', type=int, default=5, help='Number of server starts')
+    startup_parser.add_argument('--size', type=int, default=1024, help='Square image size in pixels')
+    startup_parser.add_argument('--mode', choices=MODES, default='full', help='Processing mode')
+    startup_parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for the server and each request')
+    add_fabric_options(startup_parser)
+
+    db_parser = subparsers.add_parser('db', help='Time concurrent writes to the Analysis table')
+    db_parser.add_argument('--database', help='Database URL, a fresh SQLite file by default')
+    db_parser.add_argument('--threads', type=_int_list, default=[1, 4, 8], help='Comma-separated writer thread counts')
+    db_parser.add_argument('--rows', type=int, default=2000, help='Rows written per pattern and thread count')
+    db_parser.add_argument('--output', help='Write the results to this JSON file')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two benchmark result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.command == 'compare':
+        compare(args.baseline, args.current)
+        return
+
+    runners = {'pipeline': run_pipeline, 'http': run_http, 'startup': run_startup, 'db': run_db}
+    report = runners[args.command](args)
+    report['meta'] = _metadata(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import hashlib
+from typing import BinaryIO
+
+# Partial uploads live in a subfolder of the upload folder, so finalizing is a rename
+PARTIAL_FOLDER = 'partial'
+
+# Bytes copied from the request stream per read
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def partial_path(upload_folder: str, upload_id: str) -> str:
+    """Path of the file receiving the chunks of an upload"""
+    return os.path.join(upload_folder, PARTIAL_FOLDER, f"{upload_id}.part")
+
+def received_bytes(path: str) -> int:
+    """Number of bytes received so far, which is where the next chunk must start"""
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+def write_chunk(path: str, offset: int, stream: BinaryIO, max_size: int) -> int:
+    """
+    Write a chunk at the given offset, streaming it from the request without buffering it
+    
+    Writing at an explicit offset, rather than appending, makes retries idempotent:
+    a chunk resent after a dropped connection simply rewrites the same bytes.
+    
+    Args:
+        path: Partial upload file
+        offset: Position of the first byte of the chunk
+        stream: Readable stream with the chunk bytes
+        max_size: Declared size of the whole upload
+        
+    Returns:
+        Number of bytes received after the write
+        
+    Raises:
+        ValueError: If the chunk starts before the file or past the received bytes, or runs past max_size
+    """
+    if offset < 0:
+        raise ValueError(f"Chunk offset {offset} is negative")
+    if offset > received_bytes(path):
+        raise ValueError(f"Chunk offset {offset} is past the {received_bytes(path)} bytes received")
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab'):
+        pass
+    
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        position = offset
+        while True:
+            block = stream.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            position += len(block)
+            if position > max_size:
+                raise ValueError(f"Upload is larger than the declared {max_size} bytes")
+            f.write(block)
+    
+    return received_bytes(path)
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
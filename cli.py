@@ -0,0 +1,408 @@
+"""
+Offline batch analysis of fabric images, without the web server
+
+Runs ThreadCounter over directories (searched recursively) or glob patterns in
+a pool of worker processes, for instance to reprocess an archive after the
+algorithm changed:
+
+    python cli.py 'archive/2024/**/*.jpg' --unit inch --workers 8 --output results.csv
+
+Results are written to --output as CSV or JSON (by its extension), and/or
+inserted straight into the Analysis table of --database in bulk:
+
+    python cli.py archive/ --database sqlite:///instance/threadcounty.db
+
+Every finished file is recorded in a manifest (--manifest, JSON lines), after
+its row has been committed when writing to a database. Running the same
+command again skips the files the manifest has results for, unless the file
+or the analysis settings changed, so an interrupted run picks up where it
+stopped; files that failed are retried. The output file is written from the
+manifest and so covers resumed runs as a whole.
+
+Only the image processing modules are imported: no Flask app is created and
+the database is only touched with --database.
+"""
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import uuid
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+import cv2
+
+from image_processor import ThreadCounter, ImagePipeline, MODES, ENGINES
+from tiled_image import open_tiled_image
+from dedup import stream_content_hash, perceptual_hash, hash_bands
+
+logger = logging.getLogger(__name__)
+
+# Image files picked up in directories; the web app accepts the same extensions
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tif', 'tiff', 'bmp'}
+
+# Default manifest, in the current directory
+MANIFEST_FILENAME = 'threadcounty-manifest.jsonl'
+
+# Result fields written to the output file, in order
+OUTPUT_FIELDS = (
+    'path', 'status', 'error', 'warp_count', 'weft_count', 'thread_density', 'confidence_score', 'skew_angle',
+    'measurement_unit', 'reference_length', 'processing_mode', 'engine', 'content_hash', 'perceptual_hash', 'seconds'
+)
+
+# Files queued per worker, so workers never wait for the next file while the queue stays short
+QUEUED_PER_WORKER = 4
+
+# The worker process's counter, created once by _init_worker
+_counter: Optional[ThreadCounter] = None
+
+def find_images(inputs: Iterable[str]) -> List[str]:
+    """
+    Image files named by a list of directories, glob patterns and paths
+
+    Returns:
+        Sorted, de-duplicated paths of the files with an image extension
+    """
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = glob.iglob(os.path.join(glob.escape(item), '**', '*'), recursive=True)
+        else:
+            candidates = glob.iglob(item, recursive=True) if glob.has_magic(item) else [item]
+        for path in candidates:
+            if os.path.isfile(path) and '.' in path and path.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS:
+                paths.add(os.path.abspath(path))
+    return sorted(paths)
+
+def analysis_settings(args) -> Dict[str, Any]:
+    """Settings a result depends on; results recorded with other settings are redone"""
+    return {
+        'unit': args.unit,
+        'reference_length': args.reference_length,
+        'mode': args.mode,
+        'engine': args.engine,
+    }
+
+def _init_worker(settings: Dict[str, Any]) -> None:
+    """Create the worker's counter; OpenCV gets one thread since the pool already uses every core"""
+    global _counter
+    cv2.setNumThreads(1)
+    _counter = ThreadCounter(unit=settings['unit'], reference_length=settings['reference_length'],
+                             engine=settings['engine'], mode=settings['mode'])
+
+def analyze_file(path: str) -> Dict[str, Any]:
+    """
+    Count the threads in one image file, in a worker process
+
+    The visualization is never rendered. Large TIFFs are analyzed out of core,
+    like uploads of the web app.
+
+    Returns:
+        The manifest record of the file: its path, size and modification time,
+        'status' ('completed' or 'failed') and the results or the 'error'
+    """
+    start = time.perf_counter()
+    stat = os.stat(path)
+    record = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    try:
+        with open(path, 'rb') as f:
+            record['content_hash'] = stream_content_hash(f)
+
+        tiled = open_tiled_image(path, min_pixels=_counter.out_of_core_pixels) if _counter.out_of_core else None
+        if tiled is not None:
+            try:
+                result = _counter.measure(tiled)
+            finally:
+                tiled.close()
+            # The preview assembled while the blocks were read is enough for the hash
+            record['perceptual_hash'] = perceptual_hash(tiled.preview)
+        else:
+            pipeline = ImagePipeline.from_path(path)
+            record['perceptual_hash'] = perceptual_hash(pipeline.image)
+            result = _counter.measure(pipeline)
+            pipeline.release()
+
+        record.update({
+            'status': 'completed',
+            'warp_count': result['warp_count'],
+            'weft_count': result['weft_count'],
+            'thread_density': result['thread_density'],
+            'confidence_score': result['confidence_score'],
+            'skew_angle': result.get('skew_angle'),
+            'measurement_unit': result['measurement_unit'],
+            'reference_length': _counter.reference_length,
+            'processing_mode': result['mode'],
+            'engine': result['engine'],
+        })
+    except Exception as e:
+        record.update({'status': 'failed', 'error': str(e)})
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    return record
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+class Manifest:
+    """
+    JSON lines file with one record per analyzed file, the latest record of a path winning
+
+    Records are appended and flushed one by one, so a run that is interrupted
+    keeps every record written before it stopped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short when the last run was killed
+                        continue
+                    self.records[record['path']] = record
+        self._file = open(path, 'a')
+        # Start on a new line after a line cut short
+        if self._file.tell() and not _ends_with_newline(path):
+            self._file.write('\n')
+
+    def is_done(self, path: str, settings: Dict[str, Any]) -> bool:
+        """Whether the manifest has results for the file as it is now, analyzed with these settings"""
+        record = self.records.get(path)
+        if record is None or record['status'] != 'completed' or record.get('settings') != settings:
+            return False
+        stat = os.stat(path)
+        return record['size'] == stat.st_size and record['mtime'] == stat.st_mtime
+
+    def add(self, records: List[Dict[str, Any]]) -> None:
+        for record in records:
+            self.records[record['path']] = record
+            self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+class DatabaseWriter:
+    """
+    Bulk inserts of completed results into the Analysis table of an existing database
+
+    Rows are inserted and added to the aggregate rollups in one transaction
+    per batch. The images are not copied into upload storage, so the rows are
+    inserted as archived: the app lists their results without linking to
+    files it does not have. Each row's notes record the file it came from.
+    """
+
+    def __init__(self, url: str):
+        # SQLAlchemy is only needed, and imported, when writing to a database
+        from sqlalchemy import MetaData, create_engine
+
+        self.engine = create_engine(url)
+        metadata = MetaData()
+        metadata.reflect(self.engine, only=lambda name, _: name in ('analysis', 'analysis_rollup'))
+        if 'analysis' not in metadata.tables:
+            raise SystemExit(f"{url} has no analysis table; create the schema first with `flask init-db`")
+        self.analysis = metadata.tables['analysis']
+        # Databases from before the rollups have no rollup table until `flask init-db` upgrades them
+        self.rollups = metadata.tables.get('analysis_rollup')
+
+    @staticmethod
+    def row(record: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+        """Analysis row of a completed manifest record"""
+        name = os.path.basename(record['path'])
+        extension = name.rsplit('.', 1)[1].lower()
+        row = {
+            'filename': f"{uuid.uuid4()}.{extension}",
+            'original_filename': name[:255],
+            'notes': f"Imported from {record['path']}",
+            'date_created': now,
+            'archived_at': now,
+            'image_processed': True,
+            'status': 'completed',
+        }
+        row.update({key: record[key] for key in (
+            'warp_count', 'weft_count', 'thread_density', 'confidence_score', 'skew_angle', 'measurement_unit',
+            'reference_length', 'processing_mode', 'content_hash', 'perceptual_hash')})
+        for band, value in enumerate(hash_bands(record['perceptual_hash'])):
+            row[f'phash_band{band}'] = value
+        return row
+
+    def insert(self, records: List[Dict[str, Any]]) -> None:
+        """
+        Insert the rows of completed records, and their rollups, in one transaction
+
+        Files already imported with the same content, settings and counts are
+        skipped, so a batch committed just before a run was killed, but missing
+        from its manifest, is not inserted twice when the run is resumed. Counts
+        that changed with the algorithm are imported as new rows.
+        """
+        from sqlalchemy import insert, select
+        from rollups import rollup_rows, add_to_rollups
+
+        now = datetime.utcnow()
+        rows = [self.row(record, now) for record in records]
+        table = self.analysis
+        key_columns = [table.c.content_hash, table.c.notes, table.c.measurement_unit, table.c.reference_length,
+                       table.c.processing_mode, table.c.warp_count, table.c.weft_count]
+        with self.engine.begin() as connection:
+            imported = set(connection.execute(
+                select(*key_columns).where(table.c.content_hash.in_({row['content_hash'] for row in rows}))
+            ).all())
+            rows = [row for row in rows if tuple(row[column.name] for column in key_columns) not in imported]
+            if not rows:
+                return
+            connection.execute(insert(table), rows)
+            if self.rollups is not None:
+                add_to_rollups(connection, self.rollups, rollup_rows(rows))
+
+def write_output(path: str, records: List[Dict[str, Any]]) -> None:
+    """Write records to a CSV file, or a JSON array for a .json path"""
+    rows = [{field: record.get(field) for field in OUTPUT_FIELDS} for record in records]
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=2)
+            f.write('\n')
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+class Progress:
+    """Files done, failures and throughput on stderr, at most once per interval"""
+
+    def __init__(self, total: int, interval: float = 1.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self._start = time.monotonic()
+        self._last = 0.0
+        self._tty = sys.stderr.isatty()
+
+    def update(self, record: Dict[str, Any]) -> None:
+        self.done += 1
+        if record['status'] != 'completed':
+            self.failed += 1
+        now = time.monotonic()
+        if now - self._last >= self.interval or self.done == self.total:
+            self._last = now
+            self.report(now)
+
+    def report(self, now: float) -> None:
+        elapsed = max(now - self._start, 1e-9)
+        rate = self.done / elapsed
+        remaining = (self.total - self.done) / rate if rate else 0
+        line = (f"{self.done}/{self.total} files, {self.failed} failed, "
+                f"{rate:.1f} images/s, {elapsed:.0f}s elapsed, ~{remaining:.0f}s left")
+        sys.stderr.write(('\r' + line + ' ' * 4) if self._tty else line + '\n')
+        if self._tty and self.done == self.total:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+def run(args) -> int:
+    """
+    Analyze the files named on the command line
+
+    Returns:
+        Exit status: 0 if every file was analyzed, 1 if any failed
+    """
+    settings = analysis_settings(args)
+    paths = find_images(args.inputs)
+    manifest = Manifest(args.manifest)
+    pending = [path for path in paths if not manifest.is_done(path, settings)]
+    print(f"{len(paths)} images, {len(paths) - len(pending)} already analyzed, {len(pending)} to analyze",
+          file=sys.stderr)
+
+    database = DatabaseWriter(args.database) if args.database else None
+    progress = Progress(len(pending))
+    batch: List[Dict[str, Any]] = []
+
+    def finish(records: List[Dict[str, Any]]) -> None:
+        # Completed rows are in the database before the manifest says so
+        if database is not None:
+            database.insert(records)
+        manifest.add(records)
+
+    executor = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(settings,))
+    try:
+        queue = iter(pending)
+        running = set()
+        while True:
+            # Keep a few files queued per worker
+            for path in queue:
+                running.add(executor.submit(analyze_file, path))
+                if len(running) >= args.workers * QUEUED_PER_WORKER:
+                    break
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                record = dict(future.result(), settings=settings)
+                progress.update(record)
+                if record['status'] != 'completed':
+                    logger.warning("Could not analyze %s: %s", record['path'], record['error'])
+                    manifest.add([record])
+                elif database is not None:
+                    batch.append(record)
+                else:
+                    finish([record])
+            if len(batch) >= args.batch_size:
+                records, batch = batch, []
+                finish(records)
+    finally:
+        # Files still queued when a run is interrupted are left for the next one, while
+        # the results already in are kept
+        executor.shutdown(cancel_futures=True)
+        if batch:
+            finish(batch)
+        manifest.close()
+
+    records = [manifest.records[path] for path in paths if path in manifest.records]
+    if args.output:
+        write_output(args.output, records)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    failed = sum(1 for record in records if record['status'] != 'completed')
+    if failed:
+        print(f"{failed} images could not be analyzed; run again to retry them", file=sys.stderr)
+    return 1 if failed else 0
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='threadcounty', description='Count threads in fabric images offline')
+    parser.add_argument('inputs', nargs='+', help='Image files, directories or glob patterns (quote them)')
+    parser.add_argument('--unit', choices=('cm', 'inch'), default='cm', help='Unit of the counts')
+    parser.add_argument('--reference-length', type=float, default=1.0, help='Length the counts are scaled to')
+    parser.add_argument('--mode', choices=MODES, default='full', help='Processing mode')
+    parser.add_argument('--engine', choices=ENGINES, default=os.environ.get('ANALYSIS_ENGINE', 'tiled'),
+                        help='Analysis engine [default: ANALYSIS_ENGINE or tiled]')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--output', help='Write the results to this CSV file, or JSON for a .json path')
+    parser.add_argument('--database', help='Insert the results into the Analysis table of this database URL')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows inserted per database transaction')
+    parser.add_argument('--manifest', default=MANIFEST_FILENAME, help='Manifest recording the analyzed files')
+    parser.add_argument('--verbose', action='store_true', help='Log every analysis')
+
+    args = parser.parse_args(argv)
+    if not (args.output or args.database):
+        parser.error('give --output, --database or both')
+    if args.reference_length <= 0:
+        parser.error('--reference-length must be positive')
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s %(name)s: %(message)s')
+
+    try:
+        sys.exit(run(args))
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume", file=sys.stderr)
+        sys.exit(130)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import logging
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import click
+
+from app import app, db, init_db, retention_sweeper, aggregate_rollups, storage, artifact_store
+from models import Analysis
+from derivatives import derivative_filename, is_derivative, backfill_derivatives, create_overlay_preview
+from visualizations import get_visualization
+
+logger = logging.getLogger(__name__)
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and upgrade the schema of the configured database"""
+    init_db()
+    click.echo("Database schema is up to date")
+
+@app.cli.command('sweep-retention')
+@click.option('--days', type=float, default=None, help='Archive analyses older than this many days [default: RETENTION_DAYS]')
+def sweep_retention_command(days):
+    """Archive expired analyses and remove stale upload sessions until nothing is due"""
+    max_age = timedelta(days=days) if days else None
+    if not (max_age or retention_sweeper.max_age or retention_sweeper.session_ttl):
+        raise click.UsageError("Retention is disabled; set RETENTION_DAYS or pass --days")
+    totals = retention_sweeper.sweep(max_age)
+    click.echo(f"Archived {totals['archived']} analyses, deleted {totals['files_deleted']} files "
+               f"and removed {totals['sessions_removed']} upload sessions")
+
+@app.cli.command('collect-artifacts')
+@click.option('--grace-hours', default=1.0, show_default=True, help='Keep blobs written more recently than this')
+def collect_artifacts_command(grace_hours):
+    """Delete stored artifacts no key refers to, e.g. those stored before they were reference counted"""
+    deleted = artifact_store.collect_garbage(grace_hours * 3600)
+    click.echo(f"Deleted {deleted} unreferenced artifacts")
+
+@app.cli.command('rebuild-rollups')
+@click.option('--batch-size', default=1000, show_default=True, help='Analyses read per batch')
+def rebuild_rollups_command(batch_size):
+    """Recompute the aggregate rollups from every processed analysis, e.g. after upgrading"""
+    analyses, rows = aggregate_rollups.rebuild(db.session, batch_size)
+    click.echo(f"Rebuilt {rows} rollup rows from {analyses} analyses")
+
+@app.cli.command('backfill-derivatives')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Number of worker processes')
+def backfill_derivatives_command(workers):
+    """Generate missing thumbnails, previews and overlay previews for existing uploads"""
+    # One listing of the storage; derivatives are skipped by name rather than looked up
+    originals = [name for name in storage.names() if not is_derivative(name)]
+    click.echo(f"Checking {len(originals)} uploads")
+
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for count in executor.map(partial(backfill_derivatives, storage), originals, chunksize=16):
+            written += count
+    click.echo(f"Wrote {written} thumbnail/preview derivatives")
+
+    # Overlay previews come from the stored visualizations of processed analyses
+    overlays = 0
+    for analysis in Analysis.query.filter_by(image_processed=True).yield_per(500):
+        if analysis.archived_at is not None or \
+                storage.exists(derivative_filename(analysis.filename, 'overlay')) or not storage.exists(analysis.filename):
+            continue
+        try:
+            create_overlay_preview(storage, analysis.filename, get_visualization(analysis).data)
+            overlays += 1
+        except ValueError as e:
+            logger.error("Error creating overlay preview for analysis %s: %s", analysis.id, e)
+    click.echo(f"Wrote {overlays} overlay previews")
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """Move uploads still stored flat in UPLOAD_FOLDER into the configured storage backend"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    moved = 0
+    for entry in os.scandir(upload_folder):
+        if not entry.is_file() or entry.name.endswith('.tmp'):
+            continue
+        storage.put_file(entry.name, entry.path)
+        moved += 1
+        if moved % 1000 == 0:
+            click.echo(f"Moved {moved} files")
+    click.echo(f"Moved {moved} files into {app.config['STORAGE_BACKEND']} storage")
@@ -0,0 +1,63 @@
+import logging
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+def engine_options(database_uri: str, config) -> Dict[str, Any]:
+    """
+    SQLAlchemy engine options suited to the database backend
+
+    SQLite connections wait up to SQLITE_BUSY_TIMEOUT seconds for a concurrent
+    writer instead of failing with "database is locked". Server databases get a
+    pool of DB_POOL_SIZE connections plus DB_MAX_OVERFLOW under bursts, and are
+    pinged on checkout so connections dropped by the server are replaced.
+
+    Args:
+        database_uri: SQLALCHEMY_DATABASE_URI
+        config: The app config
+
+    Returns:
+        Options for SQLALCHEMY_ENGINE_OPTIONS
+    """
+    if database_uri.startswith('sqlite'):
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT']}}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': 300,
+        'pool_pre_ping': True,
+    }
+
+def sqlite_pragmas(config) -> Dict[str, Any]:
+    """
+    Pragmas run on every new SQLite connection
+
+    WAL lets readers carry on while an analysis is being written, and with WAL
+    synchronous=NORMAL only syncs at checkpoints rather than on every commit
+    while staying consistent after a crash.
+    """
+    return {
+        'journal_mode': config['SQLITE_JOURNAL_MODE'],
+        'synchronous': config['SQLITE_SYNCHRONOUS'],
+        'busy_timeout': int(config['SQLITE_BUSY_TIMEOUT'] * 1000),
+        'cache_size': -16 * 1024,  # 16 MB, negative values are in KiB
+        'temp_store': 'MEMORY',
+    }
+
+def apply_sqlite_pragmas(engine: Engine, pragmas: Dict[str, Any]) -> None:
+    """Run the given pragmas on each connection the engine opens; other backends are left alone"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    logger.info("SQLite pragmas: %s", ', '.join(f'{name}={value}' for name, value in pragmas.items()))
@@ -0,0 +1,76 @@
+import hashlib
+from typing import BinaryIO, List
+
+import cv2
+import numpy as np
+
+# The perceptual hash is a 64-bit difference hash (dHash) stored as 16 hex digits
+HASH_SIZE = 8
+
+# The hash is split into this many 16-bit bands, each stored in an indexed column.
+# Two hashes within PHASH_BANDS - 1 bits of each other share at least one band, so
+# looking up candidates by band finds every near match up to that distance.
+PHASH_BANDS = 4
+
+# Mean absolute grey-level difference under which two small renditions show the same photo.
+# Fabric is a repetitive texture, so different swatches shot under the same lighting can
+# share a perceptual hash; hash matches are confirmed against the thumbnails.
+MATCH_TOLERANCE = 8.0
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 of the uploaded bytes, identifying byte-for-byte identical uploads"""
+    return hashlib.sha256(data).hexdigest()
+
+def stream_content_hash(stream: BinaryIO, chunk_size: int = 1024 * 1024) -> str:
+    """content_hash of a file read in chunks, for uploads too large to hold in memory"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def perceptual_hash(image: np.ndarray) -> str:
+    """
+    Difference hash of a decoded image
+    
+    Re-encoded, resized or lightly recompressed copies of the same photo hash to
+    the same value or one a few bits away.
+    
+    Args:
+        image: Decoded BGR image
+        
+    Returns:
+        The hash as 16 hex digits
+    """
+    small = cv2.resize(image, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    bits = gray[:, 1:] > gray[:, :-1]
+    return np.packbits(bits.flatten()).tobytes().hex()
+
+def hash_bands(phash: str) -> List[int]:
+    """Split a perceptual hash into its PHASH_BANDS integer bands"""
+    width = len(phash) // PHASH_BANDS
+    return [int(phash[i * width:(i + 1) * width], 16) for i in range(PHASH_BANDS)]
+
+def hamming_distance(a: str, b: str) -> int:
+    """Number of differing bits between two perceptual hashes"""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+def images_match(a: np.ndarray, b: np.ndarray, tolerance: float = MATCH_TOLERANCE) -> bool:
+    """
+    Confirm a perceptual hash match by comparing two small renditions pixel by pixel
+    
+    Args:
+        a: First decoded BGR image
+        b: Second decoded BGR image, resized to the first if their aspect ratios agree
+        tolerance: Largest mean absolute difference still counted as a match
+        
+    Returns:
+        True if both show the same picture
+    """
+    (ha, wa), (hb, wb) = a.shape[:2], b.shape[:2]
+    if abs(wa / ha - wb / hb) > 0.02 * wa / ha:
+        return False
+    if (ha, wa) != (hb, wb):
+        b = cv2.resize(b, (wa, ha), interpolation=cv2.INTER_AREA)
+    diff = cv2.absdiff(cv2.cvtColor(a, cv2.COLOR_BGR2GRAY), cv2.cvtColor(b, cv2.COLOR_BGR2GRAY))
+    return float(diff.mean()) <= tolerance
@@ -0,0 +1,202 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from image_processor import VISUALIZATION_VERSION
+from dedup import images_match
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Longest side in pixels of each derivative generated from an upload
+DERIVATIVE_SIZES = {
+    'thumb': 160,
+    'medium': 800,
+}
+
+# Longest side of the downscaled visualization overlay
+OVERLAY_SIZE = 800
+
+DERIVATIVE_QUALITY = 85
+
+# Steps an overlay's requested quality and size are snapped to, so a client cannot
+# make the server encode and cache a new rendition for every value it asks for
+OVERLAY_QUALITIES = (50, 70, DERIVATIVE_QUALITY, 95)
+OVERLAY_SIDES = tuple(sorted(set(DERIVATIVE_SIZES.values()) | {OVERLAY_SIZE}))
+
+# Formats the overlay can be served in: extension, OpenCV quality flag and MIME type
+OVERLAY_FORMATS = {
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 'image/jpeg'),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 'image/webp'),
+}
+
+def derivative_filename(filename: str, size: str) -> str:
+    """
+    Name of a derivative stored next to the original upload
+
+    Overlay previews carry the visualization version so a re-rendered overlay
+    never reuses the name (and cached responses) of an older one.
+    """
+    stem = filename.rsplit('.', 1)[0]
+    if size == 'overlay':
+        return f"{stem}.overlay-v{VISUALIZATION_VERSION}.jpg"
+    return f"{stem}.{size}.jpg"
+
+def derivative_filenames(filename: str) -> List[str]:
+    """Names of every derivative an upload may have, including overlays of earlier visualization versions"""
+    stem = filename.rsplit('.', 1)[0]
+    names = [derivative_filename(filename, size) for size in DERIVATIVE_SIZES]
+    names.extend(f"{stem}.overlay-v{version}.jpg" for version in range(1, VISUALIZATION_VERSION + 1))
+    return names
+
+def is_derivative(filename: str) -> bool:
+    """Whether a file in the upload folder is a derivative rather than an original upload"""
+    parts = filename.split('.')
+    return len(parts) == 3 and (parts[1] in DERIVATIVE_SIZES or parts[1].startswith('overlay-'))
+
+def _resize_to_fit(image: np.ndarray, max_side: int) -> np.ndarray:
+    """Downscale an image so its longest side is at most max_side, never upscaling"""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def _write_jpeg(storage: Storage, name: str, image: np.ndarray) -> None:
+    """Encode a derivative and store it; storage writes are atomic, so readers never see a partial file"""
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, DERIVATIVE_QUALITY])
+    if not ok:
+        raise ValueError(f"Could not encode derivative: {name}")
+    storage.write(name, buffer.tobytes())
+
+def _read_image(storage: Storage, name: str) -> Optional[np.ndarray]:
+    """Decode a stored image, or None if it is missing or unreadable"""
+    try:
+        data = storage.read(name)
+    except FileNotFoundError:
+        return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+def create_derivatives(storage: Storage, filename: str, image: Optional[np.ndarray] = None) -> Dict[str, str]:
+    """
+    Generate the thumbnail and medium preview of an upload
+
+    Args:
+        storage: Storage holding the upload
+        filename: Stored name of the original upload
+        image: The already decoded upload, to avoid reading and decoding it again
+
+    Returns:
+        Mapping of size name to derivative name
+    """
+    if image is None:
+        image = _read_image(storage, filename)
+        if image is None:
+            raise ValueError(f"Could not read image: {filename}")
+
+    names = {}
+
+    # Each size is resized from the next larger one, which is cheaper than resizing the original twice
+    current = image
+    for size, max_side in sorted(DERIVATIVE_SIZES.items(), key=lambda item: -item[1]):
+        current = _resize_to_fit(current, max_side)
+        name = derivative_filename(filename, size)
+        _write_jpeg(storage, name, current)
+        names[size] = name
+
+    return names
+
+def create_overlay_preview(storage: Storage, filename: str, visualization: bytes) -> Optional[str]:
+    """
+    Generate the downscaled overlay preview of an upload
+
+    Args:
+        storage: Storage holding the upload
+        filename: Stored name of the original upload
+        visualization: JPEG encoded visualization of the analysis
+
+    Returns:
+        Name of the overlay preview, or None if the visualization could not be decoded
+    """
+    overlay = cv2.imdecode(np.frombuffer(visualization, np.uint8), cv2.IMREAD_COLOR)
+    if overlay is None:
+        return None
+
+    name = derivative_filename(filename, 'overlay')
+    _write_jpeg(storage, name, _resize_to_fit(overlay, OVERLAY_SIZE))
+    return name
+
+def snap_overlay_params(quality: Optional[int], max_side: Optional[int]) -> Tuple[int, Optional[int]]:
+    """
+    Snap a requested overlay quality and size to the nearest supported steps
+
+    Args:
+        quality: Requested encoder quality from 1 to 100, or None for the default
+        max_side: Requested longest side in pixels, or None for full resolution
+
+    Returns:
+        Tuple of the quality from OVERLAY_QUALITIES and the smallest size from
+        OVERLAY_SIDES that is at least as large as the one requested, or None when
+        a larger size than all of them is asked for
+    """
+    quality = DERIVATIVE_QUALITY if quality is None else min(OVERLAY_QUALITIES, key=lambda step: abs(step - quality))
+    if max_side is not None:
+        max_side = next((side for side in OVERLAY_SIDES if side >= max_side), None)
+    return quality, max_side
+
+def encode_overlay(visualization: bytes, fmt: str, quality: int = DERIVATIVE_QUALITY,
+                   max_side: Optional[int] = None) -> bytes:
+    """
+    Re-encode a visualization in another format, quality or size
+
+    Args:
+        visualization: JPEG encoded visualization of the analysis
+        fmt: Key of OVERLAY_FORMATS
+        quality: Encoder quality from 1 to 100
+        max_side: Longest side in pixels, or None for full resolution (never upscaled)
+
+    Returns:
+        The encoded overlay
+    """
+    overlay = cv2.imdecode(np.frombuffer(visualization, np.uint8), cv2.IMREAD_COLOR)
+    if overlay is None:
+        raise ValueError("Could not decode visualization")
+    if max_side:
+        overlay = _resize_to_fit(overlay, max_side)
+
+    extension, quality_flag, _ = OVERLAY_FORMATS[fmt]
+    ok, buffer = cv2.imencode(extension, overlay, [quality_flag, quality])
+    if not ok:
+        raise ValueError(f"Could not encode overlay as {fmt}")
+    return buffer.tobytes()
+
+def same_thumbnail(storage: Storage, filename: str, other_filename: str) -> bool:
+    """Whether two uploads have matching thumbnails, i.e. show the same photo"""
+    thumb = _read_image(storage, derivative_filename(filename, 'thumb'))
+    other = _read_image(storage, derivative_filename(other_filename, 'thumb'))
+    return thumb is not None and other is not None and images_match(thumb, other)
+
+def backfill_derivatives(storage: Storage, filename: str) -> int:
+    """
+    Generate any missing thumbnail/medium derivatives of an upload
+
+    Args:
+        storage: Storage holding the upload
+        filename: Stored name of the original upload
+
+    Returns:
+        Number of derivatives written
+    """
+    missing = [size for size in DERIVATIVE_SIZES if not storage.exists(derivative_filename(filename, size))]
+    if not missing:
+        return 0
+
+    try:
+        create_derivatives(storage, filename)
+    except ValueError as e:
+        logger.error("Error creating derivatives: %s", e)
+        return 0
+    return len(missing)
@@ -0,0 +1,145 @@
+import io
+import csv
+import json
+import zlib
+from datetime import datetime
+from typing import Any, Iterable, Iterator, List, Sequence
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - without pyarrow, exports are CSV or NDJSON only
+    pyarrow = None
+
+from models import Analysis
+
+# Export formats: file extension and content type of each
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'ndjson': ('ndjson', 'application/x-ndjson'),
+    'arrow': ('arrows', 'application/vnd.apache.arrow.stream'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+# Formats written with pyarrow
+ARROW_FORMATS = ('arrow', 'parquet')
+
+# Compressions an export can be wrapped in: file extension suffix and content type
+EXPORT_COMPRESSIONS = {'gzip': ('gz', 'application/gzip')}
+
+def available_formats() -> List[str]:
+    """Export formats supported by the installed packages"""
+    return [name for name in EXPORT_FORMATS if pyarrow is not None or name not in ARROW_FORMATS]
+
+def _arrow_schema(fields: Sequence[str]):
+    """
+    Arrow schema of the exported columns, taken from the Analysis column types
+
+    Declaring it up front keeps every batch on the same schema, even one whose
+    values of a column happen to all be null.
+    """
+    types = {int: pyarrow.int64(), float: pyarrow.float64(), bool: pyarrow.bool_(),
+             datetime: pyarrow.timestamp('us')}
+    return pyarrow.schema([(field, types.get(Analysis.__table__.c[field].type.python_type, pyarrow.string()))
+                           for field in fields])
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written to it since the last drain"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _csv_chunks(fields: Sequence[str], batches: Iterable[List[Sequence[Any]]]) -> Iterator[bytes]:
+    # Only the datetime columns need converting, to ISO 8601 as in the API
+    dates = [index for index, field in enumerate(fields) if Analysis.__table__.c[field].type.python_type is datetime]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for rows in batches:
+        if dates:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for index in dates:
+                    if row[index] is not None:
+                        row[index] = row[index].isoformat()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def _ndjson_chunks(fields: Sequence[str], batches: Iterable[List[Sequence[Any]]]) -> Iterator[bytes]:
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(fields, row)), default=datetime.isoformat) + '\n'
+                      for row in rows).encode('utf-8')
+
+def _arrow_chunks(fields: Sequence[str], batches: Iterable[List[Sequence[Any]]], fmt: str) -> Iterator[bytes]:
+    schema = _arrow_schema(fields)
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema) if fmt == 'parquet' else pyarrow.ipc.new_stream(sink, schema)
+    try:
+        for rows in batches:
+            columns = list(zip(*rows)) if rows else [[] for _ in fields]
+            # Each batch becomes a Parquet row group or an Arrow record batch, then leaves memory
+            writer.write_batch(pyarrow.record_batch([pyarrow.array(column, type=field.type)
+                                                     for column, field in zip(columns, schema)], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def _gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_chunks(fields: Sequence[str], batches: Iterable[List[Sequence[Any]]], fmt: str,
+                  compression: str = None) -> Iterator[bytes]:
+    """
+    Encode batches of analysis rows as a streamed export file
+
+    Only one batch of rows and its encoded bytes are held at a time, so memory
+    does not grow with the number of rows exported.
+
+    Args:
+        fields: Names of the exported Analysis columns
+        batches: Lists of row tuples holding the values of those columns
+        fmt: Name from EXPORT_FORMATS; 'arrow' and 'parquet' need pyarrow
+        compression: Name from EXPORT_COMPRESSIONS, or None
+
+    Yields:
+        Consecutive chunks of the file
+    """
+    if fmt == 'csv':
+        chunks = _csv_chunks(fields, batches)
+    elif fmt == 'ndjson':
+        chunks = _ndjson_chunks(fields, batches)
+    else:
+        chunks = _arrow_chunks(fields, batches, fmt)
+    if compression == 'gzip':
+        chunks = _gzip_chunks(chunks)
+    for chunk in chunks:
+        if chunk:
+            yield chunk
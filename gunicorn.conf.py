@@ -0,0 +1,62 @@
+"""
+Gunicorn settings for running ThreadCounty in production
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is imported once in the master and forked into the workers. Each
+worker analyzes images on its own share of the cores, so OpenCV's thread pool
+and the background analysis pool are sized to that share rather than to every
+core. Every setting can be overridden with the environment variables below.
+"""
+import os
+import multiprocessing
+
+cpu_count = multiprocessing.cpu_count()
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+workers = int(os.environ.get('WEB_CONCURRENCY', cpu_count))
+worker_class = 'gthread'
+threads = int(os.environ.get('WORKER_THREADS', 2))
+
+# Analyses of large images can legitimately take a while
+timeout = int(os.environ.get('WORKER_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so memory fragmented by OpenCV and NumPy is returned
+max_requests = int(os.environ.get('MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+preload_app = True
+
+# Logs go to stderr: the app's as JSON lines, gunicorn's own at the same level
+loglevel = os.environ.get('LOG_LEVEL', 'info').lower()
+errorlog = '-'
+accesslog = os.environ.get('ACCESS_LOG')
+
+# Cores each worker may use for OpenCV and for its background analysis pool
+cores_per_worker = max(1, cpu_count // workers)
+
+# Read by app.py when it is imported, which happens after this file is loaded
+os.environ.setdefault('LOG_FORMAT', 'json')
+os.environ.setdefault('ANALYSIS_WORKERS', str(cores_per_worker))
+
+def on_starting(server):
+    """Create or upgrade the schema once, before any worker exists"""
+    from app import init_db
+    init_db()
+
+def post_fork(server, worker):
+    """Size OpenCV to this worker's share of the cores and warm it up"""
+    from wsgi import warm_up
+    warm_up(cores_per_worker)
+
+def post_worker_init(worker):
+    """
+    Start claiming analysis jobs in every worker
+
+    Jobs queued by any worker, or left behind by one that was recycled or
+    killed, are picked up by whichever worker has a free slot.
+    """
+    from app import job_queue
+    job_queue.start()
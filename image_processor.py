@@ -2,115 +2,816 @@ import cv2
 import numpy as np
 import os
 import logging
-from typing import Tuple, Dict, Any, Optional
+from typing import Tuple, Dict, Any, List, Optional, Union
 import base64
+from functools import lru_cache
+
+from utils import calculate_confidence
+from metrics import stage_timer
+from tiled_image import TiledImage, BLOCK_SIZE, OUT_OF_CORE_PIXELS, open_tiled_image
+from regions import Regions, resolve_regions
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Bump whenever the visualization output changes so stored artifacts are re-rendered
+VISUALIZATION_VERSION = 2
+
+# Longest side in pixels of the stored visualization; larger images are downscaled before drawing
+VISUALIZATION_SIZE = 1600
+
+# Overlay styles: 'uniform' rules the counted threads evenly across the image, 'tiles' rules
+# each analysis tile at the thread pitch detected in it (tiled engine only, else uniform)
+OVERLAY_STYLES = ('uniform', 'tiles')
+
+# Grid colours (BGR)
+WARP_COLOR = (0, 255, 0)
+WEFT_COLOR = (0, 0, 255)
+
+# Analysis engines: 'tiled' runs a batched FFT over a grid of tiles covering the whole image,
+# 'spectral' a batched 2D FFT over the same grid that also finds how far the threads are skewed,
+# 'strip' is the original single central strip per axis
+ENGINES = ('tiled', 'spectral', 'strip')
+
+# Smallest tile side (in pixels) the tiled engine will analyze
+MIN_TILE_SIZE = 32
+
+# The spectral engine transforms a centred square window of each tile, at most this many pixels a side
+SPECTRAL_WINDOW = 256
+
+# Largest skew, in degrees from vertical/horizontal, the spectral engine looks for threads at
+MAX_SKEW_ANGLE = 30.0
+
+# Fraction of the image width/height covered by the central strips; counts are reported
+# over this window so both engines produce comparable numbers
+STRIP_FRACTION = 0.2
+
+# Central regions (row range, column range) as fractions of the image size
+# Warp threads run vertically, weft threads horizontally
+WARP_ROI = ((0.25, 0.75), (0.4, 0.6))
+WEFT_ROI = ((0.4, 0.6), (0.25, 0.75))
+
+# Processing modes: 'full' preprocesses the whole frame, 'roi' crops the warp/weft regions
+# before any filtering, 'pyramid' works on a pyrDown level chosen from the thread pitch
+MODES = ('full', 'roi', 'pyramid')
+
+# Pyramid mode keeps at least this many pixels per thread at the chosen level
+MIN_PYRAMID_PITCH = 6.0
+MAX_PYRAMID_LEVELS = 4
+
+def region_slices(shape: Tuple[int, ...], roi: Tuple[Tuple[float, float], Tuple[float, float]]) -> Tuple[slice, slice]:
+    """Convert a fractional region of interest into row/column slices for an image of the given shape"""
+    height, width = shape[:2]
+    (top, bottom), (left, right) = roi
+    return (slice(int(height * top), int(height * bottom)),
+            slice(int(width * left), int(width * right)))
+
+@lru_cache(maxsize=8)
+def spectral_search_masks(size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Where in an rfft2 spectrum of a size x size window to look for the warp and weft peaks
+    
+    Warp threads (vertical) put their peak near the horizontal frequency axis and weft
+    threads near the vertical one; each is searched within MAX_SKEW_ANGLE of its axis.
+    The lowest frequencies, which hold uneven lighting rather than threads, are left out.
+    
+    Returns:
+        Boolean (warp, weft) masks shaped like the spectrum: (size, size // 2 + 1)
+    """
+    fy = np.fft.fftfreq(size)[:, np.newaxis] * size
+    fx = np.fft.rfftfreq(size)[np.newaxis, :] * size
+    slope = np.tan(np.radians(MAX_SKEW_ANGLE))
+    outside_dc = np.hypot(fx, fy) >= 2
+    warp = outside_dc & (np.abs(fy) <= slope * fx)
+    weft = outside_dc & (fx <= slope * np.abs(fy))
+    return warp, weft
+
+def parabolic_offset(left: np.ndarray, center: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Offset in bins, within +-0.5, of the vertex of the parabola through a peak and its neighbours"""
+    curvature = left - 2 * center + right
+    offset = np.divide(0.5 * (left - right), curvature,
+                       out=np.zeros_like(curvature), where=curvature != 0)
+    return np.clip(offset, -0.5, 0.5)
+
+# Pixels of context threshold_threads needs around a block for its output to match the
+# whole-image result: the 5x5 blur reaches 2 pixels, the 11x11 adaptive threshold 5 more
+THRESHOLD_HALO = 8
+
+def threshold_threads(gray: np.ndarray) -> np.ndarray:
+    """
+    Highlight threads in a grayscale image
+    
+    Args:
+        gray: Grayscale image; it is blurred in place to avoid an extra buffer
+        
+    Returns:
+        Binary image with threads as foreground
+    """
+    # Apply Gaussian blur to reduce noise
+    with stage_timer('blur'):
+        cv2.GaussianBlur(gray, (5, 5), 0, dst=gray)
+    
+    # Apply adaptive threshold to highlight threads
+    with stage_timer('threshold'):
+        return cv2.adaptiveThreshold(
+            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+            cv2.THRESH_BINARY_INV, 11, 2
+        )
+
+def downscale_preview(image: np.ndarray, max_side: int) -> np.ndarray:
+    """
+    Downscale an image so its longest side is at most max_side, never upscaling
+    
+    Halves with INTER_AREA (which has a fast path for exact halving) until within
+    a factor of two, then finishes with INTER_LINEAR; a single INTER_AREA resize
+    by an arbitrary factor is several times slower on large images.
+    """
+    height, width = image.shape[:2]
+    while max(height, width) >= 2 * max_side:
+        height, width = height // 2, width // 2
+        image = cv2.resize(image[:height * 2, :width * 2], (width, height), interpolation=cv2.INTER_AREA)
+    
+    scale = max_side / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(1, int(round(width * scale))), max(1, int(round(height * scale)))),
+                           interpolation=cv2.INTER_LINEAR)
+    return image
+
+class ImagePipeline:
+    """
+    A fabric image decoded once and shared by every processing stage
+    
+    Preprocessing, frequency analysis and visualization all read from the same
+    decoded array, so an analysis costs a single decode no matter how many stages
+    touch the pixels.
+    """
+    
+    def __init__(self, image: np.ndarray, source: str = '<memory>'):
+        """
+        Wrap an already decoded BGR image
+        
+        Args:
+            image: Decoded image as returned by cv2.imread/cv2.imdecode
+            source: Path or name of the image, used in log and error messages
+        """
+        self.image = image
+        self.source = source
+        self._preprocessed = None
+    
+    @classmethod
+    def from_path(cls, image_path: str) -> 'ImagePipeline':
+        """Decode an image file"""
+        img = cv2.imread(image_path)
+        if img is None:
+            if not os.path.exists(image_path):
+                raise FileNotFoundError(f"Image file not found: {image_path}")
+            raise ValueError(f"Could not read image: {image_path}")
+        return cls(img, image_path)
+    
+    @classmethod
+    def from_bytes(cls, data: bytes, source: str = '<memory>') -> 'ImagePipeline':
+        """Decode an encoded image straight from memory, e.g. an upload that was never written to disk"""
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Could not read image: {source}")
+        return cls(img, source)
+    
+    @classmethod
+    def from_storage(cls, storage, name: str) -> 'ImagePipeline':
+        """Decode a file held by an upload storage backend (see storage.py), local or remote"""
+        try:
+            data = storage.read(name)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Image file not found: {name}")
+        return cls.from_bytes(data, name)
+    
+    @classmethod
+    def load(cls, image: Union[str, 'ImagePipeline'], storage=None) -> 'ImagePipeline':
+        """Return the pipeline for a path (a stored name when a storage is given) or an existing pipeline"""
+        if isinstance(image, ImagePipeline):
+            return image
+        if storage is not None:
+            return cls.from_storage(storage, image)
+        return cls.from_path(image)
+    
+    @property
+    def preprocessed(self) -> np.ndarray:
+        """Thresholded image used by the frequency analysis, computed on first access"""
+        if self._preprocessed is None:
+            with stage_timer('grayscale'):
+                gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+            self._preprocessed = threshold_threads(gray)
+        return self._preprocessed
+    
+    def release(self) -> None:
+        """Drop the decoded and preprocessed pixels once no stage needs them any more"""
+        self.image = None
+        self._preprocessed = None
+
 class ThreadCounter:
     """Class to handle image processing for thread counting in fabric images"""
     
-    def __init__(self, unit: str = 'cm', reference_length: float = 1.0):
+    def __init__(self, unit: str = 'cm', reference_length: float = 1.0,
+                 engine: str = 'tiled', grid_size: int = 4, mode: str = 'full', overlay: str = 'uniform',
+                 storage=None, out_of_core_pixels: int = OUT_OF_CORE_PIXELS, deskew: bool = False):
         """
         Initialize the thread counter
         
         Args:
             unit: The unit of measurement ('cm' or 'inch')
             reference_length: The reference length in the unit specified
+            engine: Analysis engine to use ('tiled', 'spectral' or 'strip')
+            grid_size: Number of tiles per side for the tiled and spectral engines
+            mode: Processing mode ('full', 'roi' or 'pyramid')
+            overlay: Visualization grid style ('uniform' or 'tiles')
+            storage: Upload storage backend; when given, images passed by name are read from it
+                instead of from the local filesystem
+            out_of_core_pixels: TIFFs passed by name with at least this many pixels are
+                analyzed block by block (full mode, tiled engine) instead of decoded whole
+            deskew: Rotate the visualization by the skew the spectral engine detects, so its
+                grid lines up with the threads
         """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown analysis engine: {engine}")
+        if mode not in MODES:
+            raise ValueError(f"Unknown processing mode: {mode}")
+        if overlay not in OVERLAY_STYLES:
+            raise ValueError(f"Unknown overlay style: {overlay}")
+        
         self.unit = unit
         self.reference_length = reference_length
-        logger.info(f"ThreadCounter initialized with unit {unit} and reference length {reference_length}")
+        self.engine = engine
+        self.grid_size = grid_size
+        self.mode = mode
+        self.overlay = overlay
+        self.storage = storage
+        self.out_of_core_pixels = out_of_core_pixels
+        self.deskew = deskew
+        logger.debug("ThreadCounter initialized with unit %s and reference length %s", unit, reference_length)
     
-    def preprocess_image(self, image_path: str) -> np.ndarray:
+    @property
+    def out_of_core(self) -> bool:
+        """Whether large TIFFs can be analyzed block by block with this mode and engine"""
+        return self.mode == 'full' and self.engine == 'tiled'
+    
+    def preprocess_image(self, image: Union[str, ImagePipeline]) -> np.ndarray:
         """
         Preprocess the image for analysis
         
         Args:
-            image_path: Path to the image file
+            image: Path or stored name of the image file, or an already decoded ImagePipeline
             
         Returns:
             Preprocessed image as numpy array
         """
-        logger.debug(f"Preprocessing image: {image_path}")
+        pipeline = ImagePipeline.load(image, self.storage)
+        logger.debug("Preprocessing image: %s", pipeline.source)
         
-        # Check if image exists
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image file not found: {image_path}")
+        preprocessed = pipeline.preprocessed
         
-        # Read the image
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError(f"Could not read image: {image_path}")
+        logger.debug("Image preprocessing completed")
         
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return preprocessed
+    
+    def count_threads(self, image: Union[str, ImagePipeline, TiledImage],
+                      regions: Optional[Regions] = None) -> Dict[str, Any]:
+        """
+        Count the threads in a fabric image
         
-        # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        The image is decoded once and shared by preprocessing, analysis and
+        visualization. The visualization is drawn directly onto the decoded
+        pixels, after which the pipeline's arrays are released. Large TIFFs are
+        not decoded at all but analyzed out of core, see _streamed_tiled_analysis.
         
-        # Apply adaptive threshold to highlight threads
-        thresh = cv2.adaptiveThreshold(
-            blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY_INV, 11, 2
-        )
+        Args:
+            image: Path or stored name of the image file, an already decoded ImagePipeline,
+                or a TiledImage to analyze out of core
+            regions: Optional regions of interest to count separately, or 'auto' to
+                find the swatches in the image (see regions.py)
+            
+        Returns:
+            Dictionary with thread counting results; 'visualization' holds the
+            JPEG encoded overlay as bytes, which callers store rather than return
+        """
+        if isinstance(image, str) and self.out_of_core and not regions:
+            tiled = open_tiled_image(image, self.storage, self.out_of_core_pixels)
+            if tiled is not None:
+                try:
+                    return self.count_threads(tiled)
+                finally:
+                    tiled.close()
+        
+        pipeline = image if isinstance(image, TiledImage) else ImagePipeline.load(image, self.storage)
+        result = self.measure(pipeline, regions)
+        warp_count = result['warp_count']
+        weft_count = result['weft_count']
         
-        logger.debug("Image preprocessing completed")
+        # Create visualization of detected threads
+        tile_counts = None
+        if self.overlay == 'tiles' and 'tile_grid' in result:
+            tile_counts = (result['tile_grid'], result['warp_tile_counts'], result['weft_tile_counts'])
+        skew_angle = result.get('skew_angle') if self.deskew else None
+        visualization = self.render_visualization(pipeline, warp_count, weft_count, tile_counts, skew_angle,
+                                                   result.get('regions'))
+        if isinstance(pipeline, ImagePipeline):
+            pipeline.release()
+        result['visualization'] = visualization
+        
+        logger.info("Thread counting completed. Warp: %s, Weft: %s", warp_count, weft_count)
         
-        return thresh
+        return result
     
-    def count_threads(self, image_path: str) -> Dict[str, Any]:
+    def measure(self, pipeline: Union[ImagePipeline, TiledImage],
+                regions: Optional[Regions] = None) -> Dict[str, Any]:
         """
-        Count the threads in a fabric image
+        Count the threads in an image without rendering its visualization
+        
+        Live sessions (see live.py) measure every incoming frame this way and
+        only render the frame that is finally kept.
         
         Args:
-            image_path: Path to the image file
+            pipeline: A decoded ImagePipeline, or a TiledImage to analyze out of core
+            regions: Optional regions of interest to count separately, or 'auto'
             
         Returns:
-            Dictionary with thread counting results
+            Dictionary with thread counting results, without 'visualization'
         """
-        logger.info(f"Starting thread counting for image: {image_path}")
+        if regions:
+            if isinstance(pipeline, TiledImage):
+                raise ValueError("Regions of interest can only be analyzed in images decoded whole")
+            logger.debug("Starting region thread counting for image: %s", pipeline.source)
+            result = self._analyze_regions(pipeline, regions)
+        elif isinstance(pipeline, TiledImage):
+            logger.debug("Starting out-of-core thread counting for image: %s", pipeline.source)
+            result = self._streamed_tiled_analysis(pipeline)
+        else:
+            logger.debug("Starting thread counting for image: %s", pipeline.source)
+            result = self._analyze_pipeline(pipeline)
         
-        # Preprocess the image
-        preprocessed = self.preprocess_image(image_path)
+        # Calculate thread density
+        total_count = result['warp_count'] + result['weft_count']
         
-        # Get image dimensions
-        height, width = preprocessed.shape
+        result.update({
+            'thread_density': total_count / self.reference_length,
+            'measurement_unit': self.unit,
+            'engine': self.engine,
+            'mode': self.mode
+        })
         
-        # Define regions for warp and weft analysis
-        # Warp threads run vertically
-        warp_region = preprocessed[int(height * 0.25):int(height * 0.75), int(width * 0.4):int(width * 0.6)]
+        return result
+    
+    def _analyze_pipeline(self, pipeline: ImagePipeline) -> Dict[str, Any]:
+        """Count threads in a decoded image with the configured mode and engine"""
+        if self.mode == 'roi':
+            # Only the central warp/weft regions are ever filtered
+            return self._roi_frequency_analysis(pipeline)
+        
+        if self.mode == 'pyramid':
+            preprocessed, level = self._pyramid_preprocess(pipeline)
+        else:
+            # Preprocess the image
+            preprocessed, level = self.preprocess_image(pipeline), 0
+        
+        with stage_timer('fft'):
+            result = self._engine_analysis(preprocessed)
+        result['pyramid_level'] = level
+        return result
+    
+    def _engine_analysis(self, preprocessed: np.ndarray) -> Dict[str, Any]:
+        """Count threads in a preprocessed image, or part of one, with the configured engine"""
+        if self.engine == 'tiled':
+            return self._tiled_frequency_analysis(preprocessed)
+        if self.engine == 'spectral':
+            return self._spectral_frequency_analysis(preprocessed)
+        return self._strip_frequency_analysis(preprocessed)
+    
+    def _analyze_regions(self, pipeline: ImagePipeline, regions: Regions) -> Dict[str, Any]:
+        """
+        Count threads separately in each region of interest of a decoded image
+        
+        The image is preprocessed once, in full (or at its pyramid level in
+        pyramid mode), and every region is analyzed on its crop of the shared
+        binary image, so N swatches cost one decode and one threshold. Each
+        region is counted as if it had been cropped and uploaded on its own; the
+        central warp/weft bands of the roi mode are a single-swatch shortcut and
+        are not used here.
+        
+        Args:
+            pipeline: Decoded image
+            regions: Regions from regions.parse_regions, or 'auto' to detect the swatches
+            
+        Returns:
+            Dictionary with the per-region results under 'regions', and the median
+            counts and lowest confidence of the regions as the overall result
+        """
+        with stage_timer('regions'):
+            boxes = resolve_regions(regions, pipeline.image)
+        
+        if self.mode == 'pyramid':
+            preprocessed, level = self._pyramid_preprocess(pipeline)
+        else:
+            preprocessed, level = self.preprocess_image(pipeline), 0
+        scale = preprocessed.shape[0] / pipeline.image.shape[0]
+        
+        region_results = []
+        with stage_timer('fft'):
+            for box in boxes:
+                top, left = int(box['y'] * scale), int(box['x'] * scale)
+                bottom, right = int((box['y'] + box['height']) * scale), int((box['x'] + box['width']) * scale)
+                counts = self._engine_analysis(preprocessed[top:bottom, left:right])
+                region_results.append(dict(
+                    box,
+                    warp_count=counts['warp_count'],
+                    weft_count=counts['weft_count'],
+                    thread_density=(counts['warp_count'] + counts['weft_count']) / self.reference_length,
+                    confidence_score=float(counts['confidence_score']),
+                    skew_angle=counts.get('skew_angle')
+                ))
+        
+        skew_angles = [region['skew_angle'] for region in region_results if region['skew_angle'] is not None]
+        return {
+            'warp_count': int(round(float(np.median([region['warp_count'] for region in region_results])))),
+            'weft_count': int(round(float(np.median([region['weft_count'] for region in region_results])))),
+            'confidence_score': min(region['confidence_score'] for region in region_results),
+            'skew_angle': round(float(np.median(skew_angles)), 2) if skew_angles else None,
+            'regions': region_results,
+            'pyramid_level': level
+        }
+    
+    def _streamed_tiled_analysis(self, image: TiledImage) -> Dict[str, Any]:
+        """
+        Out-of-core version of preprocessing plus _tiled_frequency_analysis
+        
+        The image is read in BLOCK_SIZE blocks with THRESHOLD_HALO pixels of context,
+        so each block thresholds exactly as it would within the whole image. The
+        halo is then cropped and the block's column and row sums are added into
+        the profiles of the analysis tiles it overlaps. Only the profiles outlive a
+        block, so peak memory depends on the block size, not on the image, and the
+        counts equal those of the in-memory path.
+        
+        Args:
+            image: TIFF opened for region reads
+            
+        Returns:
+            Dictionary with warp/weft counts, per-tile counts and confidence score
+        """
+        if not self.out_of_core:
+            raise ValueError("Out-of-core analysis requires the full mode and the tiled engine")
+        
+        height, width = image.shape
+        rows, cols, tile_height, tile_width = self._tile_layout(height, width)
+        used_height, used_width = rows * tile_height, cols * tile_width
+        
+        # Exact integer sums; the in-memory path's float32 sums of 0/255 values are exact too
+        warp_profiles = np.zeros((rows * cols, tile_width), np.float64)
+        weft_profiles = np.zeros((rows * cols, tile_height), np.float64)
+        
+        with stage_timer('streamed_preprocess'):
+            for top, bottom, left, right, gray, pad_top, pad_left in image.blocks(BLOCK_SIZE, THRESHOLD_HALO,
+                                                                                   VISUALIZATION_SIZE):
+                binary = threshold_threads(gray)
+                # Pixels past the last whole tile are not analyzed, as in _tiled_frequency_analysis
+                bottom, right = min(bottom, used_height), min(right, used_width)
+                if bottom <= top or right <= left:
+                    continue
+                
+                # Add the block's part of every analysis tile it overlaps
+                for row in range(top // tile_height, (bottom - 1) // tile_height + 1):
+                    y0, y1 = max(top, row * tile_height), min(bottom, (row + 1) * tile_height)
+                    for col in range(left // tile_width, (right - 1) // tile_width + 1):
+                        x0, x1 = max(left, col * tile_width), min(right, (col + 1) * tile_width)
+                        part = binary[y0 - top + pad_top:y1 - top + pad_top, x0 - left + pad_left:x1 - left + pad_left]
+                        tile = row * cols + col
+                        warp_profiles[tile, x0 - col * tile_width:x1 - col * tile_width] += part.sum(axis=0)
+                        weft_profiles[tile, y0 - row * tile_height:y1 - row * tile_height] += part.sum(axis=1)
+        
+        with stage_timer('fft'):
+            result = self._tile_profile_counts(warp_profiles.astype(np.float32), weft_profiles.astype(np.float32),
+                                               height, width)
+        result['tile_grid'] = [rows, cols]
+        result['pyramid_level'] = 0
+        return result
+    
+    def _strip_frequency_analysis(self, preprocessed: np.ndarray) -> Dict[str, Any]:
+        """
+        Count threads from a single central strip per axis
         
-        # Weft threads run horizontally
-        weft_region = preprocessed[int(height * 0.4):int(height * 0.6), int(width * 0.25):int(width * 0.75)]
+        Args:
+            preprocessed: Preprocessed (thresholded) image
+            
+        Returns:
+            Dictionary with warp/weft counts and confidence score
+        """
+        # Define regions for warp and weft analysis
+        warp_region = preprocessed[region_slices(preprocessed.shape, WARP_ROI)]
+        weft_region = preprocessed[region_slices(preprocessed.shape, WEFT_ROI)]
         
         # Count threads using frequency domain analysis
         warp_count = self._frequency_domain_analysis(warp_region, vertical=True)
         weft_count = self._frequency_domain_analysis(weft_region, vertical=False)
         
-        # Calculate thread density
-        total_count = warp_count + weft_count
-        
-        # For demo purposes, let's calculate a confidence score (this would be refined in production)
+        # A single strip per axis gives no spread to measure, so this engine keeps its placeholder score
         confidence_score = min(0.95, max(0.5, 0.75 + np.random.normal(0, 0.1)))
         
-        # Create visualization of detected threads
-        visual_result = self._create_visual_result(image_path, warp_count, weft_count)
+        return {
+            'warp_count': warp_count,
+            'weft_count': weft_count,
+            'confidence_score': confidence_score
+        }
+    
+    def _roi_frequency_analysis(self, pipeline: ImagePipeline) -> Dict[str, Any]:
+        """
+        Count threads from the central warp/weft regions, cropped before any filtering
+        
+        Only the two regions are converted to grayscale, blurred and thresholded.
+        Each region is cut into bands along the threads, and the band profiles are
+        analyzed with one batched FFT per axis like the tiled engine.
         
-        result = {
+        Args:
+            pipeline: Decoded image
+            
+        Returns:
+            Dictionary with warp/weft counts, per-band counts and confidence score
+        """
+        image = pipeline.image
+        height, width = image.shape[:2]
+        
+        with stage_timer('grayscale'):
+            warp_gray = cv2.cvtColor(image[region_slices(image.shape, WARP_ROI)], cv2.COLOR_BGR2GRAY)
+            weft_gray = cv2.cvtColor(image[region_slices(image.shape, WEFT_ROI)], cv2.COLOR_BGR2GRAY)
+        warp_region = threshold_threads(warp_gray)
+        weft_region = threshold_threads(weft_gray)
+        
+        # Warp profiles run across the region's columns, so band it by rows; weft the other way round
+        with stage_timer('fft'):
+            warp_bands = np.array_split(warp_region, self.grid_size, axis=0)
+            weft_bands = np.array_split(weft_region, self.grid_size, axis=1)
+            warp_freqs = self._batched_peak_frequency(np.stack([band.sum(axis=0, dtype=np.float32) for band in warp_bands]))
+            weft_freqs = self._batched_peak_frequency(np.stack([band.sum(axis=1, dtype=np.float32) for band in weft_bands]))
+        
+        return self.summarize_tile_counts(
+            warp_freqs * width * STRIP_FRACTION * self.reference_length,
+            weft_freqs * height * STRIP_FRACTION * self.reference_length
+        )
+    
+    def _pyramid_preprocess(self, pipeline: ImagePipeline) -> Tuple[np.ndarray, int]:
+        """
+        Preprocess a downscaled pyramid level chosen from the estimated thread pitch
+        
+        Counts are measured over a fixed fraction of the image, so they carry over
+        from the reduced level to full resolution without further scaling.
+        
+        Args:
+            pipeline: Decoded image
+            
+        Returns:
+            Tuple of the preprocessed pyramid level and its level number (0 = full resolution)
+        """
+        with stage_timer('grayscale'):
+            gray = cv2.cvtColor(pipeline.image, cv2.COLOR_BGR2GRAY)
+        
+        # Keep at least MIN_PYRAMID_PITCH pixels per thread along the finer axis
+        with stage_timer('pyramid'):
+            pitch = self._estimate_pitch(gray)
+            level = int(np.floor(np.log2(max(pitch / MIN_PYRAMID_PITCH, 1.0))))
+            level = min(level, MAX_PYRAMID_LEVELS)
+            
+            for _ in range(level):
+                if min(gray.shape) < 4 * MIN_TILE_SIZE:
+                    break
+                gray = cv2.pyrDown(gray)
+        level = int(round(np.log2(pipeline.image.shape[0] / gray.shape[0])))
+        
+        logger.debug("Pyramid level %s for estimated pitch %.1fpx", level, pitch)
+        
+        return threshold_threads(gray), level
+    
+    def _estimate_pitch(self, gray: np.ndarray) -> float:
+        """Rough thread pitch in pixels from the central profile of each axis"""
+        rows, cols = region_slices(gray.shape, ((0.4, 0.6), (0.4, 0.6)))
+        profiles = [gray[rows, :].sum(axis=0, dtype=np.float32), gray[:, cols].sum(axis=1, dtype=np.float32)]
+        freqs = [self._batched_peak_frequency(profile[np.newaxis, :])[0] for profile in profiles]
+        return 1.0 / max(max(freqs), 1e-6)
+    
+    def _tiled_frequency_analysis(self, preprocessed: np.ndarray) -> Dict[str, Any]:
+        """
+        Count threads over a grid of tiles covering the whole image
+        
+        The warp and weft profiles of every tile are stacked and transformed with a
+        single batched rfft per axis, and each spectral peak is refined to sub-bin
+        precision. The reported counts are the per-tile medians and the confidence
+        score reflects how much the tiles disagree.
+        
+        Args:
+            preprocessed: Preprocessed (thresholded) image
+            
+        Returns:
+            Dictionary with warp/weft counts, per-tile counts and confidence score
+        """
+        height, width = preprocessed.shape
+        rows, cols, tile_height, tile_width = self._tile_layout(height, width)
+        
+        # View the image as a stack of tiles: (rows * cols, tile_height, tile_width)
+        tiles = preprocessed[:rows * tile_height, :cols * tile_width] \
+            .reshape(rows, tile_height, cols, tile_width) \
+            .swapaxes(1, 2) \
+            .reshape(rows * cols, tile_height, tile_width)
+        
+        # Warp threads run vertically and show up in the column sums, weft threads in the row sums
+        result = self._tile_profile_counts(tiles.sum(axis=1, dtype=np.float32), tiles.sum(axis=2, dtype=np.float32),
+                                           height, width)
+        result['tile_grid'] = [rows, cols]
+        
+        return result
+    
+    def _tile_layout(self, height: int, width: int) -> Tuple[int, int, int, int]:
+        """
+        Grid of analysis tiles for an image: as many as fit at the minimum tile size, up to grid_size per side
+        
+        Returns:
+            Tuple of (rows, cols, tile_height, tile_width)
+        """
+        rows = max(1, min(self.grid_size, height // MIN_TILE_SIZE))
+        cols = max(1, min(self.grid_size, width // MIN_TILE_SIZE))
+        return rows, cols, height // rows, width // cols
+    
+    def _tile_profile_counts(self, warp_profiles: np.ndarray, weft_profiles: np.ndarray,
+                             height: int, width: int) -> Dict[str, Any]:
+        """
+        Counts from the column (warp) and row (weft) sum profiles of every tile
+        
+        Args:
+            warp_profiles: One column-sum profile per tile
+            weft_profiles: One row-sum profile per tile
+            height: Height of the whole image
+            width: Width of the whole image
+            
+        Returns:
+            Dictionary with warp/weft counts, per-tile counts and confidence score
+        """
+        warp_freqs = self._batched_peak_frequency(warp_profiles)
+        weft_freqs = self._batched_peak_frequency(weft_profiles)
+        
+        # Report counts over the same window as the strip engine
+        return self.summarize_tile_counts(
+            warp_freqs * width * STRIP_FRACTION * self.reference_length,
+            weft_freqs * height * STRIP_FRACTION * self.reference_length
+        )
+    
+    def _spectral_frequency_analysis(self, preprocessed: np.ndarray) -> Dict[str, Any]:
+        """
+        Count threads and measure their skew with a 2D FFT of every tile
+        
+        Summing a tile along an axis smears the spectral peak of threads that are
+        a few degrees off that axis. Here a centred, Hann-windowed square of each
+        tile goes through one batched rfft2 instead, and the warp and weft peaks are
+        found as 2D frequency vectors within MAX_SKEW_ANGLE of their axes. A
+        vector's length is the thread frequency across the threads whatever their
+        orientation, and its direction is the orientation. Counts are reported over
+        the same window as the other engines, as if the fabric had been straightened.
+        
+        Args:
+            preprocessed: Preprocessed (thresholded) image
+            
+        Returns:
+            Dictionary with warp/weft counts, per-tile counts, confidence score and the
+            median warp, weft and overall skew in degrees (counterclockwise positive)
+        """
+        height, width = preprocessed.shape
+        rows, cols, tile_height, tile_width = self._tile_layout(height, width)
+        
+        # A power of two about half the tile side, up to SPECTRAL_WINDOW: the FFT costs far more per
+        # pixel than the axis sums of the tiled engine, and a few dozen threads pin the peak down
+        size = 1 << int(np.log2(min(tile_height, tile_width)))
+        size = min(SPECTRAL_WINDOW, max(MIN_TILE_SIZE, size // 2))
+        top, left = (tile_height - size) // 2, (tile_width - size) // 2
+        
+        # Stack the windows: (rows * cols, size, size)
+        windows = preprocessed[:rows * tile_height, :cols * tile_width] \
+            .reshape(rows, tile_height, cols, tile_width)[:, top:top + size, :, left:left + size] \
+            .swapaxes(1, 2) \
+            .reshape(rows * cols, size, size) \
+            .astype(np.float64)
+        
+        # Remove the DC offset and taper the edges to limit spectral leakage. NumPy's
+        # rfft2 runs faster in double than in single precision, so the windows stay double
+        windows -= windows.mean(axis=(1, 2), keepdims=True)
+        taper = np.hanning(size)
+        windows *= np.outer(taper, taper)
+        
+        amplitudes = np.abs(np.fft.rfft2(windows))
+        warp_mask, weft_mask = spectral_search_masks(size)
+        warp_fx, warp_fy = self._batched_spectral_peak(amplitudes, warp_mask)
+        weft_fx, weft_fy = self._batched_spectral_peak(amplitudes, weft_mask)
+        
+        # A frequency vector and its negation are the same wave; point weft vectors downwards
+        flip = np.where(weft_fy < 0, -1.0, 1.0)
+        weft_fx, weft_fy = weft_fx * flip, weft_fy * flip
+        
+        # Image rows grow downwards, so a counterclockwise turn has the warp vector point up
+        warp_angles = np.degrees(np.arctan2(-warp_fy, warp_fx))
+        weft_angles = np.degrees(np.arctan2(weft_fx, weft_fy))
+        
+        result = self.summarize_tile_counts(
+            np.hypot(warp_fx, warp_fy) * width * STRIP_FRACTION * self.reference_length,
+            np.hypot(weft_fx, weft_fy) * height * STRIP_FRACTION * self.reference_length
+        )
+        warp_angle, weft_angle = float(np.median(warp_angles)), float(np.median(weft_angles))
+        result.update({
+            'tile_grid': [rows, cols],
+            'warp_angle': round(warp_angle, 2),
+            'weft_angle': round(weft_angle, 2),
+            'skew_angle': round((warp_angle + weft_angle) / 2, 2)
+        })
+        
+        return result
+    
+    @staticmethod
+    def _batched_spectral_peak(amplitudes: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the strongest frequency vector within a mask in many rfft2 spectra at once
+        
+        Args:
+            amplitudes: Amplitude spectra of square windows, (count, size, size // 2 + 1)
+            mask: Where to search, shaped like a single spectrum
+            
+        Returns:
+            Horizontal and vertical frequency of each peak in cycles per pixel, each
+            refined by parabolic interpolation between neighbouring bins
+        """
+        count, size = amplitudes.shape[:2]
+        last = amplitudes.shape[2] - 1
+        
+        peak = np.argmax((amplitudes * mask).reshape(count, -1), axis=1)
+        iy, ix = np.unravel_index(peak, mask.shape)
+        tiles = np.arange(count)
+        center = amplitudes[tiles, iy, ix]
+        
+        # Vertical neighbours wrap around; the column left of fx = 0 mirrors column 1 of the negated row
+        above = amplitudes[tiles, (iy - 1) % size, ix]
+        below = amplitudes[tiles, (iy + 1) % size, ix]
+        left = np.where(ix > 0, amplitudes[tiles, iy, np.maximum(ix - 1, 0)], amplitudes[tiles, -iy % size, 1])
+        right = amplitudes[tiles, iy, np.minimum(ix + 1, last)]
+        
+        fx = ix + np.where(ix < last, parabolic_offset(left, center, right), 0)
+        fy = np.where(iy > size // 2, iy - size, iy) + parabolic_offset(above, center, below)
+        return fx / size, fy / size
+    
+    def summarize_tile_counts(self, warp_tile_counts: np.ndarray, weft_tile_counts: np.ndarray) -> Dict[str, Any]:
+        """
+        Combine per-tile counts into the reported counts and confidence score
+        
+        Args:
+            warp_tile_counts: Warp count measured in each tile
+            weft_tile_counts: Weft count measured in each tile
+            
+        Returns:
+            Dictionary with median counts, per-tile counts and confidence score
+        """
+        # Ensure minimum sensible thread count
+        warp_count = max(10, int(round(float(np.median(warp_tile_counts)))))
+        weft_count = max(10, int(round(float(np.median(weft_tile_counts)))))
+        
+        confidence_score = calculate_confidence(
+            warp_count, weft_count,
+            float(np.std(warp_tile_counts)), float(np.std(weft_tile_counts))
+        )
+        
+        return {
             'warp_count': warp_count,
             'weft_count': weft_count,
-            'thread_density': total_count / self.reference_length,
             'confidence_score': confidence_score,
-            'measurement_unit': self.unit,
-            'visual_result': visual_result
+            'warp_tile_counts': warp_tile_counts.round(2).tolist(),
+            'weft_tile_counts': weft_tile_counts.round(2).tolist()
         }
+    
+    @staticmethod
+    def _batched_peak_frequency(profiles: np.ndarray) -> np.ndarray:
+        """
+        Find the dominant frequency of many profiles at once
         
-        logger.info(f"Thread counting completed. Warp: {warp_count}, Weft: {weft_count}")
+        Args:
+            profiles: 2D array with one intensity profile per row
+            
+        Returns:
+            Peak frequency of each profile in cycles per pixel, refined by
+            parabolic interpolation between neighbouring bins
+        """
+        length = profiles.shape[1]
         
-        return result
+        # Remove the DC offset and taper the edges to limit spectral leakage
+        profiles = profiles - profiles.mean(axis=1, keepdims=True)
+        profiles *= np.hanning(length).astype(np.float32)
+        
+        amplitudes = np.abs(np.fft.rfft(profiles, axis=1))
+        
+        # Skip the DC bin and the last bin so every peak has two neighbours
+        peak_idx = np.argmax(amplitudes[:, 1:-1], axis=1) + 1
+        rows = np.arange(len(peak_idx))
+        left = amplitudes[rows, peak_idx - 1]
+        center = amplitudes[rows, peak_idx]
+        right = amplitudes[rows, peak_idx + 1]
+        
+        return (peak_idx + parabolic_offset(left, center, right)) / length
     
     def _frequency_domain_analysis(self, image_region: np.ndarray, vertical: bool = True) -> int:
         """
@@ -156,49 +857,157 @@ class ThreadCounter:
         
         return thread_count
     
-    def _create_visual_result(self, image_path: str, warp_count: int, weft_count: int) -> str:
+    def _create_visual_result(self, image: Union[str, ImagePipeline], warp_count: int, weft_count: int) -> str:
         """
         Create a visual representation of the detected threads
         
         Args:
-            image_path: Path to the original image
+            image: Path to the original image or its decoded ImagePipeline
             warp_count: Count of warp threads
             weft_count: Count of weft threads
             
         Returns:
             Base64 encoded string of the visualization image
         """
-        # Read original image
-        img = cv2.imread(image_path)
-        if img is None:
-            logger.error(f"Could not read image for visualization: {image_path}")
+        buffer = self.render_visualization(image, warp_count, weft_count)
+        if buffer is None:
             return ""
         
-        # Create a copy for visualization
-        visual = img.copy()
-        height, width = visual.shape[:2]
+        # Encode the visualization as base64 string
+        with stage_timer('base64'):
+            visual_b64 = base64.b64encode(buffer).decode('utf-8')
+        
+        return visual_b64
+    
+    def render_visualization(self, image: Union[str, ImagePipeline, TiledImage], warp_count: int, weft_count: int,
+                             tile_counts: Optional[Tuple[List[int], List[float], List[float]]] = None,
+                             skew_angle: Optional[float] = None,
+                             regions: Optional[List[Dict[str, Any]]] = None) -> Optional[bytes]:
+        """
+        Render the thread grid overlay for an image as JPEG bytes
         
-        # Draw grid lines to represent detected threads
-        # Warp threads (vertical)
-        warp_spacing = width // (warp_count + 1)
-        for i in range(1, warp_count + 1):
-            x = i * warp_spacing
-            cv2.line(visual, (x, 0), (x, height), (0, 255, 0), 1)
+        Images larger than VISUALIZATION_SIZE are downscaled before drawing, and
+        all lines of an axis are set with a single slice assignment, so the cost
+        does not grow with the thread count. Smaller images are drawn on directly
+        rather than a copy, so this should be the last stage that reads the
+        pipeline's pixels.
         
-        # Weft threads (horizontal)
-        weft_spacing = height // (weft_count + 1)
-        for i in range(1, weft_count + 1):
-            y = i * weft_spacing
-            cv2.line(visual, (0, y), (width, y), (0, 0, 255), 1)
+        Args:
+            image: Path to the original image, its decoded ImagePipeline, or a TiledImage
+                whose preview was assembled by an out-of-core analysis
+            warp_count: Count of warp threads
+            weft_count: Count of weft threads
+            tile_counts: Optional (tile_grid, warp_tile_counts, weft_tile_counts) from the
+                tiled engine; each tile is then ruled at the pitch detected in it
+                instead of spreading the counts evenly over the image
+            skew_angle: Skew of the threads in degrees, counterclockwise; the image is
+                rotated back by it before the grid is drawn
+            regions: Optional per-region results of a region analysis; each region is
+                then outlined and ruled with its own counts instead of the whole image
+            
+        Returns:
+            JPEG encoded visualization, or None if the image could not be read
+        """
+        if isinstance(image, TiledImage):
+            # Out-of-core images only ever exist as their preview; keep it intact for the caller
+            visual = image.preview.copy()
+            height, width = image.shape
+        else:
+            try:
+                visual = ImagePipeline.load(image, self.storage).image
+            except (FileNotFoundError, ValueError):
+                logger.error("Could not read image for visualization: %s", getattr(image, 'source', image))
+                return None
+            height, width = visual.shape[:2]
+        
+        with stage_timer('visualization_draw'):
+            visual = downscale_preview(visual, VISUALIZATION_SIZE)
+            if regions:
+                self._draw_regions(visual, (height, width), regions)
+            else:
+                if skew_angle:
+                    visual = self._deskew(visual, skew_angle)
+                
+                if tile_counts is None:
+                    self._draw_uniform_grid(visual, (height, width), warp_count, weft_count)
+                else:
+                    self._draw_tile_grid(visual, *tile_counts)
+                
+                # Add text with thread count information
+                font = cv2.FONT_HERSHEY_SIMPLEX
+                cv2.putText(visual, f"Warp: {warp_count}", (10, 30), font, 1, WARP_COLOR, 2)
+                cv2.putText(visual, f"Weft: {weft_count}", (10, 70), font, 1, WEFT_COLOR, 2)
+                cv2.putText(visual, f"Total: {warp_count + weft_count}", (10, 110), font, 1, (255, 0, 0), 2)
+        
+        with stage_timer('jpeg_encode'):
+            _, buffer = cv2.imencode('.jpg', visual)
+        
+        return buffer.tobytes()
+    
+    @staticmethod
+    def _deskew(visual: np.ndarray, skew_angle: float) -> np.ndarray:
+        """Rotate an image clockwise by skew_angle degrees about its centre, keeping its size"""
+        height, width = visual.shape[:2]
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), -skew_angle, 1.0)
+        return cv2.warpAffine(visual, rotation, (width, height), flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_CONSTANT)
+    
+    @staticmethod
+    def _draw_uniform_grid(visual: np.ndarray, original_shape: Tuple[int, int], warp_count: int, weft_count: int) -> None:
+        """
+        Rule the counted threads evenly across the image
         
-        # Add text with thread count information
+        Line positions are laid out on the original image and scaled to the
+        (possibly downscaled) visual, so the grid looks the same at any size.
+        """
+        height, width = original_shape
+        preview_height, preview_width = visual.shape[:2]
+        
+        # Warp threads (vertical), then weft threads (horizontal) on top
+        warp_x = np.arange(1, warp_count + 1) * (width // (warp_count + 1))
+        weft_y = np.arange(1, weft_count + 1) * (height // (weft_count + 1))
+        visual[:, np.minimum(warp_x * preview_width // width, preview_width - 1)] = WARP_COLOR
+        visual[np.minimum(weft_y * preview_height // height, preview_height - 1), :] = WEFT_COLOR
+    
+    def _draw_regions(self, visual: np.ndarray, original_shape: Tuple[int, int],
+                      regions: List[Dict[str, Any]]) -> None:
+        """Outline each region and rule it evenly with its own counts, labelled with them"""
+        height, width = original_shape
+        scale_y, scale_x = visual.shape[0] / height, visual.shape[1] / width
         font = cv2.FONT_HERSHEY_SIMPLEX
-        cv2.putText(visual, f"Warp: {warp_count}", (10, 30), font, 1, (0, 255, 0), 2)
-        cv2.putText(visual, f"Weft: {weft_count}", (10, 70), font, 1, (0, 0, 255), 2)
-        cv2.putText(visual, f"Total: {warp_count + weft_count}", (10, 110), font, 1, (255, 0, 0), 2)
         
-        # Encode the visualization as base64 string
-        _, buffer = cv2.imencode('.jpg', visual)
-        visual_b64 = base64.b64encode(buffer).decode('utf-8')
+        for region in regions:
+            top, left = int(region['y'] * scale_y), int(region['x'] * scale_x)
+            bottom, right = int((region['y'] + region['height']) * scale_y), int((region['x'] + region['width']) * scale_x)
+            # Draw through a view, so the grid is laid out on the region alone
+            self._draw_uniform_grid(visual[top:bottom, left:right], (region['height'], region['width']),
+                                    region['warp_count'], region['weft_count'])
+            cv2.rectangle(visual, (left, top), (right - 1, bottom - 1), (255, 0, 0), 2)
+            cv2.putText(visual, f"{region['label']}: {region['warp_count']} x {region['weft_count']}",
+                        (left + 5, top + 25), font, 0.7, (255, 0, 0), 2)
+        
+        cv2.putText(visual, f"Regions: {len(regions)}", (10, visual.shape[0] - 15), font, 1, (255, 0, 0), 2)
+    
+    def _draw_tile_grid(self, visual: np.ndarray, tile_grid: List[int],
+                        warp_tile_counts: List[float], weft_tile_counts: List[float]) -> None:
+        """
+        Rule each analysis tile at the warp and weft pitch detected in it
         
-        return visual_b64
+        Tile counts are measured over a STRIP_FRACTION window of the whole image,
+        so the pitch in pixels follows from the visual's size alone.
+        """
+        rows, cols = tile_grid
+        height, width = visual.shape[:2]
+        row_edges = np.linspace(0, height, rows + 1).astype(int)
+        col_edges = np.linspace(0, width, cols + 1).astype(int)
+        warp_pitches = width * STRIP_FRACTION * self.reference_length / np.maximum(warp_tile_counts, 1e-6)
+        weft_pitches = height * STRIP_FRACTION * self.reference_length / np.maximum(weft_tile_counts, 1e-6)
+        
+        # Tiles are listed row by row, as the tiled engine stacks them
+        for tile, (row, col) in enumerate(np.ndindex(rows, cols)):
+            top, bottom = row_edges[row], row_edges[row + 1]
+            left, right = col_edges[col], col_edges[col + 1]
+            warp_x = np.arange(left + warp_pitches[tile], right, max(warp_pitches[tile], 1.0)).astype(int)
+            weft_y = np.arange(top + weft_pitches[tile], bottom, max(weft_pitches[tile], 1.0)).astype(int)
+            visual[top:bottom, warp_x] = WARP_COLOR
+            visual[weft_y, left:right] = WEFT_COLOR
@@ -0,0 +1,506 @@
+import os
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+import cv2
+
+from image_processor import ThreadCounter, ImagePipeline
+from tiled_image import open_tiled_image
+from derivatives import create_derivatives
+from storage import Storage
+from dedup import content_hash, stream_content_hash, perceptual_hash
+from regions import Regions, parse_regions
+from metrics import QUEUE_DEPTH, JOBS_RUNNING, ANALYSIS_FAILURES, collect_timings, stage_timer, record_analysis
+
+logger = logging.getLogger(__name__)
+
+def _init_worker() -> None:
+    """Keep each pool process single-threaded so the pool, not OpenCV, spreads work across cores"""
+    cv2.setNumThreads(1)
+
+@lru_cache(maxsize=32)
+def _get_counter(unit: str, reference_length: float, mode: str, overlay: str, engine: str,
+                 deskew: bool) -> ThreadCounter:
+    """Reuse one ThreadCounter per parameter set for the lifetime of a worker process"""
+    return ThreadCounter(unit=unit, reference_length=reference_length, mode=mode, overlay=overlay,
+                         engine=engine, deskew=deskew)
+
+def run_analysis(storage: Storage, filename: str, unit: str, reference_length: float, mode: str = 'full',
+                 overlay: str = 'uniform', engine: str = 'tiled', deskew: bool = False,
+                 regions: Optional[Regions] = None) -> Dict[str, Any]:
+    """
+    Run a thread count in a worker process
+
+    Args:
+        storage: Upload storage backend; workers read from it directly, so they need
+            no filesystem shared with the web process
+        filename: Stored name of the uploaded image
+        unit: The unit of measurement ('cm' or 'inch')
+        reference_length: The reference length in the unit specified
+        mode: Processing mode ('full', 'roi' or 'pyramid')
+        overlay: Visualization grid style ('uniform' or 'tiles')
+        engine: Analysis engine ('tiled', 'spectral' or 'strip')
+        deskew: Rotate the visualization by the detected skew (spectral engine)
+        regions: Optional regions of interest to count separately, or 'auto' to find the swatches
+
+    Returns:
+        The results of ThreadCounter.count_threads, plus the content and perceptual
+        hashes of the image and the time spent in each stage ('timings')
+    """
+    counter = _get_counter(unit, reference_length, mode, overlay, engine, deskew)
+    with collect_timings() as timings:
+        # Large TIFFs are never held in memory whole, see ThreadCounter._streamed_tiled_analysis;
+        # region analyses crop the decoded image, so they always decode it
+        tiled = open_tiled_image(filename, storage) if counter.out_of_core and not regions else None
+        if tiled is not None:
+            try:
+                # The analysis assembles the preview the hashes and derivatives are made from
+                results = counter.count_threads(tiled)
+                with stage_timer('hash'), storage.open(filename) as stream:
+                    hashes = {'content_hash': stream_content_hash(stream),
+                              'perceptual_hash': perceptual_hash(tiled.preview)}
+                with stage_timer('derivatives'):
+                    create_derivatives(storage, filename, tiled.preview)
+            finally:
+                tiled.close()
+        else:
+            with stage_timer('read_upload'):
+                data = storage.read(filename)
+            
+            # Decode once for the hashes, the derivatives and the analysis
+            with stage_timer('decode'):
+                pipeline = ImagePipeline.from_bytes(data, filename)
+            with stage_timer('hash'):
+                hashes = {'content_hash': content_hash(data), 'perceptual_hash': perceptual_hash(pipeline.image)}
+            del data
+            with stage_timer('derivatives'):
+                create_derivatives(storage, filename, pipeline.image)
+            results = counter.count_threads(pipeline, regions)
+    
+    results.update(hashes)
+    results['timings'] = timings
+    return results
+
+class JobQueue:
+    """
+    Queue of analysis jobs processed by pools of worker processes
+
+    The table is the queue: jobs are ``Analysis`` rows in the ``queued`` state, and
+    every process serving the app runs a dispatcher thread that claims the oldest
+    queued row whenever one of its workers is free, whichever process created the
+    job. Claiming is a conditional ``queued`` -> ``running`` update, so a row is
+    only ever processed once. Submitting a job wakes the local dispatcher; the
+    others find it within JOB_CLAIM_INTERVAL seconds.
+
+    A process keeps a lease on the rows it is running by refreshing their
+    ``heartbeat_at`` every quarter of JOB_LEASE_SECONDS. A row still running once
+    its lease has run out belongs to a process that died or was recycled (e.g. by
+    gunicorn's max_requests or timeout), and the next dispatcher to notice puts
+    it back to ``queued``.
+
+    If a pool process dies (e.g. killed for using too much memory), the pool is
+    replaced and the jobs it was running go back to ``queued``, up to
+    JOB_MAX_ATTEMPTS times each so an image that crashes every worker fails
+    instead of being retried forever.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.max_workers = 1
+        self.max_attempts = 3
+        self.poll_interval = 0.25
+        self.claim_interval = 1.0
+        self.lease_seconds = 60.0
+        self._wakeup = threading.Event()
+        self._finished_jobs = threading.Condition()
+        self._held: Set[int] = set()
+        self._lock = threading.Lock()
+        self._slots: Optional[threading.Semaphore] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._dispatcher: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._running = 0
+        self._stopping = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Configure the queue from the Flask app config"""
+        self.app = app
+        self.max_workers = app.config.get('ANALYSIS_WORKERS') or os.cpu_count() or 1
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', self.max_attempts)
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', self.poll_interval)
+        self.claim_interval = app.config.get('JOB_CLAIM_INTERVAL', self.claim_interval)
+        self.lease_seconds = app.config.get('JOB_LEASE_SECONDS', self.lease_seconds)
+        self._slots = threading.Semaphore(self.max_workers)
+        QUEUE_DEPTH.set_function(lambda: self.depth)
+        JOBS_RUNNING.set_function(lambda: self.running)
+        app.extensions['job_queue'] = self
+
+    @property
+    def depth(self) -> int:
+        """Number of jobs waiting for a worker, in every process"""
+        from sqlalchemy import select, func
+        from app import db
+        from models import Analysis, STATUS_QUEUED
+
+        with self.app.app_context(), db.engine.connect() as connection:
+            return connection.execute(select(func.count()).where(Analysis.status == STATUS_QUEUED)).scalar()
+
+    @property
+    def running(self) -> int:
+        """Number of jobs currently being processed by this process"""
+        return self._running
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """The worker pool, for callers that fan out work themselves (e.g. batch analysis)"""
+        self._ensure_started()
+        # A pool that lost a process refuses new work; replace it rather than fail every caller
+        if self._executor._broken:
+            self._restart_executor(self._executor)
+        return self._executor
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context(self.app.config.get('ANALYSIS_START_METHOD', 'spawn'))
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context, initializer=_init_worker)
+
+    def _ensure_started(self) -> None:
+        """Start the worker pool and dispatcher on first use rather than at import time"""
+        if self._dispatcher is not None:
+            return
+
+        with self._start_lock:
+            if self._dispatcher is not None:
+                return
+
+            self._executor = self._new_executor()
+            atexit.register(self._shutdown)
+
+            self._dispatcher = threading.Thread(target=self._dispatch, name='analysis-dispatcher', daemon=True)
+            self._dispatcher.start()
+            logger.info("Analysis job queue started with %s workers", self.max_workers)
+
+    def _restart_executor(self, broken: ProcessPoolExecutor) -> None:
+        """Replace a pool that lost a process, unless another thread already did"""
+        with self._start_lock:
+            if self._executor is not broken:
+                return
+            self._executor = self._new_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+        logger.warning("Analysis worker pool was broken by a dead process and has been restarted")
+
+    def start(self) -> None:
+        """
+        Start claiming jobs in this process
+
+        Called by every process that serves the app (each gunicorn worker, or the
+        development server), so queued jobs are processed, including those left
+        behind by a process that went away, even before anything is submitted.
+        """
+        # Pool processes started with spawn re-import the main module, and with it the app
+        if multiprocessing.current_process().name != 'MainProcess':
+            return
+        self._ensure_started()
+
+    def submit(self, analysis_id: int) -> None:
+        """
+        Have a queued analysis processed
+
+        The job is already in the queue once its row is committed as queued; this
+        only wakes up the local dispatcher so it does not wait for its next poll.
+
+        Args:
+            analysis_id: ID of an Analysis row in the queued state
+        """
+        self._ensure_started()
+        logger.debug("Analysis job %s submitted", analysis_id)
+        self._wakeup.set()
+
+    def hold(self, analysis_ids: Iterable[int]) -> None:
+        """Keep the lease on running rows this process analyzes outside the queue (batch analysis)"""
+        self._ensure_started()
+        with self._lock:
+            self._held.update(analysis_ids)
+
+    def release(self, analysis_ids: Iterable[int]) -> None:
+        """Stop renewing the lease on rows passed to hold"""
+        with self._lock:
+            self._held.difference_update(analysis_ids)
+
+    def wait(self, analysis_id: int, timeout: float) -> bool:
+        """
+        Block until a job finishes
+
+        The job may run in any process, so its row is re-read every
+        JOB_POLL_INTERVAL seconds, and as soon as this process finishes a job.
+
+        Args:
+            analysis_id: ID of the job to wait for
+            timeout: Maximum number of seconds to wait
+
+        Returns:
+            True if the job finished, False on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while not self._finished(analysis_id):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with self._finished_jobs:
+                self._finished_jobs.wait(min(self.poll_interval, remaining))
+        return True
+
+    def _finished(self, analysis_id: int) -> bool:
+        """Whether a job's row has left the queued and running states, read on a connection of its own"""
+        from sqlalchemy import select
+        from app import db
+        from models import Analysis, STATUS_QUEUED, STATUS_RUNNING
+
+        # A fresh connection sees commits made by other processes since the request began
+        with self.app.app_context(), db.engine.connect() as connection:
+            status = connection.execute(select(Analysis.status).where(Analysis.id == analysis_id)).scalar()
+        return status not in (STATUS_QUEUED, STATUS_RUNNING)
+
+    def _dispatch(self) -> None:
+        """Claim queued jobs for the pool, one per free worker slot, and keep the leases of running ones"""
+        renew_at = 0.0
+        while not self._stopping:
+            if time.monotonic() >= renew_at:
+                try:
+                    self._renew_leases()
+                except Exception as e:
+                    logger.error("Error renewing analysis job leases: %s", e)
+                renew_at = time.monotonic() + self.lease_seconds / 4
+
+            if not self._slots.acquire(timeout=self.claim_interval):
+                continue
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                logger.error("Error claiming an analysis job: %s", e)
+                claimed = None
+
+            if claimed is None:
+                self._slots.release()
+                self._wakeup.wait(self.claim_interval)
+                self._wakeup.clear()
+                continue
+
+            analysis_id, job = claimed
+            with self._lock:
+                self._running += 1
+            executor = self._executor
+            try:
+                future = executor.submit(run_analysis, *job)
+            except Exception as e:
+                # The job never reached a worker, so it goes back to the queue whatever the cause
+                if isinstance(e, BrokenProcessPool):
+                    logger.error("Error submitting analysis job %s: %s", analysis_id, e)
+                    self._restart_executor(executor)
+                elif isinstance(e, RuntimeError):
+                    # Pools refuse new work once the interpreter is exiting; stop claiming jobs
+                    logger.info("Analysis job queue stopping, job %s left for another process", analysis_id)
+                    self._stopping = True
+                else:
+                    logger.error("Error submitting analysis job %s: %s", analysis_id, e)
+                self._requeue(analysis_id, str(e))
+                continue
+            future.add_done_callback(lambda f, analysis_id=analysis_id, executor=executor:
+                                     self._complete(analysis_id, f, executor))
+
+    def _claim(self) -> Optional[Tuple[int, tuple]]:
+        """
+        Move the oldest queued job to running
+
+        Returns:
+            Tuple of the job's ID and the arguments of run_analysis, or None if
+            no job is queued
+        """
+        from sqlalchemy import select
+        from app import db
+        from models import Analysis, STATUS_QUEUED, STATUS_RUNNING
+
+        with self.app.app_context():
+            try:
+                # Another process may claim the same row first; then try the next one
+                while True:
+                    analysis_id = db.session.scalar(select(Analysis.id).where(Analysis.status == STATUS_QUEUED)
+                                                    .order_by(Analysis.id).limit(1))
+                    if analysis_id is None:
+                        return None
+                    claimed = Analysis.query.filter_by(id=analysis_id, status=STATUS_QUEUED).update({
+                        'status': STATUS_RUNNING,
+                        'attempts': Analysis.attempts + 1,
+                        'heartbeat_at': datetime.utcnow()
+                    }, synchronize_session=False)
+                    db.session.commit()
+                    if claimed:
+                        break
+
+                analysis = db.session.get(Analysis, analysis_id)
+                job = (self.app.extensions['storage'], analysis.filename, analysis.measurement_unit or 'cm',
+                       analysis.reference_length or 1.0, analysis.processing_mode or 'full',
+                       self.app.config['OVERLAY_STYLE'], self.app.config['ANALYSIS_ENGINE'],
+                       self.app.config['DESKEW_OVERLAY'],
+                       parse_regions(analysis.region_spec) if analysis.region_spec else None)
+                with self._lock:
+                    self._held.add(analysis_id)
+                return analysis_id, job
+            finally:
+                db.session.remove()
+
+    def _renew_leases(self) -> None:
+        """
+        Refresh the heartbeat of the rows this process is running, and requeue rows whose lease ran out
+
+        Expired jobs that have used up JOB_MAX_ATTEMPTS are failed instead.
+        """
+        from sqlalchemy import or_, and_
+        from app import db
+        from models import Analysis, STATUS_FAILED, STATUS_QUEUED, STATUS_RUNNING
+
+        now = datetime.utcnow()
+        with self._lock:
+            held = list(self._held)
+
+        with self.app.app_context():
+            try:
+                if held:
+                    Analysis.query.filter(Analysis.id.in_(held), Analysis.status == STATUS_RUNNING) \
+                        .update({'heartbeat_at': now}, synchronize_session=False)
+
+                # Rows from before leases existed have no heartbeat; their age stands in for it
+                cutoff = now - timedelta(seconds=self.lease_seconds)
+                expired = Analysis.query.filter(
+                    Analysis.status == STATUS_RUNNING,
+                    or_(Analysis.heartbeat_at < cutoff,
+                        and_(Analysis.heartbeat_at.is_(None), Analysis.date_created < cutoff))
+                )
+                failed = expired.filter(Analysis.attempts >= self.max_attempts).update({
+                    'status': STATUS_FAILED,
+                    'error': f'The analysis was interrupted {self.max_attempts} times'
+                }, synchronize_session=False)
+                expired = expired.update({'status': STATUS_QUEUED}, synchronize_session=False)
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+        if failed:
+            logger.error("Failed %s analysis jobs that were interrupted too often", failed)
+            ANALYSIS_FAILURES.inc(failed)
+        if expired:
+            logger.warning("Requeued %s analysis jobs whose process stopped renewing their lease", expired)
+            self._wakeup.set()
+
+    def _complete(self, analysis_id: int, future, executor: ProcessPoolExecutor) -> None:
+        """Record the outcome of a finished job"""
+        from app import db
+        from models import Analysis, STATUS_FAILED
+        from queries import flag_near_duplicate
+        from visualizations import store_visualization
+
+        if isinstance(future.exception(), BrokenProcessPool):
+            # The worker died under the job, which says nothing about the image itself
+            logger.error("Worker process died while running analysis job %s", analysis_id)
+            self._restart_executor(executor)
+            self._requeue(analysis_id, "The worker process running the analysis died")
+            return
+
+        with self._lock:
+            self._running -= 1
+        self._slots.release()
+
+        try:
+            with self.app.app_context():
+                analysis = db.session.get(Analysis, analysis_id)
+                try:
+                    results = future.result()
+                    record_analysis(results['mode'], results.pop('timings', {}))
+                    analysis.apply_results(results)
+                    flag_near_duplicate(analysis, self.app.config['DUPLICATE_MAX_DISTANCE'],
+                                        self.app.extensions['storage'])
+                    # Stored before the commit, so a job is never completed without its visualization
+                    store_visualization(analysis, results['visualization'])
+                    db.session.commit()
+                    logger.info("Analysis job %s completed", analysis_id)
+                except Exception as e:
+                    logger.error("Error processing analysis job %s: %s", analysis_id, e)
+                    ANALYSIS_FAILURES.inc()
+                    db.session.rollback()
+                    analysis.status = STATUS_FAILED
+                    analysis.error = str(e)
+                    db.session.commit()
+                finally:
+                    db.session.remove()
+        finally:
+            self._finish(analysis_id)
+
+    def _requeue(self, analysis_id: int, error: str) -> None:
+        """
+        Put a claimed job that got no result back in the queue, freeing its worker slot
+
+        A job that has used up JOB_MAX_ATTEMPTS fails with the error instead.
+        """
+        from app import db
+        from models import Analysis, STATUS_FAILED, STATUS_QUEUED, STATUS_RUNNING
+
+        with self._lock:
+            self._running -= 1
+        self._slots.release()
+
+        try:
+            with self.app.app_context():
+                analysis = db.session.get(Analysis, analysis_id)
+                # Jobs cut off by this process exiting are not the image's fault
+                retry = self._stopping or (analysis.attempts or 0) < self.max_attempts
+                values = {'status': STATUS_QUEUED} if retry else {'status': STATUS_FAILED, 'error': error}
+                Analysis.query.filter_by(id=analysis_id, status=STATUS_RUNNING) \
+                    .update(values, synchronize_session=False)
+                db.session.commit()
+                db.session.remove()
+        except Exception as e:
+            # Still running in the table: requeued once its lease runs out
+            logger.error("Error requeueing analysis job %s: %s", analysis_id, e)
+            retry = False
+
+        if not retry:
+            ANALYSIS_FAILURES.inc()
+        self._finish(analysis_id)
+        self._wakeup.set()
+
+    def _finish(self, analysis_id: int) -> None:
+        """Drop the lease on a job and wake up any long-polling requests waiting on it"""
+        with self._lock:
+            self._held.discard(analysis_id)
+        with self._finished_jobs:
+            self._finished_jobs.notify_all()
+
+    def _shutdown(self) -> None:
+        """Hand the jobs of this process back to the queue when it exits, rather than wait for their leases"""
+        from app import db
+        from models import Analysis, STATUS_QUEUED, STATUS_RUNNING
+
+        self._stopping = True
+        with self._lock:
+            held = list(self._held)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if not held:
+            return
+        try:
+            with self.app.app_context():
+                Analysis.query.filter(Analysis.id.in_(held), Analysis.status == STATUS_RUNNING) \
+                    .update({'status': STATUS_QUEUED}, synchronize_session=False)
+                db.session.commit()
+                db.session.remove()
+            logger.info("Requeued %s analysis jobs on shutdown", len(held))
+        except Exception as e:
+            logger.error("Error requeueing analysis jobs on shutdown: %s", e)
@@ -0,0 +1,234 @@
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+import cv2
+import numpy as np
+
+try:
+    from flask_sock import Sock
+except ImportError:  # pragma: no cover - without flask-sock, live sessions take frames over HTTP only
+    Sock = None
+
+from image_processor import ThreadCounter, ImagePipeline
+
+logger = logging.getLogger(__name__)
+
+# Encoded frame formats accepted from live clients, by their leading bytes
+FRAME_SIGNATURES = {b'\xff\xd8\xff': 'jpg', b'\x89PNG\r\n\x1a\n': 'png'}
+
+def frame_extension(data: bytes) -> Optional[str]:
+    """File extension of an encoded frame, or None if it is not a JPEG or PNG"""
+    for signature, extension in FRAME_SIGNATURES.items():
+        if data.startswith(signature):
+            return extension
+    return None
+
+class LiveSession:
+    """
+    A camera held over the fabric, analyzed frame by frame
+
+    Every frame is measured with the session's ThreadCounter but never stored or
+    rendered. The per-tile counts, which are the FFT peak frequencies scaled to
+    the image, are smoothed across frames with an exponential moving average,
+    so a blurred or badly framed frame only nudges the reported counts. The
+    counts are reported as stable once they have moved by less than the
+    tolerance for several frames in a row, which is the client's cue to lock.
+    """
+
+    def __init__(self, counter: ThreadCounter, smoothing: float, stable_frames: int,
+                 stable_tolerance: float, frame_size: int):
+        self.id = str(uuid.uuid4())
+        self.counter = counter
+        self.smoothing = smoothing
+        self.stable_frames = stable_frames
+        self.stable_tolerance = stable_tolerance
+        self.frame_size = frame_size
+        self.last_active = time.monotonic()
+        # Set, under the lock, once the session has been stored as an analysis
+        self.analysis_id: Optional[int] = None
+        # Frames of one session are measured one at a time, in the order they arrive
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the smoothed counts, e.g. after the camera moved to another fabric"""
+        self.frames = 0
+        self.last_frame: Optional[bytes] = None
+        self.results: Optional[Dict[str, Any]] = None
+        self._warp: Optional[np.ndarray] = None
+        self._weft: Optional[np.ndarray] = None
+        self._skew: Optional[float] = None
+        self._tile_grid = None
+        self._steady = 0
+
+    def decode(self, data: bytes) -> ImagePipeline:
+        """Decode a frame, downscaled so its longest side is at most frame_size"""
+        pipeline = ImagePipeline.from_bytes(data, f'live-{self.id}')
+        height, width = pipeline.image.shape[:2]
+        scale = self.frame_size / max(height, width)
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            pipeline = ImagePipeline(cv2.resize(pipeline.image, size, interpolation=cv2.INTER_AREA), pipeline.source)
+        return pipeline
+
+    def add_frame(self, data: bytes) -> Dict[str, Any]:
+        """
+        Measure a frame and fold it into the smoothed counts
+
+        Args:
+            data: The frame, encoded as JPEG or PNG
+
+        Returns:
+            The smoothed counts, the counts of this frame alone under 'frame_warp_count'
+            and 'frame_weft_count', and whether the counts are 'stable'
+
+        Raises:
+            ValueError: If the frame cannot be decoded
+        """
+        pipeline = self.decode(data)
+        measured = self.counter.measure(pipeline)
+        pipeline.release()
+
+        # Engines without tiles report a single count per axis
+        warp = np.asarray(measured.get('warp_tile_counts') or [measured['warp_count']], dtype=np.float64)
+        weft = np.asarray(measured.get('weft_tile_counts') or [measured['weft_count']], dtype=np.float64)
+
+        # Smooth tile by tile; a frame with another tile layout starts over
+        if self._warp is None or self._warp.shape != warp.shape or self._weft.shape != weft.shape:
+            self._warp, self._weft, self._skew = warp, weft, measured.get('skew_angle')
+            self._steady = 0
+        else:
+            self._warp += self.smoothing * (warp - self._warp)
+            self._weft += self.smoothing * (weft - self._weft)
+            if measured.get('skew_angle') is not None and self._skew is not None:
+                self._skew += self.smoothing * (measured['skew_angle'] - self._skew)
+        self._tile_grid = measured.get('tile_grid')
+
+        results = self.counter.summarize_tile_counts(self._warp, self._weft)
+        results.update({
+            'thread_density': (results['warp_count'] + results['weft_count']) / self.counter.reference_length,
+            'skew_angle': None if self._skew is None else round(self._skew, 2),
+            'measurement_unit': self.counter.unit,
+            'mode': self.counter.mode
+        })
+
+        # Stable once the smoothed counts have settled for enough frames in a row
+        previous = self.results
+        if previous is not None and all(
+                abs(results[key] - previous[key]) <= self.stable_tolerance * previous[key]
+                for key in ('warp_count', 'weft_count')):
+            self._steady += 1
+        else:
+            self._steady = 0
+
+        self.frames += 1
+        self.last_frame = data
+        self.results = results
+        self.last_active = time.monotonic()
+
+        return {
+            'frame': self.frames,
+            'warp_count': results['warp_count'],
+            'weft_count': results['weft_count'],
+            'thread_density': results['thread_density'],
+            'confidence_score': results['confidence_score'],
+            'skew_angle': results['skew_angle'],
+            'measurement_unit': results['measurement_unit'],
+            'mode': results['mode'],
+            'frame_warp_count': measured['warp_count'],
+            'frame_weft_count': measured['weft_count'],
+            'stable': self._steady >= self.stable_frames
+        }
+
+    def render(self, pipeline: ImagePipeline) -> Optional[bytes]:
+        """Render the visualization of the smoothed counts over a decoded frame"""
+        tile_counts = None
+        if self.counter.overlay == 'tiles' and self._tile_grid is not None:
+            tile_counts = (self._tile_grid, self.results['warp_tile_counts'], self.results['weft_tile_counts'])
+        skew_angle = self.results['skew_angle'] if self.counter.deskew else None
+        return self.counter.render_visualization(pipeline, self.results['warp_count'], self.results['weft_count'],
+                                                 tile_counts, skew_angle)
+
+class LiveSessions:
+    """
+    Live analysis sessions of this process
+
+    Sessions only live in memory: frames are never written to storage and
+    nothing reaches the database until a session is locked. Sessions idle for
+    LIVE_SESSION_TTL seconds are dropped, at most LIVE_MAX_SESSIONS are open at
+    once, and frames larger than LIVE_FRAME_SIZE pixels on their longest side
+    are downscaled before they are measured.
+
+    Frames arrive over a WebSocket when flask-sock is installed (`sock` is then
+    set for the routes to register on), or one HTTP request each otherwise.
+    Because sessions belong to one process, the HTTP route needs a single
+    worker or sticky routing; a WebSocket stays on the worker that accepted it.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.sock = None
+        self.ttl = 300.0
+        self.max_sessions = 32
+        self.frame_size = 640
+        self.smoothing = 0.3
+        self.stable_frames = 5
+        self.stable_tolerance = 0.02
+        self._sessions: Dict[str, LiveSession] = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Read the live session settings and set up the WebSocket route support if available"""
+        self.app = app
+        self.ttl = app.config.get('LIVE_SESSION_TTL', self.ttl)
+        self.max_sessions = app.config.get('LIVE_MAX_SESSIONS', self.max_sessions)
+        self.frame_size = app.config.get('LIVE_FRAME_SIZE', self.frame_size)
+        self.smoothing = app.config.get('LIVE_SMOOTHING', self.smoothing)
+        self.stable_frames = app.config.get('LIVE_STABLE_FRAMES', self.stable_frames)
+        self.stable_tolerance = app.config.get('LIVE_STABLE_TOLERANCE', self.stable_tolerance)
+        if Sock is not None:
+            self.sock = Sock(app)
+        app.extensions['live_sessions'] = self
+
+    def create(self, counter: ThreadCounter) -> Optional[LiveSession]:
+        """
+        Open a session measuring frames with the given counter
+
+        Returns:
+            The new session, or None if LIVE_MAX_SESSIONS are already open
+        """
+        with self._lock:
+            self._expire()
+            if len(self._sessions) >= self.max_sessions:
+                return None
+            session = LiveSession(counter, self.smoothing, self.stable_frames, self.stable_tolerance,
+                                  self.frame_size)
+            self._sessions[session.id] = session
+        logger.info("Live session %s opened", session.id)
+        return session
+
+    def get(self, session_id: str) -> Optional[LiveSession]:
+        """The open session with the given id, or None if it does not exist or has expired"""
+        with self._lock:
+            self._expire()
+            return self._sessions.get(session_id)
+
+    def close(self, session_id: str) -> bool:
+        """Drop a session; returns whether it was open"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            logger.info("Live session %s closed after %s frames", session_id, session.frames)
+        return session is not None
+
+    def _expire(self) -> None:
+        """Drop sessions idle for longer than the TTL; the caller holds the lock"""
+        cutoff = time.monotonic() - self.ttl
+        for session_id in [key for key, session in self._sessions.items() if session.last_active < cutoff]:
+            del self._sessions[session_id]
+            logger.info("Live session %s expired", session_id)
@@ -0,0 +1,53 @@
+import os
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+# Human-readable format for development
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord carries; anything else was passed through `extra` and becomes a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format each record as one JSON object per line
+
+    Every line has the time, level, logger, process id and message; fields
+    passed with ``extra=`` are added as they are, so log pipelines can filter
+    on them without parsing the message.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging(level: Optional[str] = None, fmt: Optional[str] = None) -> None:
+    """
+    Configure the root logger for this process
+
+    Like logging.basicConfig this does nothing if the root logger already has
+    handlers, so an entry point that configured logging first wins.
+
+    Args:
+        level: Level name, defaults to LOG_LEVEL or INFO
+        fmt: 'json' for one JSON object per line or 'text', defaults to LOG_FORMAT or text
+    """
+    level = (level or os.environ.get('LOG_LEVEL', 'INFO')).upper()
+    fmt = (fmt or os.environ.get('LOG_FORMAT', 'text')).lower()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    logging.basicConfig(level=level, handlers=[handler])
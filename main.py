@@ -1,6 +1,12 @@
-from app import app
+from app import app, init_db, job_queue
 import logging
 
+logger = logging.getLogger(__name__)
+
 if __name__ == "__main__":
-    logging.info("Starting ThreadCounty server on port 5000")
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Development server; run production with: gunicorn -c gunicorn.conf.py wsgi:app
+    init_db()
+    # Pick up jobs that were still queued, or running when the last process stopped
+    job_queue.start()
+    logger.info("Starting ThreadCounty server on port 5000")
+    app.run(host="0.0.0.0", port=5000)
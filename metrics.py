@@ -0,0 +1,229 @@
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from 1 ms to 30 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Stage timings of the analysis running in the current thread, if anything is collecting them
+_active_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('stage_timings', default=None)
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """
+    Collect the seconds spent in each stage_timer block run within this context
+
+    Nested collectors share the outermost one, so timings recorded inside
+    ThreadCounter during a request land in the request's collector.
+    """
+    timings = _active_timings.get()
+    if timings is not None:
+        yield timings
+        return
+
+    timings = {}
+    token = _active_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _active_timings.reset(token)
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """Time a block as the given stage; costs one clock read per edge, nothing when not collecting"""
+    timings = _active_timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def _format_labels(labelnames: Sequence[str], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    """Base of the metric types: a name, help text and one value per label combination"""
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        # Unlabelled counters are exported from zero rather than appearing on first use
+        self._values: Dict[Tuple[str, ...], float] = {} if self.labelnames else {(): 0.0}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                                for key, value in values]
+
+class Gauge(_Metric):
+    """Current value read from a callback at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._function: Callable[[], float] = lambda: 0
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def render(self) -> List[str]:
+        return self.header() + [f'{self.name} {_format_value(self._function())}']
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            # One slot per bucket, then the sum
+            counts = self._values.setdefault(key, [0.0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = self.header()
+        for key, counts in values:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {_format_value(cumulative)}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {_format_value(cumulative)}')
+        return lines
+
+class MetricsRegistry:
+    """The metrics of this process, rendered in the Prometheus text exposition format"""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'threadcounty_stage_seconds', 'Time spent in each analysis stage', ['stage']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'threadcounty_request_seconds', 'Time to handle each request', ['endpoint', 'status']))
+UPLOAD_BYTES = REGISTRY.register(Counter(
+    'threadcounty_upload_bytes_total', 'Bytes of image data uploaded'))
+IMAGES_PROCESSED = REGISTRY.register(Counter(
+    'threadcounty_images_processed_total', 'Images analyzed', ['mode']))
+ANALYSIS_FAILURES = REGISTRY.register(Counter(
+    'threadcounty_analysis_failures_total', 'Images that could not be analyzed'))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'threadcounty_job_queue_depth', 'Analysis jobs waiting for a worker'))
+JOBS_RUNNING = REGISTRY.register(Gauge(
+    'threadcounty_jobs_running', 'Analysis jobs being processed'))
+
+def observe_timings(timings: Dict[str, float]) -> None:
+    """Add a set of stage timings to the stage latency histogram"""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+def record_analysis(mode: str, timings: Dict[str, float]) -> None:
+    """Count a completed analysis and observe its stage timings"""
+    observe_timings(timings)
+    IMAGES_PROCESSED.inc(mode=mode)
+
+class RequestMetrics:
+    """
+    Flask extension timing every request into the request latency histogram
+
+    Each request also collects the stage timings recorded while it is handled
+    (see stage_timer) and adds them to the stage latency histogram.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        from flask import g, request
+
+        def start_timer():
+            g.request_started = time.perf_counter()
+            g.stage_timings = {}
+            _active_timings.set(g.stage_timings)
+
+        def stop_timer(response):
+            started = g.pop('request_started', None)
+            if started is not None:
+                labels = {'endpoint': request.endpoint or 'unknown', 'status': str(response.status_code)}
+                # Observed once the body has been sent, so streamed responses are timed to their end
+                response.call_on_close(lambda: REQUEST_SECONDS.observe(time.perf_counter() - started, **labels))
+            return response
+
+        def collect_stage_timings(exception):
+            # Teardown runs even when the view raised, so timings never carry over to the
+            # next request handled by this thread
+            observe_timings(g.pop('stage_timings', {}))
+            _active_timings.set(None)
+
+        app.before_request(start_timer)
+        app.after_request(stop_timer)
+        app.teardown_request(collect_stage_timings)
+        app.extensions['request_metrics'] = self
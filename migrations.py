@@ -0,0 +1,48 @@
+import logging
+
+from sqlalchemy import inspect, text
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade_schema() -> None:
+    """
+    Bring an existing database up to date with the models
+
+    ``db.create_all()`` only creates missing tables, so columns and indexes that
+    were added to a model after its table was first created are added here.
+    Every step is idempotent and safe to run on each startup.
+    """
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    if isinstance(default, str):
+                        default = "'" + default.replace("'", "''") + "'"
+                    else:
+                        default = default.compile(dialect=db.engine.dialect)
+                    ddl += f' DEFAULT {default}'
+                conn.execute(text(ddl))
+                logger.info("Added column %s.%s", table.name, column.name)
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+
+                index.create(bind=conn)
+                logger.info("Created index %s", index.name)
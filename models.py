@@ -1,9 +1,39 @@
 from datetime import datetime
 from app import db
+from dedup import PHASH_BANDS, hash_bands
 import json
 
+# Lifecycle of an analysis job
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+# Fields an analysis serializes to, in API order; clients may request a subset
+SERIALIZED_FIELDS = (
+    'id', 'filename', 'original_filename', 'warp_count', 'weft_count', 'thread_density',
+    'confidence_score', 'skew_angle', 'date_created', 'measurement_unit', 'reference_length', 'processing_mode',
+    'notes', 'image_processed', 'status', 'content_hash', 'perceptual_hash', 'duplicate_of_id', 'archived_at'
+)
+
+# Columns holding the image hashes, for bulk updates
+IMAGE_HASH_COLUMNS = ('content_hash', 'perceptual_hash') + tuple(f'phash_band{band}' for band in range(PHASH_BANDS))
+
 class Analysis(db.Model):
     """Model for thread analysis results"""
+    __table_args__ = (
+        # History is listed newest first with keyset pagination on (date_created, id)
+        db.Index('ix_analysis_history', 'image_processed', 'date_created', 'id'),
+        db.Index('ix_analysis_unit_history', 'measurement_unit', 'image_processed', 'date_created', 'id'),
+        # Count range filters
+        db.Index('ix_analysis_warp_count', 'image_processed', 'warp_count'),
+        db.Index('ix_analysis_weft_count', 'image_processed', 'weft_count'),
+        # Near-duplicate candidates are looked up by perceptual hash band
+        *[db.Index(f'ix_analysis_phash_band{band}', f'phash_band{band}') for band in range(PHASH_BANDS)],
+        # Retention walks the unarchived analyses oldest first
+        db.Index('ix_analysis_retention', 'archived_at', 'date_created', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
@@ -11,30 +41,153 @@ class Analysis(db.Model):
     weft_count = db.Column(db.Integer)  # Threads running crosswise in the fabric
     thread_density = db.Column(db.Float)  # Threads per inch/cm
     confidence_score = db.Column(db.Float)  # How confident the algorithm is in the result (0-1)
+    skew_angle = db.Column(db.Float, nullable=True)  # Degrees the threads are turned counterclockwise; spectral engine only
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
     measurement_unit = db.Column(db.String(10), default='cm')  # cm or inch
+    reference_length = db.Column(db.Float, default=1.0)  # Reference length the counts were scaled to
+    processing_mode = db.Column(db.String(10), default='full')  # full, roi or pyramid
     notes = db.Column(db.Text, nullable=True)
     image_processed = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), default=STATUS_COMPLETED, server_default=STATUS_COMPLETED, index=True)  # queued, running, completed or failed
+    error = db.Column(db.Text, nullable=True)  # Failure reason for jobs that could not be processed
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the uploaded bytes
+    perceptual_hash = db.Column(db.String(16))  # Difference hash of the decoded image
+    phash_band0 = db.Column(db.Integer)  # perceptual_hash split into indexed bands, see dedup.PHASH_BANDS
+    phash_band1 = db.Column(db.Integer)
+    phash_band2 = db.Column(db.Integer)
+    phash_band3 = db.Column(db.Integer)
+    duplicate_of_id = db.Column(db.Integer, db.ForeignKey('analysis.id'), nullable=True)  # Near-identical earlier analysis
+    archived_at = db.Column(db.DateTime, nullable=True)  # When retention removed the image files; the results are kept
+    region_spec = db.Column(db.Text, nullable=True)  # Regions asked for: 'auto' or a JSON list (see regions.py); None for the whole image
+    attempts = db.Column(db.Integer, default=0, server_default='0')  # Times a background job was handed to a worker
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # Last lease renewal by the process running the job, see jobs.JobQueue
+    
+    # Counts of each region of interest, for analyses of several swatches in one image
+    regions = db.relationship('AnalysisRegion', order_by='AnalysisRegion.position',
+                              cascade='all, delete-orphan', lazy='select')
     
     def __repr__(self):
         return f'<Analysis {self.id} - {self.original_filename}>'
     
-    def to_dict(self):
-        """Convert analysis object to dictionary for API response"""
-        return {
-            'id': self.id,
-            'filename': self.filename,
-            'original_filename': self.original_filename,
-            'warp_count': self.warp_count,
-            'weft_count': self.weft_count,
-            'thread_density': self.thread_density,
-            'confidence_score': self.confidence_score,
-            'date_created': self.date_created.isoformat(),
-            'measurement_unit': self.measurement_unit,
-            'notes': self.notes,
-            'image_processed': self.image_processed
-        }
+    def to_dict(self, fields=None):
+        """
+        Convert analysis object to dictionary for API response
+        
+        Args:
+            fields: Names from SERIALIZED_FIELDS to include, or None for all of them
+        """
+        data = {}
+        for field in SERIALIZED_FIELDS if fields is None else fields:
+            value = getattr(self, field)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            data[field] = value
+        return data
+    
+    def apply_results(self, results):
+        """Copy the output of ThreadCounter.count_threads onto this analysis"""
+        self.warp_count = results['warp_count']
+        self.weft_count = results['weft_count']
+        self.thread_density = results['thread_density']
+        self.confidence_score = results['confidence_score']
+        self.skew_angle = results.get('skew_angle')
+        self.measurement_unit = results['measurement_unit']
+        self.image_processed = True
+        self.status = STATUS_COMPLETED
+        self.error = None
+        if results.get('content_hash'):
+            self.set_image_hashes(results['content_hash'], results['perceptual_hash'])
+        if results.get('regions'):
+            self.regions = [AnalysisRegion.from_result(position, region)
+                            for position, region in enumerate(results['regions'])]
+    
+    def set_image_hashes(self, content_hash, perceptual_hash):
+        """Record the content and perceptual hashes of the uploaded image"""
+        self.content_hash = content_hash
+        self.perceptual_hash = perceptual_hash
+        for band, value in enumerate(hash_bands(perceptual_hash)):
+            setattr(self, f'phash_band{band}', value)
+    
+    def reuse_results(self, analysis):
+        """Copy the results of a near-identical analysis instead of processing this image"""
+        self.warp_count = analysis.warp_count
+        self.weft_count = analysis.weft_count
+        self.thread_density = analysis.thread_density
+        self.confidence_score = analysis.confidence_score
+        self.skew_angle = analysis.skew_angle
+        self.regions = [AnalysisRegion.from_result(region.position, region.to_dict()) for region in analysis.regions]
+        self.duplicate_of_id = analysis.id
+        self.image_processed = True
+        self.status = STATUS_COMPLETED
+        self.error = None
     
     def to_json(self):
         """Convert analysis object to JSON string"""
         return json.dumps(self.to_dict())
+
+# Fields of a region result, in API order
+REGION_FIELDS = (
+    'label', 'x', 'y', 'width', 'height', 'warp_count', 'weft_count', 'thread_density',
+    'confidence_score', 'skew_angle'
+)
+
+class AnalysisRegion(db.Model):
+    """Counts of one region of interest, e.g. one swatch on a board, within an analyzed image"""
+    id = db.Column(db.Integer, primary_key=True)
+    analysis_id = db.Column(db.Integer, db.ForeignKey('analysis.id', ondelete='CASCADE'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)  # Order of the region within its analysis
+    label = db.Column(db.String(64))
+    x = db.Column(db.Integer, nullable=False)  # Bounding box in pixels of the uploaded image
+    y = db.Column(db.Integer, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    warp_count = db.Column(db.Integer)
+    weft_count = db.Column(db.Integer)
+    thread_density = db.Column(db.Float)
+    confidence_score = db.Column(db.Float)
+    skew_angle = db.Column(db.Float, nullable=True)
+    
+    def __repr__(self):
+        return f'<AnalysisRegion {self.analysis_id}/{self.label}>'
+    
+    @classmethod
+    def from_result(cls, position, region):
+        """Build a region row from one entry of the 'regions' result of ThreadCounter.count_threads"""
+        return cls(position=position, **{field: region.get(field) for field in REGION_FIELDS})
+    
+    def to_dict(self):
+        """Convert the region to a dictionary for API responses"""
+        return {field: getattr(self, field) for field in REGION_FIELDS}
+
+class AnalysisRollup(db.Model):
+    """
+    Number and total of one metric's values falling in one logarithmic bin, per day and unit
+    
+    Kept up to date as analyses complete and read by the aggregates API, see rollups.py.
+    """
+    __table_args__ = (
+        # Each bucket has exactly one row, which completed analyses add to with an upsert
+        db.Index('ix_analysis_rollup_bucket', 'day', 'measurement_unit', 'metric', 'bin', unique=True),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)  # UTC day the analyses were created
+    measurement_unit = db.Column(db.String(10), nullable=False)
+    metric = db.Column(db.String(20), nullable=False)  # One of rollups.METRICS
+    bin = db.Column(db.Integer, nullable=False)  # See rollups.value_bin
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    
+    def __repr__(self):
+        return f'<AnalysisRollup {self.day} {self.measurement_unit} {self.metric}/{self.bin}>'
+
+class UploadSession(db.Model):
+    """Resumable chunked upload; the bytes received so far live in its partial file on disk"""
+    id = db.Column(db.String(36), primary_key=True)
+    original_filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)  # Declared size of the whole upload in bytes
+    date_created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    analysis_id = db.Column(db.Integer, db.ForeignKey('analysis.id'), nullable=True)  # Set once finalized
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id} - {self.original_filename}>'
@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+def fold_stack(frame) -> str:
+    """Render a frame and its callers as one folded-stack line, outermost call first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class SlowRequestProfiler:
+    """
+    Opt-in sampling profiler for slow requests
+
+    While enabled, a background thread samples the Python stack of every request
+    in flight every PROFILE_SAMPLE_INTERVAL_MS. Requests slower than
+    PROFILE_SLOW_REQUEST_MS have their samples written to PROFILE_FOLDER in the
+    folded-stack format read by flamegraph.pl, speedscope and similar tools.
+    Fast requests only cost a dictionary insert and removal.
+    """
+
+    def __init__(self, app=None):
+        self.threshold = 0.0
+        self.interval = 0.005
+        self.folder = None
+        self._samples: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Hook into the app's requests if PROFILE_SLOW_REQUEST_MS is set"""
+        self.threshold = (app.config.get('PROFILE_SLOW_REQUEST_MS') or 0) / 1000
+        app.extensions['slow_request_profiler'] = self
+        if not self.threshold:
+            return
+
+        from flask import g, request
+
+        self.interval = app.config.get('PROFILE_SAMPLE_INTERVAL_MS', 5) / 1000
+        self.folder = app.config['PROFILE_FOLDER']
+        os.makedirs(self.folder, exist_ok=True)
+
+        def start_profile():
+            self._ensure_started()
+            g.profile_started = time.perf_counter()
+            with self._lock:
+                self._samples[threading.get_ident()] = Counter()
+
+        def stop_profile(response):
+            started = g.pop('profile_started', None)
+            if started is None:
+                return response
+            ident = threading.get_ident()
+            endpoint = request.endpoint or 'unknown'
+
+            # Sampling goes on until the body has been sent, which for a streamed
+            # response is where the work happens
+            def finish():
+                with self._lock:
+                    samples = self._samples.pop(ident, None)
+                elapsed = time.perf_counter() - started
+                if samples and elapsed >= self.threshold:
+                    self._dump(endpoint, elapsed, samples)
+
+            response.call_on_close(finish)
+            return response
+
+        def discard_profile(exception):
+            # A view that raised never reaches stop_profile
+            if exception is not None and g.pop('profile_started', None) is not None:
+                with self._lock:
+                    self._samples.pop(threading.get_ident(), None)
+
+        app.before_request(start_profile)
+        app.after_request(stop_profile)
+        app.teardown_request(discard_profile)
+        logger.info("Profiling requests slower than %.0f ms into %s", self.threshold * 1000, self.folder)
+
+    def _ensure_started(self) -> None:
+        """Start the sampling thread with the first profiled request"""
+        if self._sampler is not None:
+            return
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+                self._sampler.start()
+
+    def _sample(self) -> None:
+        """Record the current stack of every profiled request thread"""
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._samples.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[fold_stack(frame)] += 1
+
+    def _dump(self, endpoint: str, elapsed: float, samples: Counter) -> None:
+        """Write the samples of a slow request as a .folded file"""
+        filename = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{endpoint}-{elapsed * 1000:.0f}ms.folded"
+        path = os.path.join(self.folder, filename)
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info("Slow request to %s took %.0f ms, profile written to %s", endpoint, elapsed * 1000, path)
@@ -0,0 +1,354 @@
+import json
+import base64
+import operator
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import or_, tuple_, func
+from sqlalchemy.orm import load_only
+
+from models import Analysis, AnalysisRollup, SERIALIZED_FIELDS
+from rollups import METRICS, bin_quantile
+from dedup import hash_bands, hamming_distance
+from derivatives import same_thumbnail
+from storage import Storage
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Aggregates are grouped by a period (day or week) and/or the unit
+AGGREGATE_PERIODS = ('day', 'week')
+DEFAULT_GROUP_BY = ('day', 'unit')
+DEFAULT_PERCENTILES = (50.0, 90.0, 95.0)
+MAX_PERCENTILES = 10
+
+# Metrics stored as whole numbers, whose percentiles are reported as such
+INTEGER_METRICS = ('warp_count', 'weft_count')
+
+class QueryError(ValueError):
+    """Raised for invalid history query parameters"""
+
+def encode_cursor(analysis: Analysis) -> str:
+    """Opaque cursor pointing just past the given analysis in history order"""
+    payload = json.dumps([analysis.date_created.isoformat(), analysis.id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        date_created, analysis_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(date_created), int(analysis_id)
+    except (ValueError, TypeError):
+        raise QueryError('Invalid cursor')
+
+def _parse_number(args, name: str, cast=float) -> Optional[Any]:
+    value = args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        raise QueryError(f'{name} must be a number')
+
+def _parse_date(args, name: str) -> Optional[datetime]:
+    value = args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise QueryError(f'{name} must be an ISO 8601 date')
+
+def parse_fields(args) -> Optional[List[str]]:
+    """Parse the fields= projection, returning None when every field is wanted"""
+    value = args.get('fields')
+    if not value:
+        return None
+
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in SERIALIZED_FIELDS and field != 'thumbnail_url']
+    if unknown:
+        raise QueryError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def filtered_history(args):
+    """
+    Query of processed analyses matching the unit, count and date filters in args
+
+    Supported filters: unit, min_warp, max_warp, min_weft, max_weft, since, until.
+    Every filter is served by one of the indexes declared on Analysis.
+    """
+    query = Analysis.query.filter(Analysis.image_processed.is_(True))
+
+    unit = args.get('unit')
+    if unit:
+        query = query.filter(Analysis.measurement_unit == unit)
+
+    for name, column, compare in (
+        ('min_warp', Analysis.warp_count, operator.ge),
+        ('max_warp', Analysis.warp_count, operator.le),
+        ('min_weft', Analysis.weft_count, operator.ge),
+        ('max_weft', Analysis.weft_count, operator.le),
+    ):
+        value = _parse_number(args, name, int)
+        if value is not None:
+            query = query.filter(compare(column, value))
+
+    since = _parse_date(args, 'since')
+    if since is not None:
+        query = query.filter(Analysis.date_created >= since)
+    until = _parse_date(args, 'until')
+    if until is not None:
+        query = query.filter(Analysis.date_created < until)
+
+    return query
+
+def history_page(args) -> Tuple[List[Analysis], Optional[str], Optional[List[str]]]:
+    """
+    Fetch one page of history using keyset pagination on (date_created, id)
+
+    Args:
+        args: Request arguments (filters, cursor, limit and fields)
+
+    Returns:
+        Tuple of the analyses on the page, the cursor of the next page (None on
+        the last page) and the requested fields (None for all)
+    """
+    limit = _parse_number(args, 'limit', int)
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise QueryError('limit must be positive')
+    limit = min(limit, MAX_PAGE_SIZE)
+    fields = parse_fields(args)
+
+    query = filtered_history(args)
+
+    cursor = args.get('cursor')
+    if cursor:
+        date_created, analysis_id = decode_cursor(cursor)
+        query = query.filter(tuple_(Analysis.date_created, Analysis.id) < (date_created, analysis_id))
+
+    # Only load the requested columns, plus what the cursor and thumbnail URL need
+    if fields is not None:
+        columns = {'id', 'date_created'} | {field for field in fields if field != 'thumbnail_url'}
+        if 'thumbnail_url' in fields:
+            columns.add('filename')
+        query = query.options(load_only(*[getattr(Analysis, column) for column in columns]))
+
+    # Fetch one extra row to know whether there is a next page
+    analyses = query.order_by(Analysis.date_created.desc(), Analysis.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(analyses) > limit:
+        analyses = analyses[:limit]
+        next_cursor = encode_cursor(analyses[-1])
+
+    return analyses, next_cursor, fields
+
+def export_query(args):
+    """
+    Query of the processed analyses to export, oldest first
+
+    Args:
+        args: Request arguments: the filters of filtered_history and fields
+
+    Returns:
+        Tuple of the query, selecting only the exported columns, and their names
+    """
+    fields = parse_fields(args) or list(SERIALIZED_FIELDS)
+    if 'thumbnail_url' in fields:
+        raise QueryError('thumbnail_url cannot be exported')
+    query = filtered_history(args).with_entities(*[getattr(Analysis, field) for field in fields])
+    return query.order_by(Analysis.date_created, Analysis.id), fields
+
+def export_batches(query, batch_size: int) -> Iterator[List[Tuple]]:
+    """
+    Rows of an export query, batch_size at a time
+
+    Rows are fetched through a server-side cursor where the database supports
+    one, so only the current batch is ever held in memory.
+    """
+    result = query.session.execute(query.statement, execution_options={'yield_per': batch_size})
+    for partition in result.partitions():
+        yield [tuple(row) for row in partition]
+
+def compatible_analyses(unit: str, reference_length: float, mode: str, region_spec: Optional[str] = None):
+    """Processed analyses whose results are valid for the given processing parameters and regions"""
+    return Analysis.query.filter(
+        Analysis.image_processed.is_(True),
+        Analysis.archived_at.is_(None),
+        Analysis.measurement_unit == unit,
+        Analysis.reference_length == reference_length,
+        Analysis.processing_mode == mode,
+        Analysis.region_spec.is_(None) if region_spec is None else Analysis.region_spec == region_spec
+    )
+
+def find_exact_duplicate(content_hash: str, unit: str, reference_length: float, mode: str,
+                         region_spec: Optional[str] = None) -> Optional[Analysis]:
+    """Earliest processed analysis of byte-identical content with the same processing parameters and regions"""
+    return compatible_analyses(unit, reference_length, mode, region_spec) \
+        .filter(Analysis.content_hash == content_hash) \
+        .order_by(Analysis.id) \
+        .first()
+
+def find_near_duplicate(perceptual_hash: str, unit: str, reference_length: float, mode: str,
+                        max_distance: int, exclude_id: Optional[int] = None,
+                        verify: Optional[Callable[[Analysis], bool]] = None,
+                        region_spec: Optional[str] = None) -> Optional[Analysis]:
+    """
+    Closest processed analysis of a near-identical image with the same processing parameters
+    
+    Candidates are fetched through the indexed hash bands, so only distances below
+    PHASH_BANDS are guaranteed to be found.
+    
+    Args:
+        perceptual_hash: Perceptual hash of the new image
+        unit: The unit of measurement
+        reference_length: The reference length in the unit specified
+        mode: Processing mode
+        max_distance: Largest Hamming distance still counted as a near match
+        exclude_id: ID of the analysis being checked, so it does not match itself
+        verify: Optional check a candidate must also pass, tried nearest first
+        region_spec: Regions asked for, as stored in Analysis.region_spec
+        
+    Returns:
+        The nearest match, or None
+    """
+    bands = hash_bands(perceptual_hash)
+    query = compatible_analyses(unit, reference_length, mode, region_spec).filter(or_(*[
+        getattr(Analysis, f'phash_band{band}') == value for band, value in enumerate(bands)
+    ]))
+    if exclude_id is not None:
+        query = query.filter(Analysis.id != exclude_id)
+    
+    candidates = []
+    for candidate in query.order_by(Analysis.id):
+        distance = hamming_distance(perceptual_hash, candidate.perceptual_hash)
+        if distance <= max_distance:
+            candidates.append((distance, candidate.id, candidate))
+    
+    for _, _, candidate in sorted(candidates, key=lambda item: item[:2]):
+        if verify is None or verify(candidate):
+            return candidate
+    return None
+
+def flag_near_duplicate(analysis: Analysis, max_distance: int, storage: Storage) -> Optional[Analysis]:
+    """
+    Point duplicate_of_id of a hashed analysis at a near-identical predecessor, if any
+    
+    Perceptual hash matches are confirmed by comparing the thumbnails of both uploads.
+    """
+    if not analysis.perceptual_hash:
+        return None
+    match = find_near_duplicate(
+        analysis.perceptual_hash, analysis.measurement_unit, analysis.reference_length, analysis.processing_mode,
+        max_distance, exclude_id=analysis.id,
+        verify=lambda candidate: same_thumbnail(storage, analysis.filename, candidate.filename),
+        region_spec=analysis.region_spec
+    )
+    if match is not None:
+        analysis.duplicate_of_id = match.id
+    return match
+
+def parse_group_by(args) -> List[str]:
+    """Parse the group_by= grouping of the aggregates: a period (day or week) and/or unit"""
+    value = args.get('group_by')
+    if value is None:
+        return list(DEFAULT_GROUP_BY)
+
+    group_by = [group.strip() for group in value.split(',') if group.strip()]
+    unknown = [group for group in group_by if group not in AGGREGATE_PERIODS + ('unit',)]
+    if unknown:
+        raise QueryError(f"Unknown group_by: {', '.join(unknown)}")
+    if len([group for group in group_by if group in AGGREGATE_PERIODS]) > 1:
+        raise QueryError('group_by takes at most one of day and week')
+    return group_by
+
+def parse_percentiles(args) -> List[float]:
+    """Parse the percentiles= list of the aggregates, each between 0 and 100"""
+    value = args.get('percentiles')
+    if not value:
+        return list(DEFAULT_PERCENTILES)
+
+    try:
+        percentiles = [float(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise QueryError('percentiles must be numbers')
+    if not percentiles or len(percentiles) > MAX_PERCENTILES or not all(0 <= p <= 100 for p in percentiles):
+        raise QueryError(f'percentiles takes 1 to {MAX_PERCENTILES} numbers between 0 and 100')
+    return percentiles
+
+def aggregate_buckets(args) -> Tuple[List[Dict[str, Any]], List[str], List[float]]:
+    """
+    Count, mean and percentiles of the analysis metrics, read from the daily rollups
+
+    The rollups are summed in the database down to one row per group, metric
+    and bin, so the cost depends on the number of days and units covered,
+    never on the number of analyses. Weeks start on Monday and are summed from
+    their days.
+
+    Args:
+        args: Request arguments: group_by, percentiles, and the unit, since and
+            until filters (since and until are dates; until is exclusive)
+
+    Returns:
+        Tuple of the buckets, ordered by period and unit, the grouping and the percentiles
+    """
+    group_by = parse_group_by(args)
+    percentiles = parse_percentiles(args)
+    period = next((group for group in group_by if group in AGGREGATE_PERIODS), None)
+
+    keys = ([AnalysisRollup.day] if period else []) + \
+        ([AnalysisRollup.measurement_unit] if 'unit' in group_by else [])
+    query = AnalysisRollup.query.with_entities(
+        *keys, AnalysisRollup.metric, AnalysisRollup.bin,
+        func.sum(AnalysisRollup.count), func.sum(AnalysisRollup.total)
+    ).group_by(*keys, AnalysisRollup.metric, AnalysisRollup.bin)
+
+    unit = args.get('unit')
+    if unit:
+        query = query.filter(AnalysisRollup.measurement_unit == unit)
+    since = _parse_date(args, 'since')
+    if since is not None:
+        query = query.filter(AnalysisRollup.day >= since.date())
+    until = _parse_date(args, 'until')
+    if until is not None:
+        query = query.filter(AnalysisRollup.day < until.date())
+
+    # (period start, unit) -> metric -> [(bin, count)], plus the count and total of each metric
+    bins = defaultdict(lambda: defaultdict(list))
+    totals = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+    for row in query:
+        day = row[0] if period else None
+        if period == 'week':
+            day -= timedelta(days=day.weekday())
+        key = (day, row[len(keys) - 1] if 'unit' in group_by else None)
+        metric, bin_index, count, total = row[len(keys):]
+        bins[key][metric].append((bin_index, count))
+        totals[key][metric][0] += count
+        totals[key][metric][1] += total
+
+    buckets = []
+    for key in sorted(bins, key=lambda key: (key[0] or datetime.min.date(), key[1] or '')):
+        day, unit = key
+        bucket = {}
+        if period:
+            bucket[period] = day.isoformat()
+        if 'unit' in group_by:
+            bucket['unit'] = unit
+        bucket['count'] = max(count for count, _ in totals[key].values())
+        for metric in METRICS:
+            if metric not in bins[key]:
+                bucket[metric] = None
+                continue
+            count, total = totals[key][metric]
+            metric_bins = sorted(bins[key][metric])
+            stats = {'mean': round(total / count, 4)}
+            for p in percentiles:
+                value = bin_quantile(metric_bins, p / 100)
+                stats[f'p{p:g}'] = int(round(value)) if metric in INTEGER_METRICS else round(value, 4)
+            bucket[metric] = stats
+        buckets.append(bucket)
+
+    return buckets, group_by, percentiles
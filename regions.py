@@ -0,0 +1,173 @@
+import json
+import math
+import logging
+from typing import Any, Dict, List, Union
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Region spec asking for the swatches in the image to be found automatically
+AUTO_REGIONS = 'auto'
+
+# Most regions analyzed in one image
+MAX_REGIONS = 64
+
+# Smallest side of a region in pixels: two of the smallest analysis tiles
+MIN_REGION_SIZE = 64
+
+# Swatches are looked for on a copy of the image with this longest side, blurred until the
+# weave disappears; blobs smaller than SWATCH_MIN_AREA of the image are ignored
+SWATCH_DETECTION_SIZE = 512
+SWATCH_MIN_AREA = 0.01
+
+# Fraction of each side trimmed off a detected swatch, so its frayed or shadowed edges are not counted
+SWATCH_MARGIN = 0.05
+
+Regions = Union[str, List[Dict[str, Any]]]
+
+def parse_regions(value: Union[str, list]) -> Regions:
+    """
+    Validate the regions of interest asked for by a request
+
+    Args:
+        value: 'auto', or a list of regions (or its JSON text), each either
+            [x, y, width, height] or {"x", "y", "width", "height", "label"} in
+            pixels of the uploaded image
+
+    Returns:
+        'auto', or the regions as dicts with x, y, width, height and label
+
+    Raises:
+        ValueError: If the value is not a valid region list
+    """
+    if value == AUTO_REGIONS:
+        return AUTO_REGIONS
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError("Regions must be 'auto' or a JSON list of regions")
+    if not isinstance(value, list) or not value:
+        raise ValueError("Regions must be 'auto' or a non-empty list of regions")
+    if len(value) > MAX_REGIONS:
+        raise ValueError(f"At most {MAX_REGIONS} regions can be analyzed in one image")
+
+    regions = []
+    for position, item in enumerate(value):
+        if isinstance(item, dict):
+            box, label = [item.get(key) for key in ('x', 'y', 'width', 'height')], item.get('label')
+        else:
+            box, label = item, None
+        if not isinstance(box, (list, tuple)) or len(box) != 4 or \
+                not all(isinstance(number, (int, float)) and not isinstance(number, bool) and math.isfinite(number)
+                        for number in box):
+            raise ValueError(f"Region {position + 1} must be [x, y, width, height] or an object with those keys")
+        x, y, width, height = (int(round(number)) for number in box)
+        if x < 0 or y < 0 or width < MIN_REGION_SIZE or height < MIN_REGION_SIZE:
+            raise ValueError(f"Region {position + 1} must start inside the image and be at least "
+                             f"{MIN_REGION_SIZE} pixels a side")
+        regions.append({'label': str(label if label is not None else position + 1)[:64],
+                        'x': x, 'y': y, 'width': width, 'height': height})
+    return regions
+
+def dump_regions(regions: Regions) -> str:
+    """Regions as stored with an analysis, for its background job and duplicate matching"""
+    if regions == AUTO_REGIONS:
+        return AUTO_REGIONS
+    return json.dumps(regions, separators=(',', ':'), sort_keys=True)
+
+def resolve_regions(regions: Regions, image: np.ndarray) -> List[Dict[str, Any]]:
+    """
+    Pixel boxes to analyze in a decoded image
+
+    Args:
+        regions: 'auto' or regions from parse_regions
+        image: The decoded image
+
+    Returns:
+        The detected swatches for 'auto', otherwise the regions clipped to the image
+
+    Raises:
+        ValueError: If a region lies outside the image or is clipped below MIN_REGION_SIZE
+    """
+    if regions == AUTO_REGIONS:
+        return detect_swatches(image)
+
+    height, width = image.shape[:2]
+    resolved = []
+    for region in regions:
+        right = min(region['x'] + region['width'], width)
+        bottom = min(region['y'] + region['height'], height)
+        if right - region['x'] < MIN_REGION_SIZE or bottom - region['y'] < MIN_REGION_SIZE:
+            raise ValueError(f"Region {region['label']} lies outside the {width}x{height} image")
+        resolved.append(dict(region, width=right - region['x'], height=bottom - region['y']))
+    return resolved
+
+def detect_swatches(image: np.ndarray) -> List[Dict[str, Any]]:
+    """
+    Find the fabric swatches laid out on a board
+
+    The image is downscaled and blurred until the weave is gone, then split
+    from the board with Otsu's threshold. Whatever touches the image border
+    most is taken to be the board, so light swatches on a dark board are found
+    as well as dark ones on a light board. Each remaining blob's bounding box,
+    trimmed by SWATCH_MARGIN, is a swatch.
+
+    Args:
+        image: The decoded BGR (or grayscale) image
+
+    Returns:
+        Swatch boxes in reading order, labelled 1, 2, ...; the whole image as a
+        single region if no swatch stands out from the background
+    """
+    height, width = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    scale = min(1.0, SWATCH_DETECTION_SIZE / max(height, width))
+    small = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+
+    # Blur away the weave, then separate the swatches from the board
+    kernel_size = max(3, (max(small.shape) // 40) | 1)
+    small = cv2.GaussianBlur(small, (kernel_size, kernel_size), 0)
+    _, mask = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    border = np.concatenate([mask[0], mask[-1], mask[:, 0], mask[:, -1]])
+    if np.count_nonzero(border) > border.size // 2:
+        mask = cv2.bitwise_not(mask)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = SWATCH_MIN_AREA * mask.shape[0] * mask.shape[1]
+    boxes = []
+    for contour in contours:
+        if cv2.contourArea(contour) < min_area:
+            continue
+        x, y, w, h = cv2.boundingRect(contour)
+        # Back to full resolution, trimmed by the margin
+        margin_x, margin_y = w * SWATCH_MARGIN, h * SWATCH_MARGIN
+        left, top = int((x + margin_x) / scale), int((y + margin_y) / scale)
+        right, bottom = min(width, int((x + w - margin_x) / scale)), min(height, int((y + h - margin_y) / scale))
+        if right - left >= MIN_REGION_SIZE and bottom - top >= MIN_REGION_SIZE:
+            boxes.append((left, top, right - left, bottom - top))
+
+    if not boxes:
+        logger.info("No swatches found, analyzing the whole image")
+        return [{'label': '1', 'x': 0, 'y': 0, 'width': width, 'height': height}]
+
+    # Keep the largest swatches, then order them row by row, left to right
+    boxes = sorted(boxes, key=lambda box: box[2] * box[3], reverse=True)[:MAX_REGIONS]
+    boxes.sort(key=lambda box: box[1] + box[3] / 2)
+    rows = []
+    for box in boxes:
+        if rows and box[1] + box[3] / 2 < rows[-1][0][1] + rows[-1][0][3]:
+            rows[-1].append(box)
+        else:
+            rows.append([box])
+    ordered = [box for row in rows for box in sorted(row)]
+
+    logger.debug("Detected %s swatches", len(ordered))
+    return [{'label': str(position + 1), 'x': x, 'y': y, 'width': w, 'height': h}
+            for position, (x, y, w, h) in enumerate(ordered)]
@@ -0,0 +1,222 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock; every process may sweep
+    fcntl = None
+
+from derivatives import derivative_filenames
+
+logger = logging.getLogger(__name__)
+
+# Lock file in the app's instance folder; only the process holding it sweeps
+LOCK_FILENAME = 'retention.lock'
+
+class RateLimiter:
+    """Spaces calls to wait() so that at most `rate` of them complete per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+class RetentionSweeper:
+    """
+    Background expiry of old uploads, driven by the database
+
+    Analyses older than RETENTION_DAYS are found oldest first through the
+    ix_analysis_retention index, marked archived, and then have their upload,
+    derivatives and stored visualization deleted; the row and its counts stay.
+    Chunked upload sessions older than UPLOAD_SESSION_TTL_HOURS are removed
+    along with their partial files.
+
+    Work is done in batches of RETENTION_BATCH_SIZE rows from a daemon thread
+    started with the first request, with file deletions limited to
+    RETENTION_FILES_PER_SECOND so a large backlog never competes with requests
+    for disk. Under a multi-process server every process runs the thread, but
+    a file lock lets only one of them sweep at a time.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.max_age: Optional[timedelta] = None
+        self.session_ttl: Optional[timedelta] = None
+        self.batch_size = 100
+        self.interval = 300.0
+        self.files_per_second = 50.0
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Configure the sweeper and start it with the first request if any expiry is enabled"""
+        self.app = app
+        days = app.config.get('RETENTION_DAYS') or 0
+        hours = app.config.get('UPLOAD_SESSION_TTL_HOURS') or 0
+        self.max_age = timedelta(days=days) if days else None
+        self.session_ttl = timedelta(hours=hours) if hours else None
+        self.batch_size = app.config.get('RETENTION_BATCH_SIZE', self.batch_size)
+        self.interval = app.config.get('RETENTION_INTERVAL', self.interval)
+        self.files_per_second = app.config.get('RETENTION_FILES_PER_SECOND', self.files_per_second)
+        app.extensions['retention_sweeper'] = self
+
+        if self.max_age or self.session_ttl:
+            app.before_request(self._ensure_started)
+
+    def _ensure_started(self) -> None:
+        """Start the sweeper thread in this process, once"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='retention-sweeper', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                with self._exclusive() as acquired:
+                    if acquired:
+                        self.sweep()
+            except Exception as e:
+                logger.error("Retention sweep failed: %s", e)
+            time.sleep(self.interval)
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[bool]:
+        """Hold the sweep lock without blocking; yields whether this process got it"""
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(self.app.instance_path, exist_ok=True)
+        with open(os.path.join(self.app.instance_path, LOCK_FILENAME), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def sweep(self, max_age: Optional[timedelta] = None) -> Dict[str, int]:
+        """
+        Expire everything that is due, one batch at a time
+
+        Args:
+            max_age: Override of RETENTION_DAYS, e.g. from the command line
+
+        Returns:
+            Counts of archived analyses, deleted files and removed upload sessions
+        """
+        max_age = max_age or self.max_age
+        limiter = RateLimiter(self.files_per_second)
+        totals = {'archived': 0, 'files_deleted': 0, 'sessions_removed': 0}
+
+        if max_age:
+            while True:
+                archived, files_deleted = self.archive_batch(datetime.utcnow() - max_age, limiter)
+                totals['archived'] += archived
+                totals['files_deleted'] += files_deleted
+                if archived < self.batch_size:
+                    break
+
+        if self.session_ttl:
+            while True:
+                removed = self.remove_stale_sessions(datetime.utcnow() - self.session_ttl, limiter)
+                totals['sessions_removed'] += removed
+                if removed < self.batch_size:
+                    break
+
+        if any(totals.values()):
+            logger.info("Retention archived %s analyses, deleted %s files and removed %s upload sessions",
+                        totals['archived'], totals['files_deleted'], totals['sessions_removed'])
+        return totals
+
+    def archive_batch(self, cutoff: datetime, limiter: RateLimiter) -> tuple:
+        """
+        Archive the oldest batch of analyses created before the cutoff
+
+        Rows are marked archived before their files are deleted, so the database
+        never presents an analysis as live whose files are gone.
+
+        Returns:
+            Tuple of (analyses archived, files deleted)
+        """
+        from app import db, artifact_store
+        from models import Analysis, STATUS_QUEUED, STATUS_RUNNING
+        from visualizations import visualization_key
+
+        storage = self.app.extensions['storage']
+        with self.app.app_context():
+            analyses = Analysis.query.filter(
+                Analysis.archived_at.is_(None),
+                Analysis.date_created < cutoff,
+                Analysis.status.notin_((STATUS_QUEUED, STATUS_RUNNING))
+            ).order_by(Analysis.date_created, Analysis.id).limit(self.batch_size).all()
+            if not analyses:
+                return 0, 0
+
+            ids = [analysis.id for analysis in analyses]
+            Analysis.query.filter(Analysis.id.in_(ids), Analysis.archived_at.is_(None)) \
+                .update({'archived_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+
+            files_deleted = 0
+            for analysis in analyses:
+                for name in [analysis.filename] + derivative_filenames(analysis.filename):
+                    limiter.wait()
+                    if storage.delete(name):
+                        files_deleted += 1
+                # The visualization blob goes with its last key; identical renders share it
+                if analysis.image_processed:
+                    limiter.wait()
+                    if artifact_store.delete(visualization_key(analysis)):
+                        files_deleted += 1
+            db.session.remove()
+
+        return len(analyses), files_deleted
+
+    def remove_stale_sessions(self, cutoff: datetime, limiter: RateLimiter) -> int:
+        """
+        Remove the oldest batch of chunked upload sessions created before the cutoff
+
+        Returns:
+            Number of sessions removed
+        """
+        from app import db
+        from models import UploadSession
+        from chunked_upload import partial_path
+
+        upload_folder = self.app.config['UPLOAD_FOLDER']
+        with self.app.app_context():
+            sessions = UploadSession.query.filter(UploadSession.date_created < cutoff) \
+                .order_by(UploadSession.date_created).limit(self.batch_size).all()
+            for session in sessions:
+                # Finalized sessions have already moved their file into the upload folder
+                if session.analysis_id is None:
+                    limiter.wait()
+                    try:
+                        os.remove(partial_path(upload_folder, session.id))
+                    except FileNotFoundError:
+                        pass
+                db.session.delete(session)
+            db.session.commit()
+            db.session.remove()
+
+        return len(sessions)
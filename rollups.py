@@ -0,0 +1,206 @@
+import math
+import logging
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sqlalchemy import event, inspect, insert, update, delete, select, and_
+from sqlalchemy.dialects import postgresql, sqlite
+
+logger = logging.getLogger(__name__)
+
+# Analysis columns summarized by the rollups
+METRICS = ('warp_count', 'weft_count', 'thread_density', 'confidence_score')
+
+# Values are counted in logarithmic bins, so any percentile read back from the bins is within
+# RELATIVE_ACCURACY of an actual value, whatever the range of the metric
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+# Smallest value told apart from zero; zero and negative values share its bin
+MIN_VALUE = 1e-6
+
+# Columns identifying one rollup row
+BUCKET_COLUMNS = ('day', 'measurement_unit', 'metric', 'bin')
+
+# Bucket key = (day, unit, metric, bin); its value is (count, total of the values)
+Bucket = Tuple[date, str, str, int]
+
+def value_bin(value: float) -> int:
+    """Logarithmic bin of a metric value"""
+    return math.ceil(math.log(max(value, MIN_VALUE), GAMMA))
+
+def bin_value(bin_index: int) -> float:
+    """Value standing for every value in a bin, within RELATIVE_ACCURACY of each of them"""
+    return 2 * GAMMA ** bin_index / (GAMMA + 1)
+
+def bin_quantile(bins: List[Tuple[int, int]], q: float) -> float:
+    """
+    Approximate quantile of the values counted in a set of bins
+
+    Args:
+        bins: (bin, count) pairs sorted by bin
+        q: Quantile between 0 and 1
+
+    Returns:
+        The value standing for the bin holding the quantile
+    """
+    total = sum(count for _, count in bins)
+    rank = q * (total - 1)
+    seen = 0
+    for bin_index, count in bins:
+        seen += count
+        if seen > rank:
+            return bin_value(bin_index)
+    return bin_value(bins[-1][0])
+
+def rollup_rows(analyses: Iterable[Any]) -> List[Dict[str, Any]]:
+    """
+    Rollup increments for a set of completed analyses
+
+    Args:
+        analyses: Analysis objects, or mappings with their date_created,
+            measurement_unit and metric columns (e.g. bulk update rows)
+
+    Returns:
+        One row per (day, unit, metric, bin) with the number of values that fall in
+        it and their total, ready to be added to the rollup table
+    """
+    buckets: Dict[Bucket, List[float]] = defaultdict(lambda: [0, 0.0])
+    for analysis in analyses:
+        get = analysis.get if isinstance(analysis, dict) else lambda name: getattr(analysis, name)
+        day = (get('date_created') or datetime.utcnow()).date()
+        unit = get('measurement_unit') or 'cm'
+        for metric in METRICS:
+            value = get(metric)
+            if value is None:
+                continue
+            bucket = buckets[(day, unit, metric, value_bin(value))]
+            bucket[0] += 1
+            bucket[1] += value
+    return [dict(zip(BUCKET_COLUMNS, key), count=count, total=total) for key, (count, total) in buckets.items()]
+
+def negate_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Rollup decrements taking back the given increments, e.g. of deleted analyses"""
+    return [dict(row, count=-row['count'], total=-row['total']) for row in rows]
+
+def add_to_rollups(connection, table, rows: List[Dict[str, Any]]) -> None:
+    """
+    Add rollup increments (or decrements) to the rollup table within the caller's transaction
+
+    SQLite and PostgreSQL add them with a single upsert, so concurrent writers
+    never overwrite each other's counts; other databases update each row and
+    insert the ones that do not exist yet.
+    """
+    if not rows:
+        return
+    dialect = connection.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        statement = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        statement = statement.on_conflict_do_update(index_elements=list(BUCKET_COLUMNS), set_={
+            'count': table.c.count + statement.excluded['count'],
+            'total': table.c.total + statement.excluded['total'],
+        })
+        connection.execute(statement, rows)
+        return
+
+    for row in rows:
+        result = connection.execute(
+            update(table)
+            .where(and_(*[table.c[column] == row[column] for column in BUCKET_COLUMNS]))
+            .values(count=table.c.count + row['count'], total=table.c.total + row['total'])
+        )
+        if not result.rowcount:
+            connection.execute(insert(table), [row])
+
+class AggregateRollups:
+    """
+    Daily rollups of the analysis metrics per unit, kept up to date as analyses complete
+
+    For every day and unit, each metric's values are counted in logarithmic
+    bins along with their total, so averages are exact and percentiles within
+    RELATIVE_ACCURACY. Aggregate queries (see queries.aggregate_buckets) then
+    read a bounded number of rows per day instead of every analysis.
+
+    Analyses are added in the transaction that completes them: a session
+    listener picks up every analysis flushed as newly processed, and bulk
+    updates that bypass the session (batch analysis) call record. Processed
+    analyses deleted through the session, e.g. when storing the visualization
+    failed after the commit, are taken back out in the transaction deleting
+    them. The rebuild command recomputes the whole table from the analyses.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Listen for completed analyses on the app's database session"""
+        self.app = app
+        event.listen(app.extensions['sqlalchemy'].session, 'before_flush', self._before_flush)
+        event.listen(app.extensions['sqlalchemy'].session, 'after_flush', self._after_flush)
+        app.extensions['rollups'] = self
+
+    def _before_flush(self, session, flush_context, instances) -> None:
+        """Take the processed analyses this flush deletes back out of the rollups"""
+        from models import Analysis, AnalysisRollup
+
+        # Before the flush, since the values of a deleted row can no longer be loaded after it
+        deleted = [obj for obj in session.deleted if isinstance(obj, Analysis) and obj.image_processed]
+        if deleted:
+            add_to_rollups(session.connection(), AnalysisRollup.__table__, negate_rows(rollup_rows(deleted)))
+
+    def _after_flush(self, session, flush_context) -> None:
+        """Add the analyses this flush marked processed to the rollups"""
+        from models import Analysis, AnalysisRollup
+
+        completed = []
+        for obj in list(session.new) + list(session.dirty):
+            if not isinstance(obj, Analysis) or not obj.image_processed:
+                continue
+            # New rows, or existing ones whose image_processed was just set
+            history = inspect(obj).attrs.image_processed.history
+            if obj in session.new or (history.added and not any(history.deleted)):
+                completed.append(obj)
+        if completed:
+            add_to_rollups(session.connection(), AnalysisRollup.__table__, rollup_rows(completed))
+
+    def record(self, session, analyses: Iterable[Any]) -> None:
+        """Add analyses completed outside the session, e.g. by a bulk update, in the session's transaction"""
+        from models import AnalysisRollup
+
+        add_to_rollups(session.connection(), AnalysisRollup.__table__, rollup_rows(analyses))
+
+    def rebuild(self, session, batch_size: int = 1000) -> Tuple[int, int]:
+        """
+        Recompute the rollups from every processed analysis, in one transaction
+
+        Analyses are streamed batch_size rows at a time and only their bins are
+        kept in memory, so the cost does not depend on the number of analyses.
+
+        Returns:
+            Tuple of (analyses read, rollup rows written)
+        """
+        from models import Analysis, AnalysisRollup
+
+        columns = [Analysis.date_created, Analysis.measurement_unit] + [getattr(Analysis, metric) for metric in METRICS]
+        query = select(*columns).where(Analysis.image_processed.is_(True)) \
+            .execution_options(yield_per=batch_size)
+
+        buckets: Dict[Bucket, List[float]] = defaultdict(lambda: [0, 0.0])
+        analyses = 0
+        for partition in session.execute(query).mappings().partitions():
+            for row in rollup_rows(dict(mapping) for mapping in partition):
+                bucket = buckets[tuple(row[column] for column in BUCKET_COLUMNS)]
+                bucket[0] += row['count']
+                bucket[1] += row['total']
+            analyses += len(partition)
+
+        rows = [dict(zip(BUCKET_COLUMNS, key), count=count, total=total) for key, (count, total) in buckets.items()]
+        session.execute(delete(AnalysisRollup))
+        for start in range(0, len(rows), batch_size):
+            session.execute(insert(AnalysisRollup), rows[start:start + batch_size])
+        session.commit()
+        logger.info("Rebuilt %s rollup rows from %s analyses", len(rows), analyses)
+        return analyses, len(rows)
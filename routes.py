@@ -1,20 +1,39 @@
 import os
+import json
+import time
 import uuid
+import mimetypes
+import zipfile
+from concurrent.futures import as_completed
 from datetime import datetime
 import logging
 
-from flask import request, jsonify, render_template, redirect, url_for, flash, send_from_directory
+from flask import request, jsonify, render_template, redirect, url_for, flash, send_file, make_response, \
+    Response, stream_with_context, abort
+from sqlalchemy import insert, update, inspect as sa_inspect
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 import cv2
 import numpy as np
 import base64
+import hashlib
 
-from app import app, db
-from models import Analysis
-from image_processor import ThreadCounter
+from app import app, db, job_queue, storage, live_sessions, aggregate_rollups
+from models import Analysis, AnalysisRegion, UploadSession, IMAGE_HASH_COLUMNS, STATUS_QUEUED, STATUS_RUNNING, STATUS_COMPLETED, STATUS_FAILED
+from image_processor import ThreadCounter, ImagePipeline, MODES
+from visualizations import store_visualization, copy_visualization, get_visualization, get_overlay
+from jobs import run_analysis
+from queries import QueryError, history_page, aggregate_buckets, export_query, export_batches, \
+    find_exact_duplicate, flag_near_duplicate
+from dedup import content_hash, perceptual_hash
+from metrics import REGISTRY, UPLOAD_BYTES, IMAGES_PROCESSED, ANALYSIS_FAILURES, stage_timer, record_analysis
+from chunked_upload import partial_path, received_bytes, write_chunk, file_sha256
+from live import frame_extension
+from regions import parse_regions, dump_regions
+from export import EXPORT_FORMATS, EXPORT_COMPRESSIONS, available_formats, export_chunks
+from derivatives import DERIVATIVE_SIZES, OVERLAY_FORMATS, derivative_filename, create_derivatives, create_overlay_preview
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Configure allowed file extensions
@@ -24,6 +43,170 @@ def allowed_file(filename):
     """Check if the uploaded file has an allowed extension"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_batch_uploads(uploads, batch_id):
+    """
+    Save the images of a batch upload, expanding zip archives
+    
+    Args:
+        uploads: Uploaded files (images or zip archives of images)
+        batch_id: Unique ID shared by every file in the batch
+        
+    Returns:
+        List of (original_filename, unique_filename) tuples for the saved images
+        
+    Raises:
+        ValueError: If the batch has too many images or an entry is too large; the
+            images saved so far are deleted again
+    """
+    saved = []
+    max_files = app.config['BATCH_MAX_FILES']
+    too_many = f"A batch may contain at most {max_files} images"
+    
+    def next_filename(original_filename):
+        extension = original_filename.rsplit('.', 1)[1].lower()
+        return f"{batch_id}-{len(saved)}.{extension}"
+    
+    try:
+        for upload in uploads:
+            if upload.filename.lower().endswith('.zip'):
+                with zipfile.ZipFile(upload.stream) as archive:
+                    entries = []
+                    for info in archive.infolist():
+                        original_filename = secure_filename(os.path.basename(info.filename))
+                        if info.is_dir() or not allowed_file(original_filename):
+                            continue
+                        # Guard against zip bombs: no entry may exceed the single-upload limit
+                        if info.file_size > app.config['MAX_CONTENT_LENGTH']:
+                            raise ValueError(f"{info.filename} is too large")
+                        entries.append((info, original_filename))
+                    
+                    # Count the archive's images before extracting any of them
+                    if len(saved) + len(entries) > max_files:
+                        raise ValueError(too_many)
+                    for info, original_filename in entries:
+                        unique_filename = next_filename(original_filename)
+                        with archive.open(info) as src:
+                            storage.write_stream(unique_filename, src)
+                        saved.append((original_filename, unique_filename))
+            elif upload.filename and allowed_file(upload.filename):
+                if len(saved) >= max_files:
+                    raise ValueError(too_many)
+                original_filename = secure_filename(upload.filename)
+                unique_filename = next_filename(original_filename)
+                storage.write_stream(unique_filename, upload.stream)
+                saved.append((original_filename, unique_filename))
+    except (ValueError, zipfile.BadZipFile):
+        # Rejected batches leave no files behind
+        for _, unique_filename in saved:
+            storage.delete(unique_filename)
+        raise
+    
+    return saved
+
+def request_flag(name, default):
+    """Boolean request parameter, falling back to a default when absent"""
+    value = request.values.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+def wants_async():
+    """Whether the client asked for the analysis to run in the background job queue"""
+    return request_flag('async', app.config['ASYNC_ANALYSIS'])
+
+def wants_near_duplicate_reuse():
+    """Whether a near-identical earlier analysis may answer this upload instead of processing it"""
+    return request_flag('reuse_near_duplicate', app.config['REUSE_NEAR_DUPLICATES'])
+
+def wants_inline_visualization():
+    """Whether the client still expects the visualization inline as base64 next to its URL"""
+    return request_flag('inline_visualization', app.config['INLINE_VISUALIZATION'])
+
+def visualization_fields(analysis, visualization=None):
+    """
+    Link to the overlay image of an analysis, plus the legacy base64 copy
+    under 'visual_result' when the client opted in to it; archived analyses have neither
+    """
+    if analysis.archived_at is not None:
+        return {'visualization_url': None}
+    fields = {'visualization_url': url_for('api_result_overlay', analysis_id=analysis.id, fmt='jpg')}
+    if wants_inline_visualization():
+        if visualization is None:
+            visualization = get_visualization(analysis).data
+        fields['visual_result'] = base64.b64encode(visualization).decode('utf-8')
+    return fields
+
+def request_regions(params):
+    """
+    Regions of interest asked for with the 'regions' parameter: 'auto' to find the swatches
+    in the image, or a JSON list of [x, y, width, height] boxes or {"x", "y", "width",
+    "height", "label"} objects in pixels
+    
+    Returns:
+        Tuple of the parsed regions and their spec as stored with the analysis,
+        or (None, None) to analyze the whole image
+        
+    Raises:
+        ValueError: If the regions are malformed
+    """
+    value = params.get('regions')
+    if not value:
+        return None, None
+    regions = parse_regions(value)
+    return regions, dump_regions(regions)
+
+def region_fields(analysis):
+    """Per-region results of an analysis of several regions; nothing for whole-image analyses"""
+    if analysis.region_spec is None:
+        return {}
+    return {'regions': [region.to_dict() for region in analysis.regions]}
+
+def stored_results(analysis):
+    """Results of a stored analysis, in the shape returned for a freshly processed image"""
+    return {
+        'warp_count': analysis.warp_count,
+        'weft_count': analysis.weft_count,
+        'thread_density': analysis.thread_density,
+        'confidence_score': analysis.confidence_score,
+        'skew_angle': analysis.skew_angle,
+        'measurement_unit': analysis.measurement_unit,
+        'mode': analysis.processing_mode,
+        **region_fields(analysis),
+        **visualization_fields(analysis)
+    }
+
+def job_accepted(analysis):
+    """202 response pointing the client at the status endpoint of a queued job"""
+    status_url = url_for('api_job_status', job_id=analysis.id)
+    response = jsonify({
+        'success': True,
+        'job_id': analysis.id,
+        'analysis_id': analysis.id,
+        'status': analysis.status,
+        'status_url': status_url
+    })
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+def conditional_response(etag, last_modified, build):
+    """
+    Return 304 when the client already holds the current representation,
+    otherwise build the response and attach the cache validators
+    """
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response('', 304)
+    else:
+        response = make_response(build())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+def result_etag(analysis, artifact):
+    """ETag covering both the stored visualization and the analysis row"""
+    return hashlib.sha256(f"{artifact.digest}:{analysis.to_json()}".encode('utf-8')).hexdigest()[:32]
+
 @app.route('/')
 def index():
     """Render the home page"""
@@ -51,55 +234,136 @@ def upload_file():
         extension = original_filename.rsplit('.', 1)[1].lower()
         unique_filename = f"{unique_id}.{extension}"
         
-        # Save the file
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
+        measurement_unit = request.form.get('unit', 'cm')
+        try:
+            reference_length = float(request.form.get('reference_length', 1.0))
+        except ValueError:
+            flash('Reference length must be a number', 'danger')
+            return redirect(request.url)
+        
+        mode = request.form.get('mode', app.config['ANALYSIS_MODE'])
+        if mode not in MODES:
+            flash(f'Unknown processing mode: {mode}', 'danger')
+            return redirect(request.url)
+        
+        # The web form always waits for its result; API clients may ask for a background job
+        run_async = request.form.get('source') != 'web' and wants_async()
+        
+        # Read the upload once: it is hashed, decoded and written from the same buffer
+        image_data = file.read()
+        UPLOAD_BYTES.inc(len(image_data))
+        with stage_timer('hash'):
+            digest = content_hash(image_data)
         
-        # Create a new analysis record in the database
+        # A byte-identical image already analyzed with the same parameters needs no processing
+        duplicate = find_exact_duplicate(digest, measurement_unit, reference_length, mode)
+        if duplicate is not None:
+            logger.info("Upload %s is identical to analysis %s", original_filename, duplicate.id)
+            if request.form.get('source') == 'web':
+                flash('This image was already analyzed with the same settings; showing the earlier result.', 'info')
+                return redirect(url_for('view_result', analysis_id=duplicate.id))
+            return jsonify({
+                'success': True,
+                'analysis_id': duplicate.id,
+                'duplicate': True,
+                'results': stored_results(duplicate)
+            })
+        
+        # Queued jobs are picked up by the worker pool, which reads the upload from storage
+        if run_async:
+            storage.write(unique_filename, image_data)
+        
+        # Build the analysis record; synchronous analyses are only written once processed,
+        # so a successful upload costs a single transaction
         new_analysis = Analysis(
             filename=unique_filename,
             original_filename=original_filename,
-            image_processed=False
+            measurement_unit=measurement_unit,
+            reference_length=reference_length,
+            processing_mode=mode,
+            notes=request.form.get('notes', ''),
+            content_hash=digest,
+            image_processed=False,
+            status=STATUS_QUEUED if run_async else STATUS_RUNNING
         )
-        db.session.add(new_analysis)
-        db.session.commit()
+        if run_async:
+            db.session.add(new_analysis)
+            db.session.commit()
+            job_queue.submit(new_analysis.id)
+            return job_accepted(new_analysis)
         
         # Process the image
         try:
-            measurement_unit = request.form.get('unit', 'cm')
-            reference_length = float(request.form.get('reference_length', 1.0))
+            # Decode straight from the uploaded buffer, then store the original only
+            # once it is known to be a readable image
+            with stage_timer('decode'):
+                pipeline = ImagePipeline.from_bytes(image_data, original_filename)
+            with stage_timer('write_upload'):
+                storage.write(unique_filename, image_data)
+            del image_data
+            with stage_timer('derivatives'):
+                create_derivatives(storage, unique_filename, pipeline.image)
+            
+            # Flag a near-identical earlier image, and take over its result when allowed
+            with stage_timer('hash'):
+                new_analysis.set_image_hashes(digest, perceptual_hash(pipeline.image))
+            near_duplicate = flag_near_duplicate(new_analysis, app.config['DUPLICATE_MAX_DISTANCE'], storage)
+            if near_duplicate is not None and wants_near_duplicate_reuse():
+                new_analysis.reuse_results(near_duplicate)
+                db.session.add(new_analysis)
+                db.session.commit()
+                logger.info("Analysis %s reuses near-identical analysis %s", new_analysis.id, near_duplicate.id)
+                copy_visualization(new_analysis, near_duplicate)
+                if request.form.get('source') == 'web':
+                    return redirect(url_for('view_result', analysis_id=new_analysis.id))
+                return jsonify({
+                    'success': True,
+                    'analysis_id': new_analysis.id,
+                    'duplicate_of_id': near_duplicate.id,
+                    'results': stored_results(new_analysis)
+                })
             
             # Initialize thread counter with the selected unit and reference length
-            counter = ThreadCounter(unit=measurement_unit, reference_length=reference_length)
+            counter = ThreadCounter(unit=measurement_unit, reference_length=reference_length, mode=mode,
+                                    overlay=app.config['OVERLAY_STYLE'], engine=app.config['ANALYSIS_ENGINE'],
+                                    deskew=app.config['DESKEW_OVERLAY'])
             
             # Analyze the image
-            results = counter.count_threads(file_path)
+            results = counter.count_threads(pipeline)
+            visualization = results.pop('visualization')
             
-            # Update the analysis record with the results
-            new_analysis.warp_count = results['warp_count']
-            new_analysis.weft_count = results['weft_count']
-            new_analysis.thread_density = results['thread_density']
-            new_analysis.confidence_score = results['confidence_score']
-            new_analysis.measurement_unit = measurement_unit
-            new_analysis.notes = request.form.get('notes', '')
-            new_analysis.image_processed = True
-            db.session.commit()
+            # Write the finished analysis in one transaction
+            new_analysis.apply_results(results)
+            with stage_timer('db_commit'):
+                db.session.add(new_analysis)
+                db.session.commit()
+            
+            # Store the visualization so result views never re-run the analysis
+            with stage_timer('store_visualization'):
+                store_visualization(new_analysis, visualization)
+            IMAGES_PROCESSED.inc(mode=mode)
             
             # If this was called from the web interface, redirect to results page
             if request.form.get('source') == 'web':
                 return redirect(url_for('view_result', analysis_id=new_analysis.id))
             
             # Otherwise return JSON result for API clients
+            results.update(visualization_fields(new_analysis, visualization))
             return jsonify({
                 'success': True,
                 'analysis_id': new_analysis.id,
+                'duplicate_of_id': new_analysis.duplicate_of_id,
                 'results': results
             })
             
         except Exception as e:
-            logger.error(f"Error processing image: {str(e)}")
-            db.session.delete(new_analysis)
-            db.session.commit()
+            logger.error("Error processing image: %s", e)
+            ANALYSIS_FAILURES.inc()
+            db.session.rollback()
+            # Only an analysis that failed after being written has a row to remove
+            if sa_inspect(new_analysis).persistent:
+                db.session.delete(new_analysis)
+                db.session.commit()
             
             if request.form.get('source') == 'web':
                 flash(f'Error processing image: {str(e)}', 'danger')
@@ -134,58 +398,140 @@ def api_analyze():
         extension = original_filename.rsplit('.', 1)[1].lower()
         unique_filename = f"{unique_id}.{extension}"
         
-        # Save the file
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
+        measurement_unit = request.form.get('unit', 'cm')
+        try:
+            reference_length = float(request.form.get('reference_length', 1.0))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Reference length must be a number'}), 400
         
-        # Create a new analysis record in the database
+        mode = request.form.get('mode', app.config['ANALYSIS_MODE'])
+        if mode not in MODES:
+            return jsonify({'success': False, 'error': f'Unknown processing mode: {mode}'}), 400
+        
+        try:
+            regions, region_spec = request_regions(request.form)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # The web form always waits for its result; API clients may ask for a background job
+        run_async = wants_async()
+        
+        # Read the upload once: it is hashed, decoded and written from the same buffer
+        image_data = file.read()
+        UPLOAD_BYTES.inc(len(image_data))
+        with stage_timer('hash'):
+            digest = content_hash(image_data)
+        
+        # A byte-identical image already analyzed with the same parameters needs no processing
+        duplicate = find_exact_duplicate(digest, measurement_unit, reference_length, mode, region_spec)
+        if duplicate is not None:
+            logger.info("Upload %s is identical to analysis %s", original_filename, duplicate.id)
+            return jsonify({
+                'success': True,
+                'analysis_id': duplicate.id,
+                'duplicate': True,
+                'results': stored_results(duplicate)
+            })
+        
+        # Queued jobs are picked up by the worker pool, which reads the upload from storage
+        if run_async:
+            storage.write(unique_filename, image_data)
+        
+        # Build the analysis record; synchronous analyses are only written once processed,
+        # so a successful upload costs a single transaction
         new_analysis = Analysis(
             filename=unique_filename,
             original_filename=original_filename,
-            image_processed=False
+            measurement_unit=measurement_unit,
+            reference_length=reference_length,
+            processing_mode=mode,
+            region_spec=region_spec,
+            notes=request.form.get('notes', ''),
+            content_hash=digest,
+            image_processed=False,
+            status=STATUS_QUEUED if run_async else STATUS_RUNNING
         )
-        db.session.add(new_analysis)
-        db.session.commit()
+        if run_async:
+            db.session.add(new_analysis)
+            db.session.commit()
+            job_queue.submit(new_analysis.id)
+            return job_accepted(new_analysis)
         
         # Process the image
         try:
-            measurement_unit = request.form.get('unit', 'cm')
-            reference_length = float(request.form.get('reference_length', 1.0))
+            # Decode straight from the uploaded buffer, then store the original only
+            # once it is known to be a readable image
+            with stage_timer('decode'):
+                pipeline = ImagePipeline.from_bytes(image_data, original_filename)
+            with stage_timer('write_upload'):
+                storage.write(unique_filename, image_data)
+            del image_data
+            with stage_timer('derivatives'):
+                create_derivatives(storage, unique_filename, pipeline.image)
+            
+            # Flag a near-identical earlier image, and take over its result when allowed
+            with stage_timer('hash'):
+                new_analysis.set_image_hashes(digest, perceptual_hash(pipeline.image))
+            near_duplicate = flag_near_duplicate(new_analysis, app.config['DUPLICATE_MAX_DISTANCE'], storage)
+            if near_duplicate is not None and wants_near_duplicate_reuse():
+                new_analysis.reuse_results(near_duplicate)
+                db.session.add(new_analysis)
+                db.session.commit()
+                logger.info("Analysis %s reuses near-identical analysis %s", new_analysis.id, near_duplicate.id)
+                copy_visualization(new_analysis, near_duplicate)
+                return jsonify({
+                    'success': True,
+                    'analysis_id': new_analysis.id,
+                    'duplicate_of_id': near_duplicate.id,
+                    'results': stored_results(new_analysis)
+                })
             
             # Initialize thread counter with the selected unit and reference length
-            counter = ThreadCounter(unit=measurement_unit, reference_length=reference_length)
+            counter = ThreadCounter(unit=measurement_unit, reference_length=reference_length, mode=mode,
+                                    overlay=app.config['OVERLAY_STYLE'], engine=app.config['ANALYSIS_ENGINE'],
+                                    deskew=app.config['DESKEW_OVERLAY'])
             
-            # Analyze the image
-            results = counter.count_threads(file_path)
+            # Analyze the image, or each of its regions
+            results = counter.count_threads(pipeline, regions)
+            visualization = results.pop('visualization')
             
-            # Update the analysis record with the results
-            new_analysis.warp_count = results['warp_count']
-            new_analysis.weft_count = results['weft_count']
-            new_analysis.thread_density = results['thread_density']
-            new_analysis.confidence_score = results['confidence_score']
-            new_analysis.measurement_unit = measurement_unit
-            new_analysis.notes = request.form.get('notes', '')
-            new_analysis.image_processed = True
-            db.session.commit()
+            # Write the finished analysis, with its regions, in one transaction
+            new_analysis.apply_results(results)
+            with stage_timer('db_commit'):
+                db.session.add(new_analysis)
+                db.session.commit()
+            
+            # Store the visualization so result views never re-run the analysis
+            with stage_timer('store_visualization'):
+                store_visualization(new_analysis, visualization)
+            IMAGES_PROCESSED.inc(mode=mode)
             
             # Return detailed results to the mobile app
             return jsonify({
                 'success': True,
                 'analysis_id': new_analysis.id,
+                'duplicate_of_id': new_analysis.duplicate_of_id,
                 'results': {
                     'warp_count': results['warp_count'],
                     'weft_count': results['weft_count'],
                     'thread_density': results['thread_density'],
                     'confidence_score': results['confidence_score'],
-                    'measurement_unit': measurement_unit,
-                    'visual_result': results['visual_result']
+                    'skew_angle': results.get('skew_angle'),
+                    'measurement_unit': results['measurement_unit'],
+                    'mode': results['mode'],
+                    **region_fields(new_analysis),
+                    **visualization_fields(new_analysis, visualization)
                 }
             })
             
         except Exception as e:
-            logger.error(f"Error processing image: {str(e)}")
-            db.session.delete(new_analysis)
-            db.session.commit()
+            logger.error("Error processing image: %s", e)
+            ANALYSIS_FAILURES.inc()
+            db.session.rollback()
+            # Only an analysis that failed after being written has a row to remove
+            if sa_inspect(new_analysis).persistent:
+                db.session.delete(new_analysis)
+                db.session.commit()
             
             return jsonify({
                 'success': False,
@@ -198,6 +544,636 @@ def api_analyze():
         'error': 'File type not allowed. Please upload a valid image file.'
     }), 400
 
+@app.route('/api/analyze/batch', methods=['POST'])
+def api_analyze_batch():
+    """
+    API endpoint for analyzing many images in one request
+    
+    Accepts several files in the 'files' field (or a zip archive of images), creates
+    all Analysis rows in one insert, fans the images out over the worker pool and
+    streams one NDJSON line per image as it finishes, followed by a summary line.
+    """
+    uploads = request.files.getlist('files') or request.files.getlist('file')
+    if not uploads:
+        return jsonify({'success': False, 'error': 'No file part'}), 400
+    
+    measurement_unit = request.form.get('unit', 'cm')
+    try:
+        reference_length = float(request.form.get('reference_length', 1.0))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Reference length must be a number'}), 400
+    
+    mode = request.form.get('mode', app.config['ANALYSIS_MODE'])
+    if mode not in MODES:
+        return jsonify({'success': False, 'error': f'Unknown processing mode: {mode}'}), 400
+    notes = request.form.get('notes', '')
+    
+    try:
+        regions, region_spec = request_regions(request.form)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    UPLOAD_BYTES.inc(request.content_length or 0)
+    
+    # One UUID for the whole batch; images are numbered within it
+    batch_id = str(uuid.uuid4())
+    try:
+        saved = save_batch_uploads(uploads, batch_id)
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    if not saved:
+        return jsonify({
+            'success': False,
+            'error': 'No valid image files. Please upload valid image files or a zip of images.'
+        }), 400
+    
+    # Create every analysis record in a single insert and commit
+    date_created = datetime.utcnow()
+    rows = [{
+        'filename': unique_filename,
+        'original_filename': original_filename,
+        'measurement_unit': measurement_unit,
+        'reference_length': reference_length,
+        'processing_mode': mode,
+        'region_spec': region_spec,
+        'notes': notes,
+        'image_processed': False,
+        'status': STATUS_RUNNING,
+        'date_created': date_created,
+        'heartbeat_at': date_created
+    } for original_filename, unique_filename in saved]
+    analysis_ids = db.session.scalars(
+        insert(Analysis).returning(Analysis.id, sort_by_parameter_order=True), rows
+    ).all()
+    db.session.commit()
+    logger.info("Analyzing batch %s with %s images", batch_id, len(rows))
+    
+    executor = job_queue.executor
+    
+    def generate():
+        # The rows are running in this process: keep their lease, or another process requeues them
+        job_queue.hold(analysis_ids)
+        futures = {}
+        for analysis_id, row in zip(analysis_ids, rows):
+            future = executor.submit(run_analysis, storage, row['filename'], measurement_unit, reference_length, mode,
+                                     app.config['OVERLAY_STYLE'], app.config['ANALYSIS_ENGINE'],
+                                     app.config['DESKEW_OVERLAY'], regions)
+            futures[future] = (analysis_id, row)
+        
+        updates = []
+        region_rows = []
+        completed = []
+        failed = []
+        
+        def collect(future):
+            """Record the outcome of one image for the bulk update, returning its NDJSON line"""
+            analysis_id, row = futures[future]
+            line = {'analysis_id': analysis_id, 'original_filename': row['original_filename']}
+            try:
+                results = future.result()
+                record_analysis(mode, results.pop('timings', {}))
+                analysis = Analysis(id=analysis_id, **row)
+                analysis.apply_results(results)
+                flag_near_duplicate(analysis, app.config['DUPLICATE_MAX_DISTANCE'], storage)
+                store_visualization(analysis, results.pop('visualization'))
+                updates.append({
+                    'id': analysis_id,
+                    'warp_count': analysis.warp_count,
+                    'weft_count': analysis.weft_count,
+                    'thread_density': analysis.thread_density,
+                    'confidence_score': analysis.confidence_score,
+                    'skew_angle': analysis.skew_angle,
+                    'duplicate_of_id': analysis.duplicate_of_id,
+                    **{column: getattr(analysis, column) for column in IMAGE_HASH_COLUMNS},
+                    'image_processed': True,
+                    'status': STATUS_COMPLETED
+                })
+                region_rows.extend({'analysis_id': analysis_id, 'position': region.position, **region.to_dict()}
+                                   for region in analysis.regions)
+                completed.append(analysis)
+                line.update({
+                    'success': True,
+                    'results': results,
+                    'result_url': url_for('api_result', analysis_id=analysis_id),
+                    'visualization_url': url_for('api_result_overlay', analysis_id=analysis_id, fmt='jpg')
+                })
+            except Exception as e:
+                logger.error("Error processing image %s in batch %s: %s", row['original_filename'], batch_id, e)
+                ANALYSIS_FAILURES.inc()
+                failed.append(analysis_id)
+                updates.append({'id': analysis_id, 'status': STATUS_FAILED, 'error': str(e)})
+                line.update({'success': False, 'error': str(e)})
+            return line
+        
+        def flush():
+            """Write the outcomes collected so far in one bulk update and commit"""
+            if not updates:
+                return
+            try:
+                db.session.execute(update(Analysis), updates)
+                if region_rows:
+                    db.session.execute(insert(AnalysisRegion), region_rows)
+                # The bulk update bypasses the session, so the rollups are told directly
+                aggregate_rollups.record(db.session, completed)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            updates.clear()
+            region_rows.clear()
+            completed.clear()
+        
+        collected = set()
+        try:
+            for future in as_completed(futures):
+                if future in collected:
+                    continue
+                # Results are committed before their lines are streamed, so every URL in a line
+                # already works; images that finished meanwhile share the commit
+                ready = [future] + [other for other in futures
+                                    if other is not future and other not in collected and other.done()]
+                collected.update(ready)
+                lines = [collect(done) for done in ready]
+                flush()
+                for line in lines:
+                    yield json.dumps(line) + '\n'
+        finally:
+            # If the client went away mid-stream, images that have not started yet are handed to
+            # the job queue; those already running or finished are collected here
+            uncollected = [future for future in futures if future not in collected]
+            pending = [futures[future][0] for future in uncollected if future.cancel()]
+            for future in uncollected:
+                if not future.cancelled():
+                    collect(future)
+            
+            try:
+                flush()
+                
+                if pending:
+                    Analysis.query.filter(Analysis.id.in_(pending)) \
+                        .update({'status': STATUS_QUEUED}, synchronize_session=False)
+                    db.session.commit()
+                    for analysis_id in pending:
+                        job_queue.submit(analysis_id)
+            finally:
+                # Rows left running by an error above are requeued once their lease runs out
+                job_queue.release(analysis_ids)
+        
+        yield json.dumps({
+            'done': True,
+            'batch_id': batch_id,
+            'count': len(rows),
+            'failed': len(failed)
+        }) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def upload_session_or_404(upload_id):
+    """Look up an upload session, answering 404 for unknown ones and 409 once finalized"""
+    session = db.session.get(UploadSession, upload_id)
+    if session is None:
+        abort(make_response(jsonify({'success': False, 'error': 'Unknown upload'}), 404))
+    if session.analysis_id is not None:
+        abort(make_response(jsonify({
+            'success': False,
+            'error': 'Upload already finalized',
+            'analysis_id': session.analysis_id
+        }), 409))
+    return session
+
+def upload_status(session, path, error=None, status_code=200):
+    """JSON response describing how much of an upload has been received"""
+    offset = received_bytes(path)
+    body = {
+        'success': error is None,
+        'upload_id': session.id,
+        'size': session.total_size,
+        'offset': offset,
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+        'upload_url': url_for('api_upload_chunk', upload_id=session.id)
+    }
+    if error is not None:
+        body['error'] = error
+    response = jsonify(body)
+    response.status_code = status_code
+    response.headers['Upload-Offset'] = str(offset)
+    return response
+
+@app.route('/api/uploads', methods=['POST'])
+def api_upload_init():
+    """
+    Start a resumable chunked upload
+    
+    For images too large for a single request, or for unreliable connections:
+    
+    1. POST /api/uploads with the filename and total size in bytes
+    2. PUT each chunk's raw bytes to /api/uploads/<id>?offset=<n>; after a
+       failure, GET /api/uploads/<id> for the offset to resume from
+    3. POST /api/uploads/<id>/finalize with the SHA-256 checksum and the
+       analysis parameters, which queues the analysis
+    """
+    params = request.get_json(silent=True) or request.values
+    original_filename = secure_filename(params.get('filename', ''))
+    if not allowed_file(original_filename):
+        return jsonify({
+            'success': False,
+            'error': 'File type not allowed. Please upload a valid image file.'
+        }), 400
+    
+    try:
+        total_size = int(params.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Size must be a number of bytes'}), 400
+    if not 0 < total_size <= app.config['CHUNKED_UPLOAD_MAX_SIZE']:
+        return jsonify({
+            'success': False,
+            'error': f"Size must be between 1 and {app.config['CHUNKED_UPLOAD_MAX_SIZE']} bytes"
+        }), 400
+    
+    session = UploadSession(id=str(uuid.uuid4()), original_filename=original_filename, total_size=total_size)
+    db.session.add(session)
+    db.session.commit()
+    
+    response = upload_status(session, partial_path(app.config['UPLOAD_FOLDER'], session.id))
+    response.status_code = 201
+    response.headers['Location'] = url_for('api_upload_chunk', upload_id=session.id)
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT'])
+def api_upload_chunk(upload_id):
+    """Report the received offset of an upload (GET), or write one chunk of it (PUT)"""
+    session = upload_session_or_404(upload_id)
+    path = partial_path(app.config['UPLOAD_FOLDER'], session.id)
+    if request.method == 'GET':
+        return upload_status(session, path)
+    
+    try:
+        offset = int(request.args.get('offset', request.headers.get('Upload-Offset', 0)))
+        if offset < 0:
+            raise ValueError(offset)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Offset must be a number of bytes'}), 400
+    
+    # The chunk goes straight from the request stream to disk
+    UPLOAD_BYTES.inc(request.content_length or 0)
+    try:
+        write_chunk(path, offset, request.stream, session.total_size)
+    except ValueError as e:
+        # The client resumes from the offset in the response
+        return upload_status(session, path, error=str(e), status_code=409)
+    
+    return upload_status(session, path)
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def api_upload_abort(upload_id):
+    """Abandon a chunked upload and discard the bytes received so far"""
+    session = upload_session_or_404(upload_id)
+    path = partial_path(app.config['UPLOAD_FOLDER'], session.id)
+    if os.path.exists(path):
+        os.remove(path)
+    db.session.delete(session)
+    db.session.commit()
+    return jsonify({'success': True})
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def api_upload_finalize(upload_id):
+    """
+    Verify a completed chunked upload and queue its analysis
+    
+    Expects the SHA-256 checksum of the whole file, plus the same unit,
+    reference_length, mode and notes parameters as /api/analyze.
+    """
+    session = upload_session_or_404(upload_id)
+    path = partial_path(app.config['UPLOAD_FOLDER'], session.id)
+    params = request.get_json(silent=True) or request.values
+    
+    measurement_unit = params.get('unit', 'cm')
+    try:
+        reference_length = float(params.get('reference_length', 1.0))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Reference length must be a number'}), 400
+    
+    mode = params.get('mode', app.config['ANALYSIS_MODE'])
+    if mode not in MODES:
+        return jsonify({'success': False, 'error': f'Unknown processing mode: {mode}'}), 400
+    
+    try:
+        _, region_spec = request_regions(params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    received = received_bytes(path)
+    if received != session.total_size:
+        return upload_status(session, path, error=f'Received {received} of {session.total_size} bytes', status_code=409)
+    
+    # The checksum is verified over the file on disk, never the whole upload in memory
+    digest = file_sha256(path)
+    if digest != str(params.get('checksum', '')).lower():
+        return jsonify({'success': False, 'error': 'Checksum mismatch', 'checksum': digest}), 422
+    
+    # A byte-identical image already analyzed with the same parameters needs no processing
+    duplicate = find_exact_duplicate(digest, measurement_unit, reference_length, mode, region_spec)
+    if duplicate is not None:
+        logger.info("Upload %s is identical to analysis %s", session.original_filename, duplicate.id)
+        os.remove(path)
+        session.analysis_id = duplicate.id
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'analysis_id': duplicate.id,
+            'duplicate': True,
+            'results': stored_results(duplicate)
+        })
+    
+    # With local storage moving the partial file into place is a rename; remote stores upload it
+    extension = session.original_filename.rsplit('.', 1)[1].lower()
+    unique_filename = f"{session.id}.{extension}"
+    storage.put_file(unique_filename, path)
+    
+    # Large images are always analyzed in the background job queue
+    new_analysis = Analysis(
+        filename=unique_filename,
+        original_filename=session.original_filename,
+        measurement_unit=measurement_unit,
+        reference_length=reference_length,
+        processing_mode=mode,
+        region_spec=region_spec,
+        notes=params.get('notes', ''),
+        content_hash=digest,
+        image_processed=False,
+        status=STATUS_QUEUED
+    )
+    db.session.add(new_analysis)
+    db.session.flush()
+    session.analysis_id = new_analysis.id
+    db.session.commit()
+    
+    job_queue.submit(new_analysis.id)
+    return job_accepted(new_analysis)
+
+@app.route('/api/jobs/<int:job_id>')
+def api_job_status(job_id):
+    """API endpoint to check the status of an analysis job, optionally long-polling with ?wait=<seconds>"""
+    analysis = Analysis.query.get_or_404(job_id)
+    
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), app.config['JOB_POLL_MAX_WAIT'])
+    except ValueError:
+        return jsonify({'success': False, 'error': 'wait must be a number of seconds'}), 400
+    
+    # Long-poll until the job leaves the queue or the wait expires
+    deadline = time.monotonic() + wait
+    while analysis.status in (STATUS_QUEUED, STATUS_RUNNING):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        job_queue.wait(job_id, min(remaining, 1.0))
+        db.session.refresh(analysis)
+    
+    response = {
+        'success': True,
+        'job_id': analysis.id,
+        'status': analysis.status,
+        'analysis': {**analysis.to_dict(), **region_fields(analysis)}
+    }
+    if analysis.status == STATUS_COMPLETED:
+        response['result_url'] = url_for('api_result', analysis_id=analysis.id)
+    elif analysis.status == STATUS_FAILED:
+        response['error'] = analysis.error
+    
+    return jsonify(response)
+
+def live_session_or_404(session_id):
+    """Look up an open live session, answering 404 for unknown or expired ones"""
+    session = live_sessions.get(session_id)
+    if session is None:
+        abort(make_response(jsonify({'success': False, 'error': 'Unknown or expired live session'}), 404))
+    return session
+
+def live_frame_update(session, data):
+    """
+    Measure one frame of a live session
+    
+    Returns:
+        Tuple of the JSON body and the HTTP status code
+    """
+    if len(data) > app.config['LIVE_MAX_FRAME_BYTES']:
+        return {'success': False, 'error': f"Frames are limited to {app.config['LIVE_MAX_FRAME_BYTES']} bytes"}, 413
+    if frame_extension(data) is None:
+        return {'success': False, 'error': 'Frames must be JPEG or PNG images'}, 415
+    
+    try:
+        with session.lock, stage_timer('live_frame'):
+            if session.analysis_id is not None:
+                return {'success': False, 'error': 'Live session already locked',
+                        'analysis_id': session.analysis_id}, 409
+            update = session.add_frame(data)
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}, 400
+    return {'success': True, 'session_id': session.id, **update}, 200
+
+def lock_live_session(session, notes=''):
+    """
+    Store the last frame of a live session as an analysis with its smoothed counts, and close the session
+    
+    This is the only point at which a live session writes anything: the frame,
+    its derivatives and visualization, and a single analysis row. A lock request
+    that arrives while another one is storing the session waits for it and is
+    then answered 409, so a session is stored at most once.
+    
+    Returns:
+        Tuple of the JSON body and the HTTP status code
+    """
+    with session.lock:
+        if session.analysis_id is not None:
+            return {'success': False, 'error': 'Live session already locked',
+                    'analysis_id': session.analysis_id}, 409
+        if session.results is None:
+            return {'success': False, 'error': 'No frame has been analyzed yet'}, 409
+        
+        data = session.last_frame
+        results = dict(session.results)
+        extension = frame_extension(data)
+        unique_filename = f"{uuid.uuid4()}.{extension}"
+        
+        new_analysis = Analysis(
+            filename=unique_filename,
+            original_filename=f"live-{session.id}.{extension}",
+            measurement_unit=session.counter.unit,
+            reference_length=session.counter.reference_length,
+            processing_mode=session.counter.mode,
+            notes=notes,
+            image_processed=False,
+            status=STATUS_RUNNING
+        )
+        try:
+            # The kept frame is stored as received, not as downscaled for measuring
+            with stage_timer('decode'):
+                pipeline = ImagePipeline.from_bytes(data, new_analysis.original_filename)
+            with stage_timer('write_upload'):
+                storage.write(unique_filename, data)
+            with stage_timer('derivatives'):
+                create_derivatives(storage, unique_filename, pipeline.image)
+            with stage_timer('hash'):
+                new_analysis.set_image_hashes(content_hash(data), perceptual_hash(pipeline.image))
+            flag_near_duplicate(new_analysis, app.config['DUPLICATE_MAX_DISTANCE'], storage)
+            
+            visualization = session.render(pipeline)
+            pipeline.release()
+            
+            # Write the finished analysis in one transaction
+            new_analysis.apply_results(results)
+            with stage_timer('db_commit'):
+                db.session.add(new_analysis)
+                db.session.commit()
+            with stage_timer('store_visualization'):
+                store_visualization(new_analysis, visualization)
+            IMAGES_PROCESSED.inc(mode=new_analysis.processing_mode)
+        except Exception as e:
+            logger.error("Error storing live session %s: %s", session.id, e)
+            ANALYSIS_FAILURES.inc()
+            db.session.rollback()
+            if sa_inspect(new_analysis).persistent:
+                db.session.delete(new_analysis)
+                db.session.commit()
+            return {'success': False, 'error': str(e)}, 500
+        
+        session.analysis_id = new_analysis.id
+        live_sessions.close(session.id)
+    
+    logger.info("Live session %s locked as analysis %s after %s frames", session.id, new_analysis.id, session.frames)
+    return {
+        'success': True,
+        'analysis_id': new_analysis.id,
+        'duplicate_of_id': new_analysis.duplicate_of_id,
+        'frames': session.frames,
+        'results': {
+            'warp_count': results['warp_count'],
+            'weft_count': results['weft_count'],
+            'thread_density': results['thread_density'],
+            'confidence_score': results['confidence_score'],
+            'skew_angle': results['skew_angle'],
+            'measurement_unit': results['measurement_unit'],
+            'mode': results['mode'],
+            **visualization_fields(new_analysis, visualization)
+        }
+    }, 201
+
+@app.route('/api/live', methods=['POST'])
+def api_live_start():
+    """
+    Start a live analysis session
+    
+    For counting while the camera is held over the fabric instead of uploading
+    one photo after another:
+    
+    1. POST /api/live with the unit, reference length and mode
+    2. Send low-resolution JPEG or PNG frames, as binary messages on the
+       WebSocket at socket_url or as the body of a POST to frame_url each;
+       every frame is answered with the counts smoothed over the frames so far
+       and whether they are stable
+    3. Lock the result once it is stable, with {"action": "lock"} on the
+       WebSocket or a POST to lock_url, which stores the last frame as an analysis
+    
+    Nothing is stored before the lock; abandoned sessions expire after LIVE_SESSION_TTL seconds.
+    """
+    params = request.get_json(silent=True) or request.values
+    measurement_unit = params.get('unit', 'cm')
+    try:
+        reference_length = float(params.get('reference_length', 1.0))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Reference length must be a number'}), 400
+    
+    mode = params.get('mode', app.config['ANALYSIS_MODE'])
+    if mode not in MODES:
+        return jsonify({'success': False, 'error': f'Unknown processing mode: {mode}'}), 400
+    
+    counter = ThreadCounter(unit=measurement_unit, reference_length=reference_length, mode=mode,
+                            overlay=app.config['OVERLAY_STYLE'], engine=app.config['ANALYSIS_ENGINE'],
+                            deskew=app.config['DESKEW_OVERLAY'])
+    session = live_sessions.create(counter)
+    if session is None:
+        return jsonify({'success': False, 'error': 'Too many live sessions are open, try again later'}), 503
+    
+    socket_url = None
+    if live_sessions.sock is not None:
+        socket_url = url_for('api_live_socket', session_id=session.id, _external=True).replace('http', 'ws', 1)
+    response = jsonify({
+        'success': True,
+        'session_id': session.id,
+        'frame_url': url_for('api_live_frame', session_id=session.id),
+        'lock_url': url_for('api_live_lock', session_id=session.id),
+        'socket_url': socket_url,
+        'frame_size': app.config['LIVE_FRAME_SIZE'],
+        'max_frame_bytes': app.config['LIVE_MAX_FRAME_BYTES'],
+        'session_ttl': app.config['LIVE_SESSION_TTL']
+    })
+    response.status_code = 201
+    return response
+
+@app.route('/api/live/<session_id>/frames', methods=['POST'])
+def api_live_frame(session_id):
+    """Measure one frame, sent as the raw request body or as the 'frame' field of a form"""
+    session = live_session_or_404(session_id)
+    frame = request.files.get('frame')
+    body, status_code = live_frame_update(session, frame.read() if frame else request.get_data())
+    return jsonify(body), status_code
+
+@app.route('/api/live/<session_id>/lock', methods=['POST'])
+def api_live_lock(session_id):
+    """Store the current result of a live session as an analysis"""
+    session = live_session_or_404(session_id)
+    params = request.get_json(silent=True) or request.values
+    body, status_code = lock_live_session(session, params.get('notes', ''))
+    return jsonify(body), status_code
+
+@app.route('/api/live/<session_id>', methods=['DELETE'])
+def api_live_close(session_id):
+    """Abandon a live session without storing anything"""
+    if not live_sessions.close(session_id):
+        return jsonify({'success': False, 'error': 'Unknown or expired live session'}), 404
+    return jsonify({'success': True})
+
+if live_sessions.sock is not None:
+    @live_sessions.sock.route('/api/live/<session_id>/socket')
+    def api_live_socket(ws, session_id):
+        """
+        Live session over a WebSocket: binary messages are frames, each answered with
+        the smoothed counts; text messages are JSON commands {"action": "lock" | "reset" | "close"}
+        """
+        session = live_sessions.get(session_id)
+        if session is None:
+            ws.send(json.dumps({'success': False, 'error': 'Unknown or expired live session'}))
+            return
+        
+        while True:
+            message = ws.receive()
+            if isinstance(message, (bytes, bytearray)):
+                body, _ = live_frame_update(session, bytes(message))
+                ws.send(json.dumps(body))
+                continue
+            
+            try:
+                command = json.loads(message)
+            except ValueError:
+                command = {}
+            action = command.get('action') if isinstance(command, dict) else None
+            if action == 'lock':
+                body, status_code = lock_live_session(session, command.get('notes', ''))
+                ws.send(json.dumps(body))
+                if status_code == 201:
+                    return
+            elif action == 'reset':
+                with session.lock:
+                    session.reset()
+                ws.send(json.dumps({'success': True, 'session_id': session.id, 'frame': 0}))
+            elif action == 'close':
+                live_sessions.close(session.id)
+                return
+            else:
+                ws.send(json.dumps({'success': False, 'error': 'Unknown command, expected lock, reset or close'}))
+
 @app.route('/result/<int:analysis_id>')
 def view_result(analysis_id):
     """View the results of a specific analysis"""
@@ -208,46 +1184,138 @@ def view_result(analysis_id):
         flash('Image has not been processed yet.', 'warning')
         return redirect(url_for('index'))
     
-    # Get the file path for visualization
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], analysis.filename)
+    # Archived analyses keep their counts but their images have been deleted
+    if analysis.archived_at is not None:
+        return render_template('results.html', analysis=analysis, visualization=None)
     
-    # Re-process the image to get visualization
+    # Serve the visualization stored at analysis time
     try:
-        counter = ThreadCounter(unit=analysis.measurement_unit)
-        results = counter.count_threads(file_path)
+        artifact = get_visualization(analysis)
         
-        # Get the visualization as base64
-        visualization = results['visual_result']
-        
-        return render_template(
-            'results.html', 
-            analysis=analysis, 
-            visualization=visualization
+        return conditional_response(
+            result_etag(analysis, artifact),
+            artifact.last_modified,
+            lambda: render_template(
+                'results.html', 
+                analysis=analysis, 
+                visualization=url_for('api_result_overlay', analysis_id=analysis.id, fmt='jpg')
+            )
         )
     
     except Exception as e:
-        logger.error(f"Error generating visualization: {str(e)}")
+        logger.error("Error generating visualization: %s", e)
         flash(f'Error generating visualization: {str(e)}', 'danger')
         return redirect(url_for('index'))
 
 @app.route('/history')
 def history():
-    """View history of previous analyses"""
-    analyses = Analysis.query.filter_by(image_processed=True).order_by(Analysis.date_created.desc()).all()
-    return render_template('history.html', analyses=analyses)
+    """View history of previous analyses, one page at a time"""
+    try:
+        analyses, next_cursor, _ = history_page(request.args)
+    except QueryError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('history'))
+    # The next page keeps the active filters
+    page_args = {name: value for name, value in request.args.items() if name != 'cursor'}
+    return render_template('history.html', analyses=analyses, next_cursor=next_cursor, page_args=page_args)
 
 @app.route('/api/history')
 def api_history():
-    """API endpoint to get history of analyses for mobile app"""
-    analyses = Analysis.query.filter_by(image_processed=True).order_by(Analysis.date_created.desc()).all()
-    results = [analysis.to_dict() for analysis in analyses]
+    """
+    API endpoint to get history of analyses for mobile app
+    
+    Results are paginated newest first: pass the returned next_cursor as ?cursor=
+    to fetch the following page. Supports limit, fields (comma-separated subset of
+    the analysis fields) and the unit, min_warp, max_warp, min_weft, max_weft,
+    since and until filters.
+    """
+    try:
+        analyses, next_cursor, fields = history_page(request.args)
+    except QueryError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    include_thumbnail = fields is None or 'thumbnail_url' in fields
+    model_fields = None if fields is None else [field for field in fields if field != 'thumbnail_url']
+    results = []
+    for analysis in analyses:
+        result = analysis.to_dict(model_fields)
+        if include_thumbnail:
+            result['thumbnail_url'] = None if analysis.archived_at is not None else \
+                url_for('uploaded_derivative', filename=analysis.filename, size='thumb')
+        results.append(result)
     
     return jsonify({
         'success': True,
         'count': len(results),
-        'analyses': results
+        'analyses': results,
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/aggregates')
+def api_aggregates():
+    """
+    API endpoint for dashboard statistics of processed analyses
+    
+    Returns the count, mean and percentiles of warp_count, weft_count,
+    thread_density and confidence_score per bucket, read from the daily rollups
+    rather than the analyses. Supports group_by (comma-separated: day or week,
+    and/or unit; default day,unit), percentiles (default 50,90,95) and the
+    unit, since and until filters.
+    """
+    try:
+        buckets, group_by, percentiles = aggregate_buckets(request.args)
+    except QueryError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    return jsonify({
+        'success': True,
+        'group_by': group_by,
+        'percentiles': percentiles,
+        'count': len(buckets),
+        'buckets': buckets
     })
 
+@app.route('/api/export')
+def api_export():
+    """
+    API endpoint streaming the processed analyses as a file, e.g. for an audit
+    
+    Rows are written oldest first as they are read from the database, so memory
+    stays flat whatever the number of analyses. Supports format (csv, ndjson,
+    and arrow or parquet when pyarrow is installed; default csv), compression
+    (gzip), fields and the unit, min_warp, max_warp, min_weft, max_weft, since
+    and until filters of the history API.
+    """
+    fmt = request.args.get('format', 'csv').lower()
+    compression = request.args.get('compression', '').lower() or None
+    try:
+        if fmt not in available_formats():
+            raise QueryError(f"format must be one of: {', '.join(available_formats())}")
+        if compression is not None and compression not in EXPORT_COMPRESSIONS:
+            raise QueryError(f"compression must be one of: {', '.join(EXPORT_COMPRESSIONS)}")
+        query, fields = export_query(request.args)
+    except QueryError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    extension, mimetype = EXPORT_FORMATS[fmt]
+    if compression is not None:
+        suffix, mimetype = EXPORT_COMPRESSIONS[compression]
+        extension = f'{extension}.{suffix}'
+    filename = f"threadcounty-export-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.{extension}"
+    
+    batches = export_batches(query, app.config['EXPORT_BATCH_SIZE'])
+    return Response(stream_with_context(export_chunks(fields, batches, fmt, compression)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 @app.route('/api/result/<int:analysis_id>')
 def api_result(analysis_id):
     """API endpoint to get a specific analysis result for mobile app"""
@@ -260,32 +1328,162 @@ def api_result(analysis_id):
             'error': 'Image has not been processed yet.'
         }), 400
     
-    # Get the file path for visualization
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], analysis.filename)
+    # Archived analyses keep their counts but their images have been deleted
+    if analysis.archived_at is not None:
+        return jsonify(result_payload(analysis, None))
     
-    # Re-process the image to get visualization
+    # Serve the visualization stored at analysis time
     try:
-        counter = ThreadCounter(unit=analysis.measurement_unit)
-        results = counter.count_threads(file_path)
+        artifact = get_visualization(analysis)
         
         # Return the detailed result for the mobile app
+        return conditional_response(
+            result_etag(analysis, artifact),
+            artifact.last_modified,
+            lambda: jsonify(result_payload(analysis, artifact))
+        )
+    
+    except Exception as e:
+        logger.error("Error generating visualization: %s", e)
         return jsonify({
-            'success': True,
-            'analysis': analysis.to_dict(),
-            'visualization': results['visual_result']
-        })
+            'success': False,
+            'error': f'Error generating visualization: {str(e)}'
+        }), 500
+
+def result_payload(analysis, artifact):
+    """
+    Body of /api/result, with the base64 visualization only for clients that opted in;
+    archived analyses (artifact is None) have no visualization
+    """
+    payload = {
+        'success': True,
+        'analysis': {**analysis.to_dict(), **region_fields(analysis)},
+        'visualization_url': None
+    }
+    if artifact is None:
+        return payload
+    payload['visualization_url'] = url_for('api_result_overlay', analysis_id=analysis.id, fmt='jpg')
+    if wants_inline_visualization():
+        payload['visualization'] = base64.b64encode(artifact.data).decode('utf-8')
+    return payload
+
+@app.route('/api/result/<int:analysis_id>/overlay.<fmt>')
+def api_result_overlay(analysis_id, fmt):
+    """
+    Serve the visualization of an analysis as an image
+    
+    Supports ?quality= (1-100) and ?size= (longest side in pixels, never upscaled),
+    both snapped to the nearest supported step; without them the JPEG stored at analysis time is returned byte for byte.
+    Responses carry an ETag and Last-Modified for conditional requests.
+    """
+    if fmt not in OVERLAY_FORMATS:
+        return jsonify({'success': False, 'error': f'Unknown format: {fmt}'}), 404
+    
+    analysis = Analysis.query.get_or_404(analysis_id)
+    if not analysis.image_processed:
+        return jsonify({
+            'success': False,
+            'error': 'Image has not been processed yet.'
+        }), 400
+    if analysis.archived_at is not None:
+        return jsonify({
+            'success': False,
+            'error': 'The images of this analysis have been deleted by the retention policy.'
+        }), 410
     
+    quality = request.args.get('quality')
+    max_side = request.args.get('size')
+    if quality is not None and not (quality.isdigit() and 1 <= int(quality) <= 100):
+        return jsonify({'success': False, 'error': 'quality must be a number from 1 to 100'}), 400
+    if max_side is not None and not (max_side.isdigit() and int(max_side) > 0):
+        return jsonify({'success': False, 'error': 'size must be a positive number of pixels'}), 400
+    quality = int(quality) if quality is not None else None
+    max_side = int(max_side) if max_side is not None else None
+    
+    try:
+        artifact = get_overlay(analysis, fmt, quality, max_side)
     except Exception as e:
-        logger.error(f"Error generating visualization: {str(e)}")
+        logger.error("Error generating visualization: %s", e)
         return jsonify({
             'success': False,
             'error': f'Error generating visualization: {str(e)}'
         }), 500
+    
+    response = conditional_response(
+        artifact.digest[:32],
+        artifact.last_modified,
+        lambda: Response(artifact.data, mimetype=OVERLAY_FORMATS[fmt][2])
+    )
+    response.cache_control.public = True
+    return response
+
+def send_stored(name, max_age=None):
+    """
+    Serve a file from upload storage, with conditional and range request support
+    
+    Local files are sent straight from disk. Remote ones are streamed through the
+    storage's range cache, so a range request only fetches the blocks it covers.
+    Missing files and names storage rejects (e.g. empty ones) are a 404.
+    """
+    try:
+        path = storage.local_path(name)
+        if path is not None:
+            return send_file(path, max_age=max_age)
+        size = storage.size(name)
+    except (FileNotFoundError, ValueError):
+        abort(make_response(jsonify({'success': False, 'error': 'File not found'}), 404))
+    
+    response = Response(wrap_file(request.environ, storage.open(name)), direct_passthrough=True,
+                        mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+    response.content_length = size
+    # Stored files are never modified in place, so the name identifies the content
+    response.set_etag(hashlib.sha256(f"{name}:{size}".encode('utf-8')).hexdigest()[:32])
+    if max_age is not None:
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded files"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_stored(secure_filename(filename))
+
+@app.route('/uploads/<filename>/<size>')
+def uploaded_derivative(filename, size):
+    """Serve a thumbnail, medium preview or overlay preview of an uploaded file"""
+    if size not in DERIVATIVE_SIZES and size != 'overlay':
+        return jsonify({'success': False, 'error': f'Unknown size: {size}'}), 404
+    
+    filename = secure_filename(filename)
+    
+    # Uploads from before derivatives existed get theirs generated on first request;
+    # send_stored answers 404 when neither the derivative nor the upload exists
+    try:
+        generate = not storage.exists(derivative_filename(filename, size)) and storage.exists(filename)
+    except ValueError:
+        abort(make_response(jsonify({'success': False, 'error': 'File not found'}), 404))
+    if generate:
+        try:
+            if size == 'overlay':
+                analysis = Analysis.query.filter_by(filename=filename, image_processed=True).first_or_404()
+                create_overlay_preview(storage, filename, get_visualization(analysis).data)
+            else:
+                create_derivatives(storage, filename)
+        except ValueError as e:
+            logger.error("Error creating derivative: %s", e)
+            return jsonify({'success': False, 'error': str(e)}), 500
+    
+    # Thumbnails and previews of an upload never change, so clients may cache them forever;
+    # the overlay is re-rendered when the visualization changes and must be revalidated
+    immutable = size != 'overlay'
+    response = send_stored(derivative_filename(filename, size), max_age=365 * 24 * 60 * 60 if immutable else None)
+    response.cache_control.public = True
+    response.cache_control.immutable = immutable
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Metrics of this process in the Prometheus text format"""
+    return Response(REGISTRY.render(), content_type=REGISTRY.CONTENT_TYPE)
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -0,0 +1,496 @@
+import io
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import time
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # pragma: no cover - only needed for STORAGE_BACKEND=s3
+    boto3 = None
+    ClientError = None
+
+logger = logging.getLogger(__name__)
+
+# Storage backends selectable with STORAGE_BACKEND
+BACKENDS = ('local', 's3')
+
+# Bytes copied per read when streaming into or out of storage
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def shard_prefix(name: str, depth: int = 2) -> str:
+    """
+    Subdirectory of a stored file: `depth` levels of two hex digits of the SHA-256 of its name
+
+    Hashing the name rather than taking its first characters spreads uploads
+    that share a prefix (e.g. the files of one batch) evenly over the shards.
+    """
+    digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+    return '/'.join(digest[2 * level:2 * level + 2] for level in range(depth))
+
+def _check_name(name: str) -> str:
+    """Stored names are flat file names; anything that could escape the storage root is rejected"""
+    if not name or '/' in name or '\\' in name or name in ('.', '..'):
+        raise ValueError(f"Invalid storage name: {name!r}")
+    return name
+
+class Storage:
+    """
+    Where uploads and their derivatives live
+
+    Files are addressed by their flat name (e.g. ``<uuid>.jpg``); where they
+    actually sit is up to the backend. Written files are never modified, only
+    replaced whole or deleted, which lets remote backends cache freely.
+    """
+
+    def open(self, name: str) -> BinaryIO:
+        """
+        Open a stored file for streamed, seekable reading
+
+        Raises:
+            FileNotFoundError: If nothing is stored under the name
+        """
+        raise NotImplementedError
+
+    def read(self, name: str) -> bytes:
+        """Read a whole stored file"""
+        with self.open(name) as f:
+            return f.read()
+
+    def size(self, name: str) -> int:
+        """Size of a stored file in bytes"""
+        raise NotImplementedError
+
+    def exists(self, name: str) -> bool:
+        """Whether a file is stored under the name"""
+        raise NotImplementedError
+
+    def write(self, name: str, data: bytes) -> None:
+        """Store a file, replacing any previous one atomically"""
+        self.write_stream(name, io.BytesIO(data))
+
+    def write_stream(self, name: str, stream: BinaryIO) -> None:
+        """Store a file from a readable stream without holding it in memory"""
+        raise NotImplementedError
+
+    def put_file(self, name: str, path: str) -> None:
+        """Move a local file into storage; the local file is gone afterwards"""
+        with open(path, 'rb') as f:
+            self.write_stream(name, f)
+        os.remove(path)
+
+    def delete(self, name: str) -> bool:
+        """Delete a stored file, returning whether it existed"""
+        raise NotImplementedError
+
+    def names(self) -> Iterator[str]:
+        """Names of every stored file, in no particular order"""
+        raise NotImplementedError
+
+    def local_path(self, name: str) -> Optional[str]:
+        """Path of the file on the local filesystem, or None if the backend has no such path"""
+        return None
+
+class LocalStorage(Storage):
+    """
+    Files on the local filesystem, sharded into hash-prefix subdirectories
+
+    With the default depth of 2 a file lives in ``<root>/ab/cd/<name>``, so even
+    millions of uploads leave each directory with a few dozen entries. Files
+    from before sharding, still directly in the root, are read and deleted in
+    place until ``flask migrate-uploads`` moves them.
+    """
+
+    def __init__(self, root: str, depth: int = 2):
+        self.root = root
+        self.depth = depth
+
+    def path(self, name: str) -> str:
+        """Sharded path of a stored file"""
+        return os.path.join(self.root, *shard_prefix(_check_name(name), self.depth).split('/'), name)
+
+    def _existing_path(self, name: str) -> str:
+        path = self.path(name)
+        if os.path.exists(path):
+            return path
+        legacy_path = os.path.join(self.root, name)
+        if os.path.isfile(legacy_path):
+            return legacy_path
+        raise FileNotFoundError(f"Not in storage: {name}")
+
+    def open(self, name: str) -> BinaryIO:
+        return open(self._existing_path(name), 'rb')
+
+    def size(self, name: str) -> int:
+        return os.path.getsize(self._existing_path(name))
+
+    def exists(self, name: str) -> bool:
+        try:
+            self._existing_path(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def write_stream(self, name: str, stream: BinaryIO) -> None:
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, path)
+
+    def put_file(self, name: str, path: str) -> None:
+        # A rename when the file is on the same filesystem, a copy otherwise
+        target = self.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(path, target)
+
+    def delete(self, name: str) -> bool:
+        deleted = False
+        for path in (self.path(name), os.path.join(self.root, name)):
+            try:
+                os.remove(path)
+                deleted = True
+            except (FileNotFoundError, IsADirectoryError):
+                pass
+        return deleted
+
+    def names(self) -> Iterator[str]:
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            relative = os.path.relpath(dirpath, self.root)
+            depth = 0 if relative == '.' else relative.count(os.sep) + 1
+            if depth == 0:
+                # Only shard directories hold stored files; skip e.g. partial uploads
+                dirnames[:] = [d for d in dirnames if len(d) == 2]
+            for filename in filenames:
+                if (depth == self.depth or depth == 0) and not filename.endswith('.tmp'):
+                    yield filename
+
+    def local_path(self, name: str) -> Optional[str]:
+        try:
+            return self._existing_path(name)
+        except FileNotFoundError:
+            return None
+
+class RangeCache:
+    """
+    Local disk cache of fixed-size blocks of remote files
+
+    Block ``i`` of a file holds bytes ``[i * block_size, (i + 1) * block_size)``
+    and is kept as ``<root>/<shard>/<name>/<etag>/<i>``, next to a ``size`` file
+    with the total length and ETag of the version last seen in the store, so
+    repeat reads on a node touch neither the network nor the object store, and
+    blocks of different versions of a file never mix. When the cache grows past
+    max_bytes the least recently used blocks are evicted; several processes may
+    share one cache directory.
+    """
+
+    def __init__(self, root: str, max_bytes: int, block_size: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _dir(self, name: str) -> str:
+        return os.path.join(self.root, *shard_prefix(name).split('/'), name)
+
+    def _block_path(self, name: str, etag: str, index: int) -> str:
+        return os.path.join(self._dir(name), etag, str(index))
+
+    def get_meta(self, name: str) -> Optional[Tuple[int, str, float]]:
+        """Cached size and ETag of a file, with the time they were last checked against the store"""
+        path = os.path.join(self._dir(name), 'size')
+        try:
+            with open(path) as f:
+                size, etag = f.read().split()
+            return int(size), etag, os.stat(path).st_mtime
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put_meta(self, name: str, size: int, etag: str) -> None:
+        self._write(os.path.join(self._dir(name), 'size'), f"{size} {etag}".encode('ascii'))
+
+    def get_block(self, name: str, etag: str, index: int) -> Optional[bytes]:
+        path = self._block_path(name, etag, index)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def has_block(self, name: str, etag: str, index: int) -> bool:
+        return os.path.exists(self._block_path(name, etag, index))
+
+    def put_block(self, name: str, etag: str, index: int, data: bytes) -> None:
+        self._write(self._block_path(name, etag, index), data)
+        with self._lock:
+            self._written += len(data)
+            # Only rescan the cache after writing a tenth of its budget
+            due = self._written >= self.max_bytes // 10
+            if due:
+                self._written = 0
+        if due:
+            self.evict()
+
+    def invalidate(self, name: str) -> None:
+        shutil.rmtree(self._dir(name), ignore_errors=True)
+
+    def evict(self) -> None:
+        """Delete the least recently used blocks until the cache fits in max_bytes"""
+        blocks = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename == 'size' or filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blocks.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        for _, size, path in sorted(blocks):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+class _RemoteReader(io.RawIOBase):
+    """Seekable reader over a remote file that fetches blocks through the range cache on demand"""
+
+    def __init__(self, storage: 'S3Storage', name: str, size: int, etag: str):
+        self.storage = storage
+        self.name = name
+        self.length = size
+        self.etag = etag
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.length:
+            return 0
+        block_size = self.storage.cache.block_size
+        index, skip = divmod(self.position, block_size)
+        block = self.storage.block(self.name, self.etag, index, self.length)
+        count = min(len(buffer), len(block) - skip)
+        buffer[:count] = block[skip:skip + count]
+        self.position += count
+        return count
+
+class S3Storage(Storage):
+    """
+    Files in an S3-compatible object store (AWS S3, MinIO, ...)
+
+    Every web node and analysis worker reads the same bucket, so none of them
+    needs a shared filesystem. Reads are streamed in STORAGE_BLOCK_SIZE ranges
+    that are kept in a local RangeCache, and a cache miss fetches up to
+    READAHEAD_BLOCKS missing blocks in one request, so reading a whole image
+    costs about one GET. Objects are keyed ``<prefix><shard>/<name>``, sharded
+    like the local backend to spread load over the store's key partitions.
+
+    Other nodes may delete or rewrite an object (retention, derivative
+    backfills), so the cached size and ETag are checked with a HEAD once they
+    are revalidate_seconds old, and ranges are only fetched If-Match the ETag
+    the reader opened, so a read never stitches together two versions.
+    """
+
+    READAHEAD_BLOCKS = 8
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, cache: Optional[RangeCache] = None,
+                 revalidate_seconds: float = 5.0):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires the boto3 package")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.cache = cache
+        self.revalidate_seconds = revalidate_seconds
+        self._client = None
+
+    def __getstate__(self):
+        # Clients cannot be pickled; each worker process creates its own
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region)
+        return self._client
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}{shard_prefix(_check_name(name))}/{name}"
+
+    def _missing(self, error) -> bool:
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _meta(self, name: str) -> Tuple[int, str]:
+        """Size and ETag of a file, from the cache unless they are due to be revalidated"""
+        meta = self.cache.get_meta(name)
+        if meta is not None and time.time() - meta[2] < self.revalidate_seconds:
+            return meta[0], meta[1]
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if self._missing(e):
+                self.cache.invalidate(name)
+                raise FileNotFoundError(f"Not in storage: {name}") from e
+            raise
+        size, etag = response['ContentLength'], response['ETag'].strip('"')
+        if meta is not None and meta[1] != etag:
+            # Rewritten since it was cached here, e.g. by another node
+            self.cache.invalidate(name)
+        self.cache.put_meta(name, size, etag)
+        return size, etag
+
+    def size(self, name: str) -> int:
+        return self._meta(name)[0]
+
+    def exists(self, name: str) -> bool:
+        try:
+            self.size(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def open(self, name: str) -> BinaryIO:
+        size, etag = self._meta(name)
+        return io.BufferedReader(_RemoteReader(self, name, size, etag), self.cache.block_size)
+
+    def block(self, name: str, etag: str, index: int, size: int) -> bytes:
+        """One block of a version of a file, from the cache or fetched together with the missing blocks after it"""
+        data = self.cache.get_block(name, etag, index)
+        if data is not None:
+            return data
+
+        block_size = self.cache.block_size
+        last = min(index + self.READAHEAD_BLOCKS, (size - 1) // block_size + 1)
+        end = index + 1
+        while end < last and not self.cache.has_block(name, etag, end):
+            end += 1
+
+        start_byte = index * block_size
+        end_byte = min(end * block_size, size) - 1
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key(name),
+                                              Range=f'bytes={start_byte}-{end_byte}', IfMatch=f'"{etag}"')
+        except ClientError as e:
+            if self._missing(e):
+                self.cache.invalidate(name)
+                raise FileNotFoundError(f"Not in storage: {name}") from e
+            if e.response.get('Error', {}).get('Code') in ('412', 'PreconditionFailed'):
+                self.cache.invalidate(name)
+                raise FileNotFoundError(f"Changed in storage while being read: {name}") from e
+            raise
+
+        # Stream the body block by block into the cache
+        body = response['Body']
+        first = None
+        for current in range(index, end):
+            data = body.read(min(block_size, size - current * block_size))
+            self.cache.put_block(name, etag, current, data)
+            if first is None:
+                first = data
+        body.close()
+        return first
+
+    def write(self, name: str, data: bytes) -> None:
+        response = self.client.put_object(Bucket=self.bucket, Key=self.key(name), Body=data)
+        etag = response['ETag'].strip('"')
+        # Write through: files are usually read back on this node right away (derivatives, serving)
+        self.cache.invalidate(name)
+        block_size = self.cache.block_size
+        for index, start in enumerate(range(0, len(data), block_size)):
+            self.cache.put_block(name, etag, index, data[start:start + block_size])
+        self.cache.put_meta(name, len(data), etag)
+
+    def write_stream(self, name: str, stream: BinaryIO) -> None:
+        # upload_fileobj switches to a multipart upload for large files
+        self.client.upload_fileobj(stream, self.bucket, self.key(name))
+        self.cache.invalidate(name)
+
+    def put_file(self, name: str, path: str) -> None:
+        self.client.upload_file(path, self.bucket, self.key(name))
+        self.cache.invalidate(name)
+        os.remove(path)
+
+    def delete(self, name: str) -> bool:
+        existed = self.exists(name)
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        self.cache.invalidate(name)
+        return existed
+
+    def names(self) -> Iterator[str]:
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for entry in page.get('Contents', []):
+                yield entry['Key'].rsplit('/', 1)[-1]
+
+def storage_from_config(config) -> Storage:
+    """
+    Create the storage backend selected by STORAGE_BACKEND
+
+    Args:
+        config: The app config, or any mapping with the same keys
+
+    Returns:
+        LocalStorage under UPLOAD_FOLDER, or S3Storage for S3_BUCKET
+    """
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'], config.get('STORAGE_SHARD_DEPTH', 2))
+    if backend == 's3':
+        if not config.get('S3_BUCKET'):
+            raise ValueError("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        cache = RangeCache(config['STORAGE_CACHE_FOLDER'], config['STORAGE_CACHE_BYTES'], config['STORAGE_BLOCK_SIZE'])
+        return S3Storage(config['S3_BUCKET'], config.get('S3_PREFIX', ''), config.get('S3_ENDPOINT_URL'),
+                         config.get('S3_REGION'), cache, config.get('STORAGE_CACHE_REVALIDATE_SECONDS', 5.0))
+    raise ValueError(f"Unknown storage backend: {backend}")
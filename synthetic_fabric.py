@@ -0,0 +1,90 @@
+import math
+from typing import NamedTuple, Tuple
+
+import cv2
+import numpy as np
+
+from image_processor import STRIP_FRACTION
+
+class FabricSpec(NamedTuple):
+    """Parameters of a synthetic plain-weave fabric image"""
+    width: int
+    height: int
+    warp_pitch: float = 8.0  # Pixels between neighbouring warp (vertical) threads
+    weft_pitch: float = 10.0  # Pixels between neighbouring weft (horizontal) threads
+    noise: float = 10.0  # Standard deviation of the Gaussian sensor noise, in grey levels
+    rotation: float = 0.0  # Rotation of the weave in degrees
+    seed: int = 0
+
+def generate_fabric(spec: FabricSpec) -> np.ndarray:
+    """
+    Render a plain-weave fabric with known thread pitch
+
+    Warp and weft threads are shaded across their width and alternate which one
+    lies on top at each crossing, like a real plain weave under a microscope.
+
+    Args:
+        spec: Size, pitch, noise and rotation of the image
+
+    Returns:
+        BGR image as a uint8 numpy array
+    """
+    rng = np.random.default_rng(spec.seed)
+
+    # Render a larger canvas when rotating so the crop has no empty corners
+    angle = math.radians(spec.rotation)
+    margin = abs(math.sin(angle)) + abs(math.cos(angle)) if spec.rotation else 1.0
+    canvas_width = int(math.ceil(spec.width * margin)) + 2
+    canvas_height = int(math.ceil(spec.height * margin)) + 2
+
+    u = np.arange(canvas_width, dtype=np.float32) / spec.warp_pitch
+    v = np.arange(canvas_height, dtype=np.float32) / spec.weft_pitch
+
+    # Each thread is brightest along its centre line and dark in the gap to its neighbour
+    warp_shade = np.cos(np.pi * (u - np.round(u))) ** 2
+    weft_shade = np.cos(np.pi * (v - np.round(v))) ** 2
+
+    # Plain weave: the warp is on top where the thread indices have the same parity
+    warp_on_top = (np.round(v)[:, np.newaxis] + np.round(u)[np.newaxis, :]) % 2 == 0
+    fabric = np.where(warp_on_top, warp_shade[np.newaxis, :], weft_shade[:, np.newaxis])
+    fabric = 40 + 170 * fabric
+
+    if spec.rotation:
+        center = (canvas_width / 2, canvas_height / 2)
+        matrix = cv2.getRotationMatrix2D(center, spec.rotation, 1.0)
+        fabric = cv2.warpAffine(fabric.astype(np.float32), matrix, (canvas_width, canvas_height),
+                                flags=cv2.INTER_LINEAR)
+
+    top = (canvas_height - spec.height) // 2
+    left = (canvas_width - spec.width) // 2
+    fabric = fabric[top:top + spec.height, left:left + spec.width]
+
+    if spec.noise:
+        fabric = fabric + rng.normal(0, spec.noise, fabric.shape)
+
+    gray = np.clip(fabric, 0, 255).astype(np.uint8)
+
+    # A slight tint so colour conversion does real work
+    return cv2.merge([gray, (gray * 0.95).astype(np.uint8), (gray * 0.9).astype(np.uint8)])
+
+def expected_counts(spec: FabricSpec, reference_length: float = 1.0, deskewed: bool = False) -> Tuple[float, float]:
+    """
+    Ground-truth warp and weft counts for a synthetic fabric
+
+    Counts are measured like ThreadCounter does: threads crossing a STRIP_FRACTION
+    window along each image axis. A rotated weave crosses the axis at its pitch
+    divided by the cosine of the rotation, unless it is measured across the
+    threads as the spectral engine does.
+
+    Args:
+        spec: Parameters the image was generated with
+        reference_length: Reference length passed to the ThreadCounter
+        deskewed: Count across the threads rather than along the image axes
+
+    Returns:
+        Tuple of (warp_count, weft_count)
+    """
+    cos = 1.0 if deskewed else abs(math.cos(math.radians(spec.rotation)))
+    warp = spec.width * STRIP_FRACTION * cos / spec.warp_pitch * reference_length
+    weft = spec.height * STRIP_FRACTION * cos / spec.weft_pitch * reference_length
+    return warp, weft
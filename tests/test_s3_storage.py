@@ -0,0 +1,118 @@
+"""S3Storage against an in-process S3 (moto), including nodes that each keep their own range cache"""
+import io
+import os
+
+import pytest
+
+pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+import boto3
+
+from storage import RangeCache, S3Storage
+
+BUCKET = 'fabric-test'
+BLOCK_SIZE = 1024
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield
+
+
+def make_node(tmp_path, node: str, revalidate_seconds: float = 0) -> S3Storage:
+    """One web or worker node: the shared bucket, but a cache directory of its own"""
+    cache = RangeCache(str(tmp_path / node), 64 * BLOCK_SIZE, BLOCK_SIZE)
+    return S3Storage(BUCKET, 'uploads/', region='us-east-1', cache=cache,
+                     revalidate_seconds=revalidate_seconds)
+
+
+def payload(seed: int, length: int = 10 * BLOCK_SIZE + 123) -> bytes:
+    return bytes((seed + i * 7) % 251 for i in range(length))
+
+
+def test_round_trip(s3, tmp_path):
+    storage = make_node(tmp_path, 'a')
+    data = payload(1)
+    storage.write('a.jpg', data)
+    assert storage.read('a.jpg') == data
+    assert storage.size('a.jpg') == len(data)
+    assert list(storage.names()) == ['a.jpg']
+
+    # A cold cache reads the same bytes back in ranges
+    storage.cache.invalidate('a.jpg')
+    with storage.open('a.jpg') as f:
+        f.seek(3 * BLOCK_SIZE + 10)
+        assert f.read(BLOCK_SIZE) == data[3 * BLOCK_SIZE + 10:4 * BLOCK_SIZE + 10]
+        f.seek(-5, io.SEEK_END)
+        assert f.read() == data[-5:]
+
+    assert storage.delete('a.jpg')
+    assert not storage.exists('a.jpg')
+    with pytest.raises(FileNotFoundError):
+        storage.read('a.jpg')
+
+
+def test_stream_and_file_uploads(s3, tmp_path):
+    storage = make_node(tmp_path, 'a')
+    data = payload(2)
+    storage.write_stream('stream.jpg', io.BytesIO(data))
+    assert storage.read('stream.jpg') == data
+
+    path = tmp_path / 'upload.tmp'
+    path.write_bytes(data)
+    storage.put_file('file.jpg', str(path))
+    assert not os.path.exists(path)
+    assert storage.read('file.jpg') == data
+
+
+def test_rewrite_on_another_node(s3, tmp_path):
+    web, worker = make_node(tmp_path, 'web'), make_node(tmp_path, 'worker')
+    worker.write('overlay.jpg', payload(3))
+    assert web.read('overlay.jpg') == payload(3)
+
+    worker.write('overlay.jpg', payload(4, 5 * BLOCK_SIZE))
+    assert web.size('overlay.jpg') == 5 * BLOCK_SIZE
+    assert web.read('overlay.jpg') == payload(4, 5 * BLOCK_SIZE)
+
+
+def test_delete_on_another_node(s3, tmp_path):
+    web, worker = make_node(tmp_path, 'web'), make_node(tmp_path, 'worker')
+    web.write('a.jpg', payload(5))
+    assert web.read('a.jpg') == payload(5)
+
+    worker.delete('a.jpg')
+    assert not web.exists('a.jpg')
+    with pytest.raises(FileNotFoundError):
+        web.read('a.jpg')
+
+
+def test_cached_metadata_is_trusted_until_due(s3, tmp_path):
+    web, worker = make_node(tmp_path, 'web', revalidate_seconds=3600), make_node(tmp_path, 'worker')
+    worker.write('a.jpg', payload(6))
+    assert web.size('a.jpg') == len(payload(6))
+
+    worker.delete('a.jpg')
+    assert web.exists('a.jpg')
+    web.revalidate_seconds = 0
+    assert not web.exists('a.jpg')
+
+
+def test_rewrite_during_read(s3, tmp_path):
+    web, worker = make_node(tmp_path, 'web'), make_node(tmp_path, 'worker')
+    worker.write('a.jpg', payload(7, 40 * BLOCK_SIZE))
+
+    with web.open('a.jpg') as f:
+        assert f.read(BLOCK_SIZE) == payload(7, 40 * BLOCK_SIZE)[:BLOCK_SIZE]
+        worker.write('a.jpg', payload(8, 40 * BLOCK_SIZE))
+        # The blocks past the readahead belong to the new version and must not be mixed in
+        f.seek(30 * BLOCK_SIZE)
+        with pytest.raises(FileNotFoundError):
+            f.read(BLOCK_SIZE)
+
+    assert web.read('a.jpg') == payload(8, 40 * BLOCK_SIZE)
@@ -0,0 +1,236 @@
+import logging
+from typing import Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:  # pragma: no cover - out-of-core analysis is optional
+    tifffile = None
+
+try:
+    import zarr
+except ImportError:  # pragma: no cover - without zarr, compressed TIFFs are decoded to a temporary memory map
+    zarr = None
+
+logger = logging.getLogger(__name__)
+
+TIFF_EXTENSIONS = {'tif', 'tiff'}
+
+# Images with at least this many pixels are analyzed out of core; smaller ones are cheaper to decode whole
+OUT_OF_CORE_PIXELS = 64 * 1024 * 1024
+
+# Side in pixels of the blocks read and preprocessed at a time, excluding their halo. Tiles under
+# a block's halo are decoded again with the neighbouring block, which larger blocks make rarer.
+BLOCK_SIZE = 2048
+
+# Block = (top, bottom, left, right, gray, pad_top, pad_left): the block's bounds in the image,
+# its grayscale pixels including the halo, and where the block starts within them
+Block = Tuple[int, int, int, int, np.ndarray, int, int]
+
+def is_tiff(name: str) -> bool:
+    """Whether a file name has a TIFF extension"""
+    return '.' in name and name.rsplit('.', 1)[1].lower() in TIFF_EXTENSIONS
+
+class TiledImage:
+    """
+    A TIFF read region by region instead of being decoded whole
+
+    Uncompressed, contiguous TIFFs are read row segment by row segment straight
+    from the file. Tiled or striped compressed TIFFs are read through a zarr
+    view of their tiles when zarr is installed, so a region only decodes the
+    tiles it covers; otherwise they are decoded once into a temporary
+    memory-mapped file. Either way, peak memory is bounded by the block size
+    rather than by the image.
+
+    Pixels are converted the way cv2.imread converts them (RGB to BGR, 16-bit
+    to 8-bit), so an analysis of the blocks matches one of the decoded image.
+    """
+
+    def __init__(self, source, name: str):
+        """
+        Open a TIFF for region reads
+
+        Args:
+            source: Path of the file, or a seekable binary file object
+            name: Name of the image, used in log and error messages
+
+        Raises:
+            ValueError: If the TIFF's pixel layout is not supported out of core
+        """
+        if tifffile is None:
+            raise ValueError("Out-of-core analysis requires the tifffile package")
+        self.source = name
+        self.preview: Optional[np.ndarray] = None
+        # File objects passed in are closed with the image
+        self._handle = None if isinstance(source, str) else source
+        try:
+            self._tiff = tifffile.TiffFile(source)
+            self._array, self.channels = self._open_array(self._tiff.pages.first)
+        except Exception:
+            self.close()
+            raise
+        self.shape = self._array.shape[:2]
+
+    @staticmethod
+    def _open_array(page):
+        """Array-like view of the first page, with the samples axis last"""
+        if page.photometric not in (tifffile.PHOTOMETRIC.MINISBLACK, tifffile.PHOTOMETRIC.RGB):
+            raise ValueError(f"Unsupported TIFF photometric interpretation: {page.photometric.name}")
+        if page.dtype not in (np.uint8, np.uint16):
+            raise ValueError(f"Unsupported TIFF sample type: {page.dtype}")
+        channels = page.samplesperpixel
+        if page.axes not in ('YX', 'YXS', 'SYX') or channels not in (
+                (1,) if page.photometric == tifffile.PHOTOMETRIC.MINISBLACK else (3, 4)):
+            raise ValueError(f"Unsupported TIFF layout: {page.axes} with {channels} samples per pixel")
+
+        if page.is_memmappable:
+            return _ContiguousView(page, channels), channels
+        if zarr is not None:
+            array = zarr.open(page.aszarr(), mode='r')
+            return (_PlanarView(array) if page.axes == 'SYX' else array), channels
+        array = page.asarray(out='memmap')
+        return (np.moveaxis(array, 0, -1) if page.axes == 'SYX' else array), channels
+
+    def read(self, top: int, bottom: int, left: int, right: int) -> np.ndarray:
+        """
+        Read a region as cv2.imread would have decoded it
+
+        Returns:
+            8-bit BGR pixels, or grayscale for single-channel TIFFs
+        """
+        region = np.asarray(self._array[top:bottom, left:right])
+        if self.channels == 1:
+            # OpenCV keeps the high byte of 16-bit grayscale...
+            return np.ascontiguousarray(region >> 8 if region.dtype == np.uint16 else region, dtype=np.uint8)
+        region = cv2.cvtColor(np.ascontiguousarray(region[..., :3]), cv2.COLOR_RGB2BGR)
+        # ...but scales 16-bit color to the nearest 8-bit value
+        return cv2.convertScaleAbs(region, alpha=255 / 65535) if region.dtype == np.uint16 else region
+
+    def blocks(self, block_size: int, halo: int, preview_size: int) -> Iterator[Block]:
+        """
+        Read the image block by block in grayscale, with `halo` pixels of context on every side
+
+        Blocks are read row by row. A downscaled color preview with its longest side at
+        most preview_size is assembled along the way and available as `preview` once
+        every block has been read.
+
+        Args:
+            block_size: Side of each block in pixels
+            halo: Pixels of surrounding context to include, where the image has them
+            preview_size: Longest side of the preview
+
+        Yields:
+            Block tuples
+        """
+        height, width = self.shape
+        scale = min(1.0, preview_size / max(height, width))
+        preview = np.zeros((max(1, round(height * scale)), max(1, round(width * scale)), 3), np.uint8)
+
+        for top in range(0, height, block_size):
+            bottom = min(top + block_size, height)
+            for left in range(0, width, block_size):
+                right = min(left + block_size, width)
+                outer_top, outer_left = max(0, top - halo), max(0, left - halo)
+                pixels = self.read(outer_top, min(height, bottom + halo), outer_left, min(width, right + halo))
+                pad_top, pad_left = top - outer_top, left - outer_left
+
+                # Paste the block, without its halo, into the preview
+                core = pixels[pad_top:pad_top + bottom - top, pad_left:pad_left + right - left]
+                y0, y1 = round(top * scale), round(bottom * scale)
+                x0, x1 = round(left * scale), round(right * scale)
+                if y1 > y0 and x1 > x0:
+                    small = cv2.resize(core, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+                    preview[y0:y1, x0:x1] = small[..., np.newaxis] if small.ndim == 2 else small
+
+                if pixels.ndim == 3:
+                    pixels = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+                yield top, bottom, left, right, pixels, pad_top, pad_left
+
+        self.preview = preview
+
+    def close(self) -> None:
+        """Close the file; the preview stays available"""
+        self._array = None
+        if getattr(self, '_tiff', None) is not None:
+            self._tiff.close()
+        if self._handle is not None:
+            self._handle.close()
+
+class _ContiguousView:
+    """
+    Samples-last view of an uncompressed, contiguous page, read row by row from the file
+
+    Unlike a memory map, nothing stays mapped once a region has been read, so
+    the process's resident memory does not grow with the image.
+    """
+
+    def __init__(self, page, channels: int):
+        self._fh = page.parent.filehandle
+        self._offset = page.dataoffsets[0]
+        self._planar = page.axes == 'SYX'
+        self._dtype = np.dtype(page.dtype).newbyteorder(page.parent.byteorder)
+        self._samples = 1 if page.axes == 'YX' else channels
+        height, width = page.imagelength, page.imagewidth
+        self.shape = (height, width) if page.axes == 'YX' else (height, width, channels)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        top, bottom, _ = rows.indices(self.shape[0])
+        left, right, _ = cols.indices(self.shape[1])
+        width, itemsize = self.shape[1], self._dtype.itemsize
+        out = np.empty((bottom - top, right - left, self._samples), self._dtype)
+
+        # Planar pages store each sample as a whole image after the other
+        planes = [(s, self._offset + s * self.shape[0] * width * itemsize) for s in range(self._samples)] \
+            if self._planar else [(slice(None), self._offset)]
+        pixel = itemsize * (1 if self._planar else self._samples)
+        for sample, offset in planes:
+            for row in range(top, bottom):
+                target = out[row - top, :, sample]
+                self._fh.seek(offset + (row * width + left) * pixel)
+                target[...] = np.frombuffer(self._fh.read((right - left) * pixel), self._dtype).reshape(target.shape)
+        out = out.astype(self._dtype.newbyteorder('='), copy=False)
+        return out[..., 0] if len(self.shape) == 2 else out
+
+class _PlanarView:
+    """Samples-last view of a planar (samples, height, width) zarr array"""
+
+    def __init__(self, array):
+        self._array = array
+        self.shape = tuple(array.shape[1:]) + (array.shape[0],)
+
+    def __getitem__(self, key):
+        return np.moveaxis(np.asarray(self._array[(slice(None),) + key]), 0, -1)
+
+def open_tiled_image(name: str, storage=None, min_pixels: int = OUT_OF_CORE_PIXELS) -> Optional[TiledImage]:
+    """
+    Open an image for out-of-core analysis if it is a TIFF large enough to need it
+
+    Args:
+        name: Path of the image, or its stored name when a storage is given
+        storage: Upload storage backend (see storage.py); remote files are read
+            through its range cache rather than downloaded whole
+        min_pixels: Smallest image, in pixels, worth analyzing out of core
+
+    Returns:
+        The opened image, or None if it should be decoded whole: not a TIFF, too
+        small, a layout the tile reader does not handle, or tifffile missing
+    """
+    if tifffile is None or not is_tiff(name):
+        return None
+
+    source = name
+    if storage is not None:
+        source = storage.local_path(name) or storage.open(name)
+    try:
+        image = TiledImage(source, name)
+    except (ValueError, tifffile.TiffFileError) as e:
+        logger.debug("Decoding %s whole: %s", name, e)
+        return None
+
+    if image.shape[0] * image.shape[1] < min_pixels:
+        image.close()
+        return None
+    return image
@@ -12,33 +12,7 @@ def ensure_upload_dir(upload_folder: str) -> None:
     """Ensure the upload directory exists"""
     if not os.path.exists(upload_folder):
         os.makedirs(upload_folder)
-        logger.info(f"Created upload directory: {upload_folder}")
-
-def delete_old_files(folder: str, max_age_days: int = 7) -> None:
-    """Delete files older than max_age_days from the specified folder"""
-    import time
-    from datetime import datetime, timedelta
-    
-    current_time = time.time()
-    max_age_seconds = max_age_days * 24 * 60 * 60
-    
-    for filename in os.listdir(folder):
-        file_path = os.path.join(folder, filename)
-        
-        # Skip if it's not a file
-        if not os.path.isfile(file_path):
-            continue
-        
-        # Get file modification time
-        file_age = current_time - os.path.getmtime(file_path)
-        
-        # If file is older than max_age_days, delete it
-        if file_age > max_age_seconds:
-            try:
-                os.remove(file_path)
-                logger.info(f"Deleted old file: {file_path}")
-            except Exception as e:
-                logger.error(f"Error deleting file {file_path}: {str(e)}")
+        logger.info("Created upload directory: %s", upload_folder)
 
 def generate_unique_filename(original_filename: str) -> str:
     """Generate a unique filename with UUID to prevent collisions"""
@@ -54,7 +28,7 @@ def image_to_base64(image_path: str) -> Optional[str]:
         with open(image_path, "rb") as img_file:
             return base64.b64encode(img_file.read()).decode('utf-8')
     except Exception as e:
-        logger.error(f"Error converting image to base64: {str(e)}")
+        logger.error("Error converting image to base64: %s", e)
         return None
 
 def base64_to_cv2(base64_string: str) -> Optional[np.ndarray]:
@@ -71,7 +45,7 @@ def base64_to_cv2(base64_string: str) -> Optional[np.ndarray]:
         
         return img
     except Exception as e:
-        logger.error(f"Error converting base64 to cv2 image: {str(e)}")
+        logger.error("Error converting base64 to cv2 image: %s", e)
         return None
 
 def calculate_confidence(warp_count: int, weft_count: int, 
@@ -0,0 +1,73 @@
+from app import app, artifact_store, storage
+from artifact_store import ArtifactStore
+from image_processor import ThreadCounter, VISUALIZATION_VERSION
+from derivatives import create_overlay_preview, encode_overlay, snap_overlay_params
+
+def visualization_key(analysis):
+    """Artifact store key for an analysis visualization and the parameters it was rendered with"""
+    return ArtifactStore.make_key('visualization', analysis.id, {
+        'unit': analysis.measurement_unit,
+        'reference_length': analysis.reference_length,
+        'warp_count': analysis.warp_count,
+        'weft_count': analysis.weft_count,
+        'version': VISUALIZATION_VERSION,
+    })
+
+def store_visualization(analysis, visualization):
+    """Persist the JPEG visualization produced at analysis time, along with its overlay preview"""
+    if not visualization:
+        return None
+    artifact = artifact_store.put(visualization_key(analysis), visualization)
+    create_overlay_preview(storage, analysis.filename, artifact.data)
+    return artifact
+
+def copy_visualization(analysis, source):
+    """Store the visualization of a near-identical analysis as this analysis's own"""
+    artifact = artifact_store.put(visualization_key(analysis), get_visualization(source).data)
+    create_overlay_preview(storage, analysis.filename, artifact.data)
+    return artifact
+
+def get_visualization(analysis):
+    """Fetch an analysis visualization, rendering it once if it was never stored"""
+    key = visualization_key(analysis)
+    artifact = artifact_store.get(key)
+    if artifact is not None:
+        return artifact
+    
+    # Analyses created before the artifact store existed: render from the stored counts
+    # instead of re-running the whole analysis, then keep the result for next time
+    counter = ThreadCounter(unit=analysis.measurement_unit, reference_length=analysis.reference_length or 1.0,
+                            storage=storage)
+    skew_angle = analysis.skew_angle if app.config['DESKEW_OVERLAY'] else None
+    regions = [region.to_dict() for region in analysis.regions] or None
+    data = counter.render_visualization(analysis.filename, analysis.warp_count, analysis.weft_count,
+                                        skew_angle=skew_angle, regions=regions)
+    if data is None:
+        raise ValueError(f"Could not read image: {analysis.filename}")
+    return artifact_store.put(key, data)
+
+def get_overlay(analysis, fmt='jpg', quality=None, max_side=None):
+    """
+    Fetch the visualization in the requested format, quality and size
+
+    The stored JPEG is served as is when no re-encoding is asked for. Other
+    renditions are snapped to a few quality and size steps, and since they are
+    cheap to encode again they are only kept in the artifact store's memory
+    tier, keyed on the visualization they were made from so a re-rendered one
+    replaces them.
+    """
+    source = get_visualization(analysis)
+    if fmt == 'jpg' and quality is None and max_side is None:
+        return source
+    
+    quality, max_side = snap_overlay_params(quality, max_side)
+    key = ArtifactStore.make_key('overlay', analysis.id, {
+        'source': source.digest,
+        'format': fmt,
+        'quality': quality,
+        'max_side': max_side,
+    })
+    artifact = artifact_store.recall(key)
+    if artifact is not None:
+        return artifact
+    return artifact_store.remember(key, encode_overlay(source.data, fmt, quality, max_side), source.last_modified)
@@ -0,0 +1,47 @@
+"""
+WSGI entry point for production servers
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The schema is created by the server's master process (see gunicorn.conf.py or
+``flask init-db``), not when this module is imported.
+"""
+import logging
+import time
+
+import cv2
+
+from app import app, db
+from image_processor import ThreadCounter, ImagePipeline
+from synthetic_fabric import FabricSpec, generate_fabric
+
+logger = logging.getLogger(__name__)
+
+# Size of the synthetic fabric analyzed at warmup
+WARMUP_SIZE = 256
+
+def warm_up(cv2_threads: int) -> None:
+    """
+    Prepare a freshly forked worker so its first request is not slower than the rest
+
+    Caps OpenCV's thread pool at the worker's share of the cores, so workers do
+    not oversubscribe the machine, then runs one small analysis to load the
+    OpenCV kernels, NumPy's FFT and the JPEG encoder. Also opens the worker's
+    own database connection instead of reusing any the master opened before
+    forking.
+
+    Args:
+        cv2_threads: Number of threads OpenCV may use in this worker
+    """
+    start = time.perf_counter()
+    cv2.setNumThreads(cv2_threads)
+
+    fabric = generate_fabric(FabricSpec(WARMUP_SIZE, WARMUP_SIZE))
+    ThreadCounter(engine=app.config['ANALYSIS_ENGINE']).count_threads(ImagePipeline(fabric, '<warmup>'))
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+        with db.engine.connect():
+            pass
+
+    logger.info("Worker warmed up in %.0f ms with %s OpenCV threads", (time.perf_counter() - start) * 1000, cv2_threads)